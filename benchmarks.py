@@ -0,0 +1,1035 @@
+import bottle
+import collections
+import http.client
+import itertools
+import multiprocessing
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import webls
+import wsgiref.util
+
+from pathlib import Path
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_for_filename
+from pygments.lexers.special import TextLexer
+from pygments.util import ClassNotFound
+from unittest import mock
+from werkzeug.test import Client
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.removeprefix('bench_')] = func
+
+    return func
+
+
+def app_build(fs_root, **kwargs):
+    return webls.app_build(
+        development=False,
+        root=Path('.').absolute(),
+        fs_root=Path(fs_root).absolute(),
+        **kwargs,
+    )
+
+
+def timeit(func, *, repeat=5):
+    timings = []
+
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started_at)
+
+    return min(timings)
+
+
+class CountingDirEntry:
+    def __init__(self, dir_entry, counts):
+        self.dir_entry = dir_entry
+        self.counts = counts
+        self.fetched = set()
+
+        self.name = dir_entry.name
+        self.path = dir_entry.path
+
+    def fetch(self, follow_symlinks):
+        if follow_symlinks and self.dir_entry.is_symlink():
+            kind = 'stat'
+        else:
+            kind = 'lstat'
+
+        if kind not in self.fetched:
+            self.fetched.add(kind)
+            self.counts[kind] += 1
+
+    def stat(self, *, follow_symlinks=True):
+        self.fetch(follow_symlinks)
+
+        return self.dir_entry.stat(follow_symlinks=follow_symlinks)
+
+    def is_dir(self, *, follow_symlinks=True):
+        if follow_symlinks and self.dir_entry.is_symlink():
+            self.fetch(follow_symlinks)
+
+        return self.dir_entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self):
+        return self.dir_entry.is_symlink()
+
+
+class CountingScandir:
+    def __init__(self, path, counts):
+        self.iterator = os_scandir(path)
+        self.counts = counts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.iterator.close()
+
+    def __iter__(self):
+        for dir_entry in self.iterator:
+            yield CountingDirEntry(dir_entry, self.counts)
+
+
+os_scandir = os.scandir
+
+
+def syscalls_count(func):
+    """
+    Count the filesystem syscalls made by `func`.
+
+    `os` functions are wrapped directly, `os.DirEntry` methods are counted
+    at the point where they would hit the filesystem, assuming `d_type` is
+    filled in by `readdir`.
+    """
+    counts = collections.Counter()
+
+    def wrap(name, real):
+        def wrapper(path, *args, follow_symlinks=True, **kwargs):
+            counts[name if follow_symlinks else 'lstat'] += 1
+            return real(path, *args, follow_symlinks=follow_symlinks, **kwargs)
+
+        return wrapper
+
+    def wrap_plain(name, real):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return real(*args, **kwargs)
+
+        return wrapper
+
+    patches = [
+        mock.patch.object(os, 'stat', wrap('stat', os.stat)),
+        mock.patch.object(os, 'lstat', wrap_plain('lstat', os.lstat)),
+        mock.patch.object(os, 'readlink', wrap_plain('readlink', os.readlink)),
+        mock.patch.object(os, 'listdir', wrap_plain('listdir', os.listdir)),
+        mock.patch.object(
+            os,
+            'scandir',
+            lambda path: CountingScandir(path, counts),
+        ),
+    ]
+
+    for patch in patches:
+        patch.start()
+    try:
+        result = func()
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+
+    return counts, result
+
+
+def dir_read_entries_pathlib(app, fs_path):
+    # `dir_read_entries` before it was moved to `os.scandir`
+    def dir_entry_sort_key(path):
+        path_str = str(path)
+
+        dir_first = -1 if path.is_dir() else 1
+        dot_first = -1 if path_str.startswith('.') else 1
+
+        return (dir_first, dot_first, path_str)
+
+    try:
+        entries = list(fs_path.iterdir())
+    except PermissionError:
+        entries = []
+
+    entries.sort(key=dir_entry_sort_key)
+    for idx, entry in enumerate(entries):
+        url_path = entry.relative_to(app.fs_root)
+        entry_stat = entry.stat(follow_symlinks=False)
+        entries[idx] = {
+            'is_dir': False,
+            'is_symlink': False,
+            'mode': stat.filemode(entry_stat.st_mode),
+            'size_bytes': entry_stat.st_size,
+            'size_pretty': webls.size_pretty(entry_stat.st_size),
+            'name': entry.name,
+            'url': webls.get_url(app, 'fs', url_path),
+            'dl_url': webls.get_url(app, 'dl', url_path),
+            'entry_class': 'is-file',
+            'symlink_path': None,
+            'symlink_class': 'is-file',
+        }
+
+        if entry.is_dir():
+            entries[idx]['is_dir'] = True
+            entries[idx]['name'] += '/'
+            entries[idx]['url'] += '/'
+            entries[idx]['entry_class'] = 'is-dir'
+            entries[idx]['symlink_class'] = 'is-dir'
+        elif entry.is_socket():
+            entries[idx]['entry_class'] = 'is-socket'
+        elif entry.is_fifo():
+            entries[idx]['entry_class'] = 'is-fifo'
+        elif entry.is_char_device():
+            entries[idx]['entry_class'] = 'is-char-device'
+        elif entry.is_block_device():
+            entries[idx]['entry_class'] = 'is-block-device'
+
+        if entry.is_symlink():
+            entries[idx]['is_symlink'] = True
+            entries[idx]['symlink_path'] = entry.readlink()
+            if entry.exists():
+                entries[idx]['entry_class'] = 'is-symlink'
+            else:
+                entries[idx]['entry_class'] = 'is-symlink-broken'
+
+    return entries
+
+
+def tree_populate(path, *, files, dirs=0, symlinks=0):
+    for idx in range(files):
+        path.joinpath(f'file-{idx:06d}.txt').write_bytes(b'x' * (idx % 512))
+    for idx in range(dirs):
+        path.joinpath(f'dir-{idx:06d}').mkdir()
+    for idx in range(symlinks):
+        path.joinpath(f'link-{idx:06d}.txt').symlink_to(f'file-{idx:06d}.txt')
+
+
+@benchmark
+def bench_dir_read_entries():
+    ENTRY_COUNT = 20_000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        tree_populate(
+            fs_root,
+            files=ENTRY_COUNT - 2000,
+            dirs=1000,
+            symlinks=1000,
+        )
+        app = app_build(fs_root)
+
+        implementations = [
+            ('pathlib', dir_read_entries_pathlib),
+            ('scandir', lambda *args: webls.dir_read_entries(*args)[0]),
+        ]
+        results = []
+
+        for name, func in implementations:
+            counts, entries = syscalls_count(lambda: func(app, fs_root))
+            elapsed = timeit(lambda: func(app, fs_root))
+            total = sum(counts.values())
+            results.append(entries)
+
+            print(
+                f'{name:>8}: {ENTRY_COUNT} entries,'
+                f' {elapsed * 1000:.1f}ms,'
+                f' {total / ENTRY_COUNT:.2f} syscalls/entry'
+                f' ({dict(sorted(counts.items()))})'
+            )
+
+        assert results[0] == results[1], 'listings differ'
+
+
+@benchmark
+def bench_dir_pages():
+    ENTRY_COUNT = 100_000
+    LIMIT = webls.DIR_PAGE_SIZE
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        tree_populate(fs_root, files=ENTRY_COUNT)
+        app = app_build(fs_root)
+
+        offsets = [
+            ('first', 0),
+            ('middle', ENTRY_COUNT // 2),
+            ('last', ENTRY_COUNT - LIMIT),
+        ]
+        for name, offset in offsets:
+            elapsed = timeit(
+                lambda: webls.dir_read_entries(
+                    app,
+                    fs_root,
+                    offset=offset,
+                    limit=LIMIT,
+                ),
+                repeat=3,
+            )
+            print(f'{name:>8} page: {elapsed * 1000:.1f}ms')
+
+        elapsed = timeit(lambda: webls.dir_read_entries(app, fs_root), repeat=1)
+        print(f'{"all":>8} entries: {elapsed * 1000:.1f}ms')
+
+
+@benchmark
+def bench_search():
+    DIR_COUNT = 1000
+    FILES_PER_DIR = 200
+    QUERIES = ['file-000042', 'dir-000777', 'absent']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        for idx in range(DIR_COUNT):
+            dir_path = fs_root.joinpath(
+                f'dir-{idx // 100:04d}',
+                f'dir-{idx:06d}',
+            )
+            dir_path.mkdir(parents=True)
+            tree_populate(dir_path, files=FILES_PER_DIR)
+
+        mtime = time.time() - 60
+        for dir_path, _, _ in os.walk(fs_root):
+            os.utime(dir_path, (mtime, mtime))
+
+        search_index = webls.SearchIndex(fs_root=fs_root, interval=60)
+        started_at = time.perf_counter()
+        search_index.crawl()
+        elapsed = time.perf_counter() - started_at
+        stats = search_index.stats()
+        print(
+            f'{"crawl":>12}: {stats["names"]} names,'
+            f' {elapsed * 1000:.0f}ms,'
+            f' {stats["size"] / stats["names"]:.1f} bytes/name'
+        )
+
+        elapsed = timeit(search_index.crawl, repeat=3)
+        print(f'{"recrawl":>12}: {elapsed * 1000:.0f}ms')
+
+        for query in QUERIES:
+            elapsed = timeit(
+                lambda: search_index.search(query, limit=webls.SEARCH_LIMIT),
+            )
+            print(f'{query:>12}: {elapsed * 1000:.2f}ms')
+
+
+@benchmark
+def bench_dir_sizes():
+    DIR_COUNT = 1000
+    FILES_PER_DIR = 200
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        for idx in range(DIR_COUNT):
+            dir_path = fs_root.joinpath(
+                f'dir-{idx // 100:04d}',
+                f'dir-{idx:06d}',
+            )
+            dir_path.mkdir(parents=True)
+            tree_populate(dir_path, files=FILES_PER_DIR)
+
+        mtime = time.time() - 60
+        for dir_path, _, _ in os.walk(fs_root):
+            os.utime(dir_path, (mtime, mtime))
+
+        dir_sizes = webls.DirSizes(fs_root=fs_root, interval=60, max_age=600)
+        app = app_build(fs_root)
+        app.dir_sizes = dir_sizes
+
+        cases = [
+            ('crawl', lambda: (dir_sizes.records.clear(), dir_sizes.crawl())),
+            ('recrawl', dir_sizes.crawl),
+        ]
+        for name, func in cases:
+            counts, _ = syscalls_count(func)
+            elapsed = timeit(func, repeat=3)
+            print(
+                f'{name:>8}: {elapsed * 1000:.0f}ms,'
+                f' {sum(counts.values())} syscalls'
+            )
+
+        fs_path = fs_root.joinpath('dir-0000')
+        entries, _ = webls.dir_read_entries(app, fs_path)
+        with mock.patch.object(dir_sizes, 'ensure_started'):
+            elapsed = timeit(
+                lambda: webls.dir_sizes_kwargs(app, fs_path, entries),
+            )
+        print(
+            f'{"lookup":>8}: {elapsed * 1000:.2f}ms'
+            f' for a listing of {len(entries)} directories'
+        )
+
+
+@benchmark
+def bench_grep():
+    FILE_COUNT = 256
+    FILE_SIZE = 1 << 20
+    LINE = b'lorem ipsum dolor sit amet, consectetur adipiscing elit\n'
+
+    cpu_count = os.cpu_count()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        content = LINE * (FILE_SIZE // len(LINE)) + b'needle\n'
+        for idx in range(FILE_COUNT):
+            fs_root.joinpath(f'file-{idx:06d}.txt').write_bytes(content)
+        total_size = FILE_COUNT * len(content)
+
+        for processes in sorted({1, cpu_count}):
+            app = app_build(
+                fs_root,
+                grep_processes=processes,
+                grep_bytes=total_size,
+            )
+            client = Client(app)
+            # start the pool outside of the timings
+            client.get('/grep?q=needle').close()
+
+            elapsed = timeit(
+                lambda: client.get('/grep?q=needle').data,
+                repeat=3,
+            )
+            app.grep_pool.shutdown()
+
+            print(
+                f'processes={processes}:'
+                f' {total_size / elapsed / (1 << 20):.0f} MiB/s'
+            )
+
+
+@benchmark
+def bench_lines():
+    LINE_COUNT = 10_000_000
+    LINE = 'lorem ipsum dolor sit amet, consectetur adipiscing {:09d}\n'
+    WINDOW = 100
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir, 'root')
+        fs_root.mkdir()
+        path = fs_root.joinpath('big.log')
+        with path.open('w') as file:
+            for start in range(0, LINE_COUNT, 100_000):
+                lines = range(start, start + 100_000)
+                file.write(''.join(map(LINE.format, lines)))
+
+        app = app_build(fs_root, line_index_dir=Path(tmp_dir, 'index'))
+        client = Client(app)
+
+        def window(first):
+            return client.get(
+                f'/fs/big.log?lines={first}-{first + WINDOW - 1}',
+            ).close()
+
+        started_at = time.perf_counter()
+        window(1)
+        elapsed = time.perf_counter() - started_at
+        print(
+            f'{"index":>12}: {path.stat().st_size >> 20} MiB,'
+            f' {elapsed * 1000:.0f}ms'
+        )
+
+        for first in [1, LINE_COUNT // 2, LINE_COUNT - WINDOW]:
+            # leave the highlight cache out of the timings
+            app.highlight_cache = webls.ByteLruCache(max_bytes=0)
+            elapsed = timeit(lambda: window(first))
+            print(f'{f"line {first}":>12}: {elapsed * 1000:.1f}ms')
+
+        with path.open('a') as file:
+            lines = range(LINE_COUNT, LINE_COUNT + 1000)
+            file.write(''.join(map(LINE.format, lines)))
+        started_at = time.perf_counter()
+        client.get(f'/fs/big.log?lines=-{WINDOW}').close()
+        elapsed = time.perf_counter() - started_at
+        print(f'{"append":>12}: {elapsed * 1000:.1f}ms')
+
+        def scan():
+            # what finding the middle line costs without the index
+            with path.open('rb') as file:
+                for _ in itertools.islice(file, LINE_COUNT // 2):
+                    pass
+
+        elapsed = timeit(scan, repeat=1)
+        print(f'{"scan":>12}: {elapsed * 1000:.0f}ms to the middle line')
+
+
+@benchmark
+def bench_text_render():
+    LINE = 'lorem ipsum <dolor> sit amet & "consectetur" adipiscing elit\n'
+
+    for size in [64 << 10, 1 << 20]:
+        text = LINE * (size // len(LINE))
+        cases = [
+            (
+                'pygments',
+                lambda: highlight(
+                    text,
+                    TextLexer(stripnl=False),
+                    HtmlFormatter(linenos=True),
+                ),
+            ),
+            ('plain', lambda: webls.plain_text_html(text)),
+        ]
+
+        for name, func in cases:
+            tracemalloc.start()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            elapsed = timeit(func, repeat=3)
+
+            print(
+                f'{size >> 10:>5} KiB {name:>8}: {elapsed * 1000:.1f}ms,'
+                f' peak {peak / (1 << 20):.1f} MiB'
+            )
+
+
+@benchmark
+def bench_lexers():
+    NAMES = [
+        'main.py', 'notes.txt', 'README', 'Makefile', 'app.min.js',
+        'photo.jpeg', 'data.csv', 'CMakeLists.txt', 'x.unknown',
+    ]
+
+    for module in ['bottle', 'pygments.lexers', 'webls']:
+        elapsed = timeit(
+            lambda: subprocess.run(
+                [sys.executable, '-c', f'import {module}'],
+                check=True,
+            ),
+        )
+        print(f'{f"import {module}":>22}: {elapsed * 1000:.0f}ms')
+
+    def pygments_get():
+        for name in NAMES:
+            try:
+                get_lexer_for_filename(name)
+            except ClassNotFound:
+                pass
+
+    elapsed = timeit(lambda: webls.Lexers().get('main.py'))
+    print(f'{"index build":>22}: {elapsed * 1000:.1f}ms')
+
+    lexers = webls.Lexers()
+    cases = [
+        ('get_lexer_for_filename', pygments_get),
+        ('index', lambda: [lexers.get(name) for name in NAMES]),
+    ]
+    for name, func in cases:
+        elapsed = timeit(func)
+        print(f'{name:>22}: {elapsed * 1e6:.0f}us for {len(NAMES)} names')
+
+
+def server_start(*args):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    process = subprocess.Popen(
+        [
+            sys.executable, '-m', 'webls',
+            '--root', 'storage',
+            '--port', str(port),
+            *args,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+    return process, port
+
+
+def load_client(args):
+    port, path, duration = args
+    count = 0
+    stop_at = time.monotonic() + duration
+
+    while time.monotonic() < stop_at:
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        connection.request('GET', path)
+        connection.getresponse().read()
+        connection.close()
+        count += 1
+
+    return count
+
+
+def load_run(port, path, *, clients, duration):
+    with multiprocessing.Pool(clients) as pool:
+        counts = pool.map(load_client, [(port, path, duration)] * clients)
+
+    return sum(counts) / duration
+
+
+@benchmark
+def bench_pages():
+    URLS = ['/fs/', '/fs/nested/', '/fs/lorem.txt', '/fs/image.jpg']
+    REQUESTS = 100
+
+    for development in [False, True]:
+        app = webls.app_build(
+            development=development,
+            root=Path('.').absolute(),
+            fs_root=Path('storage').absolute(),
+            search_interval=0,
+        )
+        client = Client(app)
+
+        for url in URLS:
+            size = len(client.get(url).data)
+            elapsed = timeit(
+                lambda: [client.get(url).close() for _ in range(REQUESTS)],
+                repeat=3,
+            )
+            print(
+                f'development={development!s:<5} {url:>14}: {size} bytes,'
+                f' {elapsed / REQUESTS * 1000:.2f}ms'
+            )
+
+
+def wsgi_get(app, path, query=''):
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query}
+    wsgiref.util.setup_testing_defaults(environ)
+
+    body = app(environ, lambda status, headers, exc_info=None: None)
+    first_at = None
+    size = 0
+    try:
+        for chunk in body:
+            if first_at is None:
+                first_at = time.perf_counter()
+            size += len(chunk)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+    return first_at, size
+
+
+@benchmark
+def bench_streaming():
+    ENTRY_COUNT = webls.DIR_PAGE_SIZE_MAX
+    LINE = 'lorem = ipsum("dolor", sit, amet) + 42  # consectetur\n'
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        tree_populate(fs_root, files=ENTRY_COUNT)
+        fs_root.joinpath('lorem.py').write_text(LINE * 4000)
+        app = app_build(fs_root, search_interval=0, highlight_cache_size=0)
+
+        cases = [
+            ('listing', '/fs/', f'limit={ENTRY_COUNT}'),
+            ('highlight', '/fs/lorem.py', ''),
+        ]
+        for name, path, query in cases:
+            wsgi_get(app, path, query)
+
+            started_at = time.perf_counter()
+            first_at, size = wsgi_get(app, path, query)
+            ended_at = time.perf_counter()
+
+            tracemalloc.start()
+            wsgi_get(app, path, query)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(
+                f'{name:>10}: {size >> 10} KiB,'
+                f' first byte {(first_at - started_at) * 1000:.1f}ms,'
+                f' total {(ended_at - started_at) * 1000:.1f}ms,'
+                f' peak {peak / (1 << 20):.1f} MiB'
+            )
+
+
+@benchmark
+def bench_highlight_pool():
+    ENTRY_COUNT = 100
+    LINE = 'lorem = ipsum("dolor", sit, amet) + 42  # consectetur\n'
+    HIGHLIGHT_THREADS = 2
+    REQUEST_COUNT = 50
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        tree_populate(fs_root, files=ENTRY_COUNT)
+        fs_root.joinpath('lorem.py').write_text(
+            LINE * (webls.HIGHLIGHT_MAX_SIZE // len(LINE))
+        )
+
+        for processes in [0, webls.HIGHLIGHT_PROCESSES]:
+            app = app_build(
+                fs_root,
+                search_interval=0,
+                highlight_cache_size=0,
+                highlight_processes=processes,
+            )
+            is_done = threading.Event()
+
+            def highlight_loop():
+                while not is_done.is_set():
+                    wsgi_get(app, '/fs/lorem.py')
+
+            threads = [
+                threading.Thread(target=highlight_loop)
+                for _ in range(HIGHLIGHT_THREADS)
+            ]
+            for thread in threads:
+                thread.start()
+
+            timings = []
+            for _ in range(REQUEST_COUNT):
+                started_at = time.perf_counter()
+                wsgi_get(app, '/fs/')
+                timings.append(time.perf_counter() - started_at)
+
+            is_done.set()
+            for thread in threads:
+                thread.join()
+            if app.highlight_pool is not None:
+                app.highlight_pool.shutdown()
+
+            timings.sort()
+            print(
+                f'{processes:>2} processes: listing while highlighting,'
+                f' median {timings[len(timings) // 2] * 1000:.1f}ms,'
+                f' max {timings[-1] * 1000:.1f}ms'
+            )
+
+
+@benchmark
+def bench_admission():
+    LINE = 'lorem = ipsum("dolor", sit, amet) + 42  # consectetur\n'
+    HEAVY_THREADS = 4
+    REQUEST_COUNT = 50
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        tree_populate(fs_root, files=100)
+        fs_root.joinpath('lorem.py').write_text(
+            LINE * (webls.HIGHLIGHT_MAX_SIZE // len(LINE))
+        )
+
+        for heavy_limit in [0, 1]:
+            app = app_build(
+                fs_root,
+                search_interval=0,
+                highlight_cache_size=0,
+                highlight_processes=0,
+                heavy_limit=heavy_limit,
+                heavy_queue=0,
+            )
+            is_done = threading.Event()
+
+            def heavy_loop():
+                while not is_done.is_set():
+                    wsgi_get(app, '/fs/lorem.py')
+                    # clients turned away come back a little later
+                    time.sleep(0.01)
+
+            threads = [
+                threading.Thread(target=heavy_loop)
+                for _ in range(HEAVY_THREADS)
+            ]
+            for thread in threads:
+                thread.start()
+
+            timings = []
+            for _ in range(REQUEST_COUNT):
+                started_at = time.perf_counter()
+                wsgi_get(app, '/fs/')
+                timings.append(time.perf_counter() - started_at)
+
+            is_done.set()
+            for thread in threads:
+                thread.join()
+
+            stats = webls.app_metrics(app).get('admission', {}).get('heavy')
+            rejected = stats['rejected'] if stats else 0
+            timings.sort()
+            median = timings[len(timings) // 2]
+            print(
+                f'heavy_limit={heavy_limit}: listing under {HEAVY_THREADS}'
+                f' heavy clients, median {median * 1000:.1f}ms,'
+                f' max {timings[-1] * 1000:.1f}ms, {rejected} heavy rejected'
+            )
+
+
+@benchmark
+def bench_api():
+    ENTRY_COUNT = webls.DIR_PAGE_SIZE_MAX
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        tree_populate(fs_root, files=ENTRY_COUNT)
+        app = app_build(fs_root, search_interval=0)
+
+        for name, query in [
+            ('html', f'limit={ENTRY_COUNT}'),
+            ('json', f'limit={ENTRY_COUNT}&format=json'),
+            ('ndjson', 'format=ndjson'),
+        ]:
+            timings = []
+            for _ in range(3):
+                started_at = time.perf_counter()
+                first_at, size = wsgi_get(app, '/fs/', query)
+                ended_at = time.perf_counter()
+                timings.append((first_at - started_at, ended_at - started_at))
+            first, total = min(timings)
+
+            print(
+                f'{name:>8}: {ENTRY_COUNT} entries, {size >> 10} KiB,'
+                f' first byte {first * 1000:.1f}ms,'
+                f' total {total * 1000:.1f}ms'
+            )
+
+
+@benchmark
+def bench_compress():
+    REQUESTS = 20
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        tree_populate(fs_root, files=webls.DIR_PAGE_SIZE)
+        # source code, rather than a line repeated, compresses as usual
+        fs_root.joinpath('lorem.py').write_bytes(
+            Path(webls.__file__).read_bytes(),
+        )
+        os.utime(fs_root.joinpath('lorem.py'), (0, 0))
+        app = app_build(fs_root, search_interval=0)
+        client = Client(app)
+
+        for url in [
+            '/fs/',
+            '/fs/?format=json',
+            '/fs/lorem.py',
+            '/dl/lorem.py',
+        ]:
+            body = client.get(url).data
+            compress_elapsed = timeit(
+                lambda: b''.join(webls.compress_chunks([body], 'gzip', 6)),
+                repeat=3,
+            )
+
+            results = []
+            for headers in [{}, {'Accept-Encoding': 'gzip'}]:
+                size = len(client.get(url, headers=headers).data)
+                elapsed = timeit(
+                    lambda: [
+                        client.get(url, headers=headers).close()
+                        for _ in range(REQUESTS)
+                    ],
+                    repeat=3,
+                )
+                results.append((size, elapsed / REQUESTS))
+
+            (size, elapsed), (gzip_size, gzip_elapsed) = results
+            print(
+                f'{url:>17}: {size >> 10} KiB -> {gzip_size >> 10} KiB'
+                f' ({size / gzip_size:.1f}x),'
+                f' compress {compress_elapsed * 1000:.2f}ms,'
+                f' request {elapsed * 1000:.2f}ms'
+                f' -> {gzip_elapsed * 1000:.2f}ms gzip'
+            )
+
+
+@benchmark
+def bench_server_scaling():
+    CLIENTS = 16
+    DURATION = 3
+    PATHS = ['/fs/lorem.txt', '/fs/nested/']
+
+    cpu_count = os.cpu_count()
+    configs = sorted({(1, 1), (1, 4), (cpu_count, 1), (cpu_count, 4)})
+
+    print(f'{cpu_count} cpus, {CLIENTS} client processes')
+    for workers, threads in configs:
+        process, port = server_start(
+            '--workers', str(workers),
+            '--threads', str(threads),
+        )
+        try:
+            for path in PATHS:
+                rate = load_run(
+                    port,
+                    path,
+                    clients=CLIENTS,
+                    duration=DURATION,
+                )
+                print(
+                    f'workers={workers} threads={threads}'
+                    f' {path}: {rate:.0f} req/s'
+                )
+        finally:
+            process.terminate()
+            process.wait()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def download_server_run(fs_root, server_kind, port_queue):
+    app = app_build(fs_root)
+
+    @app.route('/static-file/<path:path>')
+    def handler(path):
+        # the `/dl/` handler before `file_download`
+        return bottle.static_file(
+            path,
+            root=app.fs_root,
+            mimetype='application/octet-stream',
+        )
+
+    if server_kind == 'wsgiref':
+        server = make_server(
+            '127.0.0.1',
+            0,
+            app,
+            handler_class=QuietRequestHandler,
+        )
+    else:
+        server = webls.PoolWSGIServer(
+            ('127.0.0.1', 0),
+            threads=1,
+            reuse_port=False,
+            quiet=True,
+        )
+        server.set_app(app)
+
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def download_rate(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    started_at = time.perf_counter()
+    connection.request('GET', path)
+    response = connection.getresponse()
+
+    size = 0
+    while data := response.read(1 << 20):
+        size += len(data)
+    connection.close()
+
+    return size / (time.perf_counter() - started_at) / (1 << 20)
+
+
+@benchmark
+def bench_download():
+    FILE_SIZE = 512 << 20
+
+    cases = [
+        ('static_file, wsgiref', 'wsgiref', '/static-file/file.bin'),
+        ('file_download, wsgiref', 'wsgiref', '/dl/file.bin'),
+        ('file_download, sendfile', 'pool', '/dl/file.bin'),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(Path(tmp_dir, 'file.bin'), 'wb') as file:
+            for _ in range(FILE_SIZE >> 20):
+                file.write(os.urandom(1 << 20))
+
+        for name, server_kind, path in cases:
+            port_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=download_server_run,
+                args=(tmp_dir, server_kind, port_queue),
+            )
+            process.start()
+            try:
+                port = port_queue.get()
+                rate = max(download_rate(port, path) for _ in range(3))
+                print(f'{name:>24}: {rate:.0f} MiB/s')
+            finally:
+                process.terminate()
+                process.join()
+
+
+@benchmark
+def bench_archive():
+    FILE_COUNT = 64
+    FILE_SIZE = 4 << 20
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = Path(tmp_dir)
+        for idx in range(FILE_COUNT):
+            fs_root.joinpath(f'file-{idx:06d}.bin').write_bytes(
+                os.urandom(FILE_SIZE // 2) + bytes(FILE_SIZE // 2),
+            )
+        total_size = FILE_COUNT * FILE_SIZE
+
+        def raw_read():
+            for path in fs_root.iterdir():
+                for _ in webls.archive_file_chunks(path, FILE_SIZE):
+                    pass
+
+        def archive_read(archive_format):
+            members = webls.archive_members(
+                fs_root,
+                fs_root,
+                webls.CheckPath(fs_root=fs_root).is_forbidden,
+                'root',
+            )
+            if archive_format == 'zip':
+                chunks = webls.archive_zip(members)
+            elif archive_format == 'tar':
+                chunks = webls.archive_tar(members)
+            else:
+                chunks = webls.archive_gzip(webls.archive_tar(members))
+
+            for _ in chunks:
+                pass
+
+        cases = [
+            ('raw read', raw_read),
+            ('tar', lambda: archive_read('tar')),
+            ('tar.gz', lambda: archive_read('tar.gz')),
+            ('zip', lambda: archive_read('zip')),
+        ]
+        for name, func in cases:
+            elapsed = timeit(func, repeat=3)
+            tracemalloc.start()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(
+                f'{name:>8}: {total_size / elapsed / (1 << 20):.0f} MiB/s,'
+                f' peak {peak / (1 << 20):.1f} MiB'
+            )
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+
+    for name in names:
+        print(f'# {name}')
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,37 @@
+import collections
+import gzip
 import html5lib
+import io
+import json
 import os
+import re
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
 import webls
-
+import zipfile
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import find_lexer_class_for_filename
+from pygments.lexers._mapping import LEXERS
+from pygments.lexers.python import PythonLexer
+from pygments.lexers.special import TextLexer
 from pathlib import Path
+from unittest import mock
+from urllib.parse import unquote
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 from werkzeug.test import Client
 
 
@@ -11,29 +39,63 @@ class TestWebls(unittest.TestCase):
     maxDiff = None
 
     def setUp(self):
+        self.app_build(fs_root=Path('storage').absolute())
+
+        self.response = None
+        self.body = None
+
+    def app_build(self, **kwargs):
         self.app = webls.app_build(
             development=False,
             root=Path('.').absolute(),
-            fs_root=Path('storage').absolute(),
+            **{
+                'metrics': True,
+                'search_interval': 60,
+                'grep_processes': 2,
+                **kwargs,
+            },
         )
+        if self.app.highlight_pool is not None:
+            self.addCleanup(self.app.highlight_pool.shutdown)
         self.client = Client(self.app)
 
-        self.response = None
-        self.body = None
+    def tmp_fs_root(self, **kwargs):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.app_build(fs_root=Path(tmp_dir.name), **kwargs)
+
+        return self.app.fs_root
+
+    def write_file(self, path, content, age=60):
+        mtime = time.time() - age
+
+        path.write_text(content)
+        os.utime(path, (mtime, mtime))
 
     def parse_body(self, response):
-        if response.mimetype == 'text/html':
+        if not response.data:
+            return None
+        elif 'Content-Encoding' in response.headers:
+            return response.data
+        elif response.mimetype == 'text/html':
             return html5lib.parse(
                 response.text,
                 namespaceHTMLElements=False,
             )
+        elif response.mimetype == 'application/json':
+            return response.json
         else:
-            raise NotImplementedError(response.mimetype)
+            return response.data
 
-    def get(self, path):
-        self.response = self.client.get(path)
+    def get(self, path, **kwargs):
+        self.response = self.client.get(path, **kwargs)
         self.body = self.parse_body(self.response)
 
+    def assert_header(self, name, value):
+        actual_value = self.response.headers.get(name)
+
+        self.assertEqual(value, actual_value)
+
     def assert_status_code(self, status_code):
         actual_status_code = self.response.status_code
 
@@ -105,6 +167,38 @@ class TestWebls(unittest.TestCase):
 
         self.assertEqual(list(entries), actual_entries)
 
+    def assert_entry_names(self, *names):
+        actual_names = [
+            a.text
+            for a in self.body.findall('.//td[@class="entry-name"]/a')
+        ]
+
+        self.assertEqual(list(names), actual_names)
+
+    def assert_entries_size(self, name, size_title):
+        for tr in self.body.findall('.//tr[@class="entry"]'):
+            if tr.find('./td[@class="entry-name"]/a').text == name:
+                td_size = tr.find('./td[@class="entry-size xs-hide"]')
+                self.assertEqual(size_title, td_size.get('title'))
+                return
+
+        self.fail(f'no entry named {name}')
+
+    def assert_pager(self, prev_url, text, next_url):
+        pager = self.body.find('.//div[@class="pager"]')
+        actual_prev = pager.find('./a[@class="pager-prev"]')
+        actual_next = pager.find('./a[@class="pager-next"]')
+        actual_text = pager.find('./span[@class="pager-range"]').text.strip()
+
+        self.assertEqual(
+            (prev_url, text, next_url),
+            (
+                None if actual_prev is None else actual_prev.get('href'),
+                actual_text,
+                None if actual_next is None else actual_next.get('href'),
+            ),
+        )
+
     def assert_message(self, klass, message, path=None, url=None, url_text=None):
         main = self.body.find(f'.//main[@class="{klass}"]')
         actual_message = main.find('./div[@class="message"]').text.strip()
@@ -473,6 +567,703 @@ class TestWebls(unittest.TestCase):
             }
         )
 
+    def test_fs_nested_dir_entries_no_pager(self):
+        self.get('/fs/nested/')
+
+        self.assertIsNone(self.body.find('.//div[@class="pager"]'))
+
+    def test_fs_directory_pages(self):
+        fs_root = self.tmp_fs_root()
+        for idx in range(5):
+            fs_root.joinpath(f'file-{idx}.txt').touch()
+        for idx in range(2):
+            fs_root.joinpath(f'dir-{idx}').mkdir()
+
+        self.get('/fs/?limit=3')
+        self.assert_status_code(200)
+        self.assert_entry_names('dir-0/', 'dir-1/', 'file-0.txt')
+        self.assert_pager(None, '1-3 of 7', '?offset=3&limit=3')
+
+        self.get('/fs/?offset=3&limit=3')
+        self.assert_entry_names('file-1.txt', 'file-2.txt', 'file-3.txt')
+        self.assert_pager('?offset=0&limit=3', '4-6 of 7', '?offset=6&limit=3')
+
+        self.get('/fs/?offset=6&limit=3')
+        self.assert_entry_names('file-4.txt')
+        self.assert_pager('?offset=3&limit=3', '7-7 of 7', None)
+
+    def test_fs_directory_pages_past_end(self):
+        fs_root = self.tmp_fs_root()
+        for idx in range(7):
+            fs_root.joinpath(f'file-{idx}.txt').touch()
+        fs_root.joinpath('empty').mkdir()
+
+        self.get('/fs/?offset=1000&limit=3')
+        self.assert_status_code(200)
+        self.assert_entry_names('file-5.txt', 'file-6.txt')
+        self.assert_pager('?offset=3&limit=3', '7-8 of 8', None)
+
+        self.get('/fs/?offset=8&limit=4&format=json')
+        self.assertEqual(4, self.body['offset'])
+        self.assertEqual(4, len(self.body['entries']))
+
+        self.get('/fs/empty/?offset=10')
+        self.assert_status_code(200)
+        self.assert_entry_names()
+        self.assertIsNone(self.body.find('.//div[@class="pager"]'))
+
+    def test_fs_directory_streamed(self):
+        fs_root = self.tmp_fs_root()
+        for idx in range(5):
+            fs_root.joinpath(f'file-{idx}.txt').touch()
+
+        with (
+            mock.patch.object(webls, 'DIR_ROWS_CHUNK', 2),
+            mock.patch.object(
+                webls,
+                'dir_read_page',
+                wraps=webls.dir_read_page,
+            ) as dir_read_page,
+        ):
+            response = self.client.get('/fs/', buffered=False)
+            body = iter(response.response)
+            # the head goes out before the directory is read
+            chunks = [next(body)]
+            dir_read_page.assert_not_called()
+            chunks.extend(body)
+            response.close()
+
+        # the head, the start of the table, three chunks of rows and the
+        # tail
+        self.assertEqual(6, len(chunks))
+        self.assertIn(b'<nav>', chunks[0])
+        self.assertNotIn(b'<table', chunks[0])
+        self.assertIn(b'<table', chunks[1])
+        self.assertNotIn(b'<tr class="entry">', chunks[1])
+        self.assertEqual(
+            [2, 2, 1],
+            [chunk.count(b'<tr class="entry">') for chunk in chunks[2:5]],
+        )
+        self.assertIn(b'</html>', chunks[5])
+
+        self.get('/fs/')
+        self.assertEqual(b''.join(chunks), self.response.data)
+        self.assert_entry_names(*(f'file-{idx}.txt' for idx in range(5)))
+
+    def test_fs_directory_pages_invalid_query(self):
+        self.get('/fs/nested/?offset=-5&limit=abc')
+
+        self.assert_status_code(200)
+        self.assert_entry_names('level-1/', 'file.txt')
+
+    def test_fs_directory_cache(self):
+        fs_root = self.tmp_fs_root(dir_cache_size=1 << 20)
+        fs_root.joinpath('dir').mkdir()
+        fs_root.joinpath('dir/one.txt').touch()
+
+        self.get('/fs/dir/')
+        self.get('/fs/dir/')
+        self.assert_entry_names('one.txt')
+
+        fs_root.joinpath('dir/two.txt').touch()
+        self.get('/fs/dir/')
+        self.assert_entry_names('one.txt', 'two.txt')
+
+        fs_root.joinpath('dir/one.txt').write_text('changed')
+        self.get('/fs/dir/')
+        self.assert_entries_size('one.txt', '7 bytes')
+
+        self.get('/metrics')
+        self.assertEqual(1, self.body['dir_cache']['hits'])
+        self.assertEqual(3, self.body['dir_cache']['misses'])
+        self.assertEqual(2, self.body['dir_cache']['invalidations'])
+        self.assertEqual(1, self.body['dir_cache']['watches'])
+        self.assertEqual(0, self.body['dir_cache']['mtime_checked_dirs'])
+
+    def test_fs_directory_cache_mtime_fallback(self):
+        fs_root = self.tmp_fs_root()
+        self.app.dir_cache = webls.DirCache(
+            max_bytes=1 << 20,
+            use_inotify=False,
+        )
+        fs_root.joinpath('one.txt').touch()
+
+        self.get('/fs/')
+        self.get('/fs/')
+        self.assert_entry_names('one.txt')
+
+        fs_root.joinpath('two.txt').touch()
+        self.get('/fs/')
+        self.assert_entry_names('one.txt', 'two.txt')
+
+        self.get('/metrics')
+        self.assertEqual(1, self.body['dir_cache']['hits'])
+        self.assertEqual(2, self.body['dir_cache']['misses'])
+        self.assertEqual(0, self.body['dir_cache']['watches'])
+        self.assertEqual(1, self.body['dir_cache']['mtime_checked_dirs'])
+
+    def test_fs_directory_cache_evicts(self):
+        fs_root = self.tmp_fs_root(dir_cache_size=1 << 20)
+        for name in ['a', 'b', 'c']:
+            fs_root.joinpath(name).mkdir()
+            fs_root.joinpath(name, 'file.txt').touch()
+        self.app.dir_cache.max_bytes = 3000
+        self.app.dir_cache.reset()
+
+        for name in ['a', 'b', 'c']:
+            self.get(f'/fs/{name}/')
+
+        stats = self.app.dir_cache.stats()
+        self.assertLess(stats['entries'], 3)
+        self.assertGreater(stats['evictions'], 0)
+        self.assertEqual(stats['entries'], stats['watches'])
+
+    def test_fs_directory_cache_evicts_sibling_page(self):
+        fs_root = self.tmp_fs_root(dir_cache_size=1 << 20)
+        for name in ['b.txt', 'c.txt']:
+            fs_root.joinpath(name).touch()
+        self.get('/fs/?limit=1')
+        page_size = self.app.dir_cache.stats()['size_bytes']
+        self.app.dir_cache.max_bytes = page_size * 3 // 2
+        self.app.dir_cache.reset()
+
+        # the second page evicts the first one of the same directory
+        self.get('/fs/?limit=1')
+        self.get('/fs/?offset=1&limit=1')
+        self.assert_status_code(200)
+        self.assert_entry_names('c.txt')
+        stats = self.app.dir_cache.stats()
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(1, stats['watches'])
+
+        fs_root.joinpath('a.txt').touch()
+        self.get('/fs/?offset=1&limit=1')
+        self.assert_entry_names('b.txt')
+
+    def test_dir_scan_window(self):
+        scanned = [(key * 37 % 101, None) for key in range(101)]
+
+        for offset in [0, 1, 5, 40, 90, 96, 100, 101, 150]:
+            for limit in [1, 5, 12, 200]:
+                self.assertEqual(
+                    sorted(scanned)[offset:offset + limit],
+                    webls.dir_scan_window(scanned, offset, limit),
+                )
+
+    def assert_dir_sizes(self, dir_size, **dir_sizes):
+        actual_dir_size = ' '.join(
+            self.body.find('.//p[@class="dir-size"]').text.split()
+        )
+        actual_dir_sizes = {}
+        for tr in self.body.findall('.//tr[@class="entry"]'):
+            name = tr.find('./td[@class="entry-name"]/a').text
+            td_total = tr.find('./td[@class="entry-total xs-hide"]')
+            if td_total.get('title'):
+                actual_dir_sizes[name] = td_total.get('title')
+
+        self.assertEqual(dir_size, actual_dir_size)
+        self.assertEqual(dir_sizes, actual_dir_sizes)
+
+    def test_fs_directory_sizes(self):
+        fs_root = self.tmp_fs_root(dir_sizes_interval=60)
+        fs_root.joinpath('one', 'two').mkdir(parents=True)
+        fs_root.joinpath('empty').mkdir()
+        fs_root.joinpath('top.txt').write_bytes(b'x' * 1000)
+        fs_root.joinpath('one', 'a.txt').write_bytes(b'x' * 100)
+        fs_root.joinpath('one', 'two', 'b.txt').write_bytes(b'x' * 10)
+        fs_root.joinpath('one', 'link').symlink_to('a.txt')
+
+        with mock.patch.object(self.app.dir_sizes, 'ensure_started'):
+            self.get('/fs/')
+            self.assert_dir_sizes('total sizes are being computed')
+
+            self.app.dir_sizes.crawl()
+            self.get('/fs/')
+
+        self.assert_dir_sizes(
+            'total 1.1K in 4 files, as of 0s ago',
+            **{
+                'empty/': '0 bytes in 0 files, as of 0s ago',
+                'one/': '115 bytes in 3 files, as of 0s ago',
+            },
+        )
+
+    def test_dir_sizes_incremental(self):
+        fs_root = self.tmp_fs_root(dir_sizes_interval=60)
+        fs_root.joinpath('one').mkdir()
+        fs_root.joinpath('two').mkdir()
+        fs_root.joinpath('one', 'a.txt').write_bytes(b'x' * 10)
+        self.dirs_age(fs_root, fs_root / 'one', fs_root / 'two')
+
+        dir_sizes = self.app.dir_sizes
+        dir_sizes.crawl()
+        self.assertEqual(3, dir_sizes.stats()['scanned_dirs'])
+
+        dir_sizes.crawl()
+        self.assertEqual(3, dir_sizes.stats()['scanned_dirs'])
+
+        fs_root.joinpath('two', 'b.txt').write_bytes(b'x' * 20)
+        self.dirs_age(fs_root / 'two', age=30)
+        dir_sizes.crawl()
+        self.assertEqual(4, dir_sizes.stats()['scanned_dirs'])
+        self.assertEqual((30, 2), dir_sizes.get('')[:2])
+
+        # a file changing size leaves its directory unchanged, and is
+        # only seen once the directory is older than `max_age`
+        fs_root.joinpath('one', 'a.txt').write_bytes(b'x' * 40)
+        dir_sizes.crawl()
+        self.assertEqual((30, 2), dir_sizes.get('')[:2])
+
+        dir_sizes.max_age = 0
+        dir_sizes.crawl()
+        self.assertEqual((60, 2), dir_sizes.get('')[:2])
+        self.assertEqual((40, 1), dir_sizes.get('one/')[:2])
+
+    def api_tree(self):
+        fs_root = self.tmp_fs_root()
+        fs_root.joinpath('dir').mkdir()
+        self.write_file(fs_root.joinpath('dir', 'a.txt'), 'one\n')
+        fs_root.joinpath('link').symlink_to('dir')
+        fs_root.joinpath('broken').symlink_to('missing')
+        os.mkfifo(fs_root.joinpath('fifo'))
+
+        return fs_root
+
+    def filemode(self, path):
+        return stat.filemode(path.lstat().st_mode)
+
+    def test_api_dir_json(self):
+        fs_root = self.api_tree()
+
+        self.get('/fs/?format=json')
+
+        self.assert_status_code(200)
+        self.assert_header('Content-Type', 'application/json')
+        self.assert_header('Vary', 'Accept')
+        self.assertEqual(
+            {
+                'path': './',
+                'offset': 0,
+                'limit': webls.DIR_PAGE_SIZE,
+                'total': 4,
+                'entries': [
+                    {
+                        'name': 'dir',
+                        'type': 'dir',
+                        'mode': self.filemode(fs_root.joinpath('dir')),
+                        'size': fs_root.joinpath('dir').lstat().st_size,
+                        'is_dir': True,
+                        'symlink_path': None,
+                        'is_symlink_broken': False,
+                        'url': '/fs/dir/',
+                        'dl_url': '/dl/dir',
+                    },
+                    {
+                        'name': 'link',
+                        'type': 'symlink',
+                        'mode': 'lrwxrwxrwx',
+                        'size': 3,
+                        'is_dir': True,
+                        'symlink_path': 'dir',
+                        'is_symlink_broken': False,
+                        'url': '/fs/link/',
+                        'dl_url': '/dl/link',
+                    },
+                    {
+                        'name': 'broken',
+                        'type': 'symlink',
+                        'mode': 'lrwxrwxrwx',
+                        'size': 7,
+                        'is_dir': False,
+                        'symlink_path': 'missing',
+                        'is_symlink_broken': True,
+                        'url': '/fs/broken',
+                        'dl_url': '/dl/broken',
+                    },
+                    {
+                        'name': 'fifo',
+                        'type': 'fifo',
+                        'mode': self.filemode(fs_root.joinpath('fifo')),
+                        'size': 0,
+                        'is_dir': False,
+                        'symlink_path': None,
+                        'is_symlink_broken': False,
+                        'url': '/fs/fifo',
+                        'dl_url': '/dl/fifo',
+                    },
+                ],
+            },
+            self.body,
+        )
+        listing = self.body
+
+        self.get('/fs/', headers={'Accept': 'application/json'})
+        self.assertEqual(listing, self.body)
+
+        self.get('/fs/?format=json&offset=1&limit=2')
+        self.assertEqual(
+            ['link', 'broken'],
+            [entry['name'] for entry in self.body['entries']],
+        )
+        self.assertEqual(4, self.body['total'])
+
+        self.get('/fs/', headers={'Accept': 'text/html'})
+        self.assert_header('Content-Type', 'text/html; charset=UTF-8')
+
+        self.get('/fs/?format=xml')
+        self.assert_status_code(400)
+
+    def test_api_dir_ndjson(self):
+        fs_root = self.tmp_fs_root()
+        for idx in range(5):
+            fs_root.joinpath(f'file-{idx}.txt').touch()
+
+        self.get('/fs/?format=json')
+        listing = self.body
+
+        with mock.patch.object(webls, 'DIR_ROWS_CHUNK', 2):
+            response = self.client.get(
+                '/fs/',
+                headers={'Accept': 'application/x-ndjson'},
+                buffered=False,
+            )
+            chunks = list(response.response)
+            response.close()
+
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        self.assertEqual(
+            [2, 2, 1],
+            [chunk.count(b'\n') for chunk in chunks],
+        )
+
+        # in the order they are read
+        entries = [json.loads(line) for line in b''.join(chunks).splitlines()]
+        entries.sort(key=lambda entry: entry['name'])
+        self.assertEqual(listing['entries'], entries)
+
+    def test_api_file(self):
+        fs_root = self.api_tree()
+        fs_root.joinpath('a-link').symlink_to('dir/a.txt')
+
+        self.get('/fs/dir/a.txt?format=json')
+
+        self.assert_status_code(200)
+        self.assertEqual(
+            {
+                'name': 'a.txt',
+                'type': 'file',
+                'mode': self.filemode(fs_root.joinpath('dir', 'a.txt')),
+                'size': 4,
+                'is_dir': False,
+                'symlink_path': None,
+                'is_symlink_broken': False,
+                'url': '/fs/dir/a.txt',
+                'dl_url': '/dl/dir/a.txt',
+            },
+            self.body,
+        )
+
+        self.get('/fs/link/a.txt', headers={'Accept': 'application/json'})
+        self.assertEqual('/fs/link/a.txt', self.body['url'])
+        etag = self.response.headers['ETag']
+
+        self.get('/fs/link/a.txt', headers={'If-None-Match': etag})
+        self.assert_status_code(200)
+        self.get(
+            '/fs/link/a.txt',
+            headers={'Accept': 'application/json', 'If-None-Match': etag},
+        )
+        self.assert_status_code(304)
+        self.assert_header('Vary', 'Accept')
+
+        self.get('/fs/a-link?format=ndjson')
+        self.assertEqual(b'\n', self.response.data[-1:])
+        self.assertEqual(
+            {'name': 'a-link', 'type': 'symlink', 'symlink_path': 'dir/a.txt'},
+            {
+                key: value
+                for key, value in json.loads(self.response.data).items()
+                if key in ['name', 'type', 'symlink_path']
+            },
+        )
+
+    def test_age_pretty(self):
+        for seconds, text in [
+            (-1, '0s'),
+            (59, '59s'),
+            (60, '1m'),
+            (3599, '59m'),
+            (7200, '2h'),
+            (86400 * 3, '3d'),
+        ]:
+            with self.subTest(seconds=seconds):
+                self.assertEqual(text, webls.age_pretty(seconds))
+
+    def assert_search_results(self, *results):
+        actual_results = [
+            (
+                tr.find('./td[@class="entry-name"]/a').get('href'),
+                tr.find('./td[@class="entry-dir xs-hide"]/a').text,
+            )
+            for tr in self.body.findall('.//tr[@class="result"]')
+        ]
+
+        self.assertEqual(list(results), actual_results)
+
+    def assert_search_status(self, status):
+        actual_status = self.body.find('.//p[@class="search-status"]').text
+
+        self.assertEqual(status, actual_status)
+
+    def dirs_age(self, *paths, age=60):
+        mtime = time.time() - age
+
+        for path in paths:
+            os.utime(path, (mtime, mtime))
+
+    def test_search(self):
+        self.app.search_index.crawl()
+        self.get('/search?q=FILE')
+
+        self.assert_status_code(200)
+        self.assert_title('webls: search ./')
+        self.assert_search_status('3 matches')
+        self.assert_search_results(
+            ('/fs/nested/file.txt', './nested/'),
+            ('/fs/nested/level-1/file.txt', './nested/level-1/'),
+            (
+                '/fs/nested/level-1/level-2/file.txt',
+                './nested/level-1/level-2/',
+            ),
+        )
+
+    def test_search_directories(self):
+        self.app.search_index.crawl()
+        self.get('/search?q=level-')
+
+        self.assert_search_results(
+            ('/fs/nested/level-1/', './nested/'),
+            ('/fs/nested/level-1/level-2/', './nested/level-1/'),
+        )
+
+    def test_search_path(self):
+        self.app.search_index.crawl()
+        self.get('/search?q=file&path=nested/level-1/')
+
+        self.assert_title('webls: search ./nested/level-1/')
+        self.assert_search_results(
+            ('/fs/nested/level-1/file.txt', './nested/level-1/'),
+            (
+                '/fs/nested/level-1/level-2/file.txt',
+                './nested/level-1/level-2/',
+            ),
+        )
+
+    def test_search_limit(self):
+        self.app.search_index.crawl()
+        self.get('/search?q=file&limit=2')
+
+        self.assert_search_status('first 2 matches')
+        self.assertEqual(2, len(self.body.findall('.//tr[@class="result"]')))
+
+    def test_search_not_indexed(self):
+        with mock.patch.object(self.app.search_index, 'ensure_started'):
+            self.get('/search?q=file')
+
+        self.assert_status_code(200)
+        self.assert_search_status('index is being built')
+
+    def test_search_disabled(self):
+        self.app_build(fs_root=Path('storage').absolute(), search_interval=0)
+        self.get('/search?q=file')
+
+        self.assert_status_code(404)
+        self.get('/fs/')
+        self.assertIsNone(self.body.find('.//form[@class="search"]'))
+
+    def test_search_and_grep_off_by_default(self):
+        app = webls.app_build(
+            development=False,
+            root=Path('.').absolute(),
+            fs_root=self.app.fs_root,
+        )
+
+        self.assertIsNone(app.search_index)
+        self.assertIsNone(app.grep_pool)
+        for url in ['/search?q=file', '/grep?q=lorem']:
+            with self.subTest(url=url):
+                self.assertEqual(404, Client(app).get(url).status_code)
+
+    def test_fs_directory_search_form(self):
+        self.get('/fs/nested/')
+
+        form = self.body.find('.//form[@class="search"]')
+        self.assertEqual('/search', form.get('action'))
+        self.assertEqual(
+            'nested/',
+            form.find('./input[@name="path"]').get('value'),
+        )
+
+    def test_search_index_incremental(self):
+        fs_root = self.tmp_fs_root()
+        fs_root.joinpath('one').mkdir()
+        fs_root.joinpath('two').mkdir()
+        fs_root.joinpath('one', 'a.txt').touch()
+        self.dirs_age(fs_root, fs_root / 'one', fs_root / 'two')
+
+        search_index = self.app.search_index
+        search_index.crawl()
+        snapshot = search_index.snapshot
+
+        with mock.patch.object(
+            search_index,
+            'dir_block',
+            wraps=search_index.dir_block,
+        ) as dir_block:
+            search_index.crawl()
+            self.assertEqual(0, dir_block.call_count)
+            self.assertIs(snapshot, search_index.snapshot)
+
+            fs_root.joinpath('two', 'b.txt').touch()
+            self.dirs_age(fs_root / 'two', age=30)
+            search_index.crawl()
+            dir_block.assert_called_once_with(os.path.join(fs_root, 'two/'))
+
+        self.assertEqual(
+            ([('two/', 'b.txt')], False),
+            search_index.search('B.TXT', limit=10),
+        )
+
+        fs_root.joinpath('one', 'a.txt').unlink()
+        fs_root.joinpath('one').rmdir()
+        search_index.crawl()
+        self.assertEqual(['', 'two/'], search_index.snapshot.keys)
+        self.assertEqual(([], False), search_index.search('a.txt', limit=10))
+
+    def test_search_index_case_folding(self):
+        fs_root = self.tmp_fs_root()
+        for name in ['\u0130stanbul.txt', 'ABC.txt', 'abc.md']:
+            fs_root.joinpath(name).touch()
+
+        search_index = self.app.search_index
+        search_index.crawl()
+
+        self.assertEqual(
+            ([('', 'ABC.txt'), ('', 'abc.md')], False),
+            search_index.search('abc', limit=10),
+        )
+        self.assertEqual(
+            ([('', '\u0130stanbul.txt')], False),
+            search_index.search('stanbul', limit=10),
+        )
+
+    def grep(self, path):
+        self.addCleanup(self.app.grep_pool.shutdown)
+        self.get(path)
+
+        self.assert_header('Content-Type', 'application/x-ndjson')
+        *hits, summary = [
+            json.loads(line)
+            for line in self.response.text.splitlines()
+        ]
+
+        return hits, summary
+
+    def grep_tree(self, **kwargs):
+        fs_root = self.tmp_fs_root(**kwargs)
+        fs_root.joinpath('sub').mkdir()
+        fs_root.joinpath('a.txt').write_text(
+            'one\nneedle here\nthree\nand a needle'
+        )
+        fs_root.joinpath('sub', 'b.log').write_text('needle\n')
+        fs_root.joinpath('sub', 'binary.txt').write_bytes(b'\0needle\n')
+        fs_root.joinpath('image.jpg').write_bytes(b'needle\n')
+
+        return fs_root
+
+    def test_grep(self):
+        self.grep_tree()
+        hits, summary = self.grep('/grep?q=needle')
+
+        self.assert_status_code(200)
+        self.assertEqual(
+            [
+                ('./a.txt', '/fs/a.txt', 2, 'needle here'),
+                ('./a.txt', '/fs/a.txt', 4, 'and a needle'),
+                ('./sub/b.log', '/fs/sub/b.log', 1, 'needle'),
+            ],
+            sorted(
+                (hit['path'], hit['url'], hit['line'], hit['text'])
+                for hit in hits
+            ),
+        )
+        self.assertEqual(3, summary['files'])
+        self.assertEqual(3, summary['hits'])
+        self.assertIsNone(summary['truncated'])
+
+    def test_grep_pool_worker_killed(self):
+        self.grep_tree()
+        self.grep('/grep?q=needle')
+
+        self.pool_kill(self.app.grep_pool)
+        hits, summary = self.grep('/grep?q=needle')
+
+        self.assertEqual(3, summary['hits'])
+        self.assertIsNone(summary['truncated'])
+
+    def test_grep_path(self):
+        self.grep_tree()
+        hits, summary = self.grep('/grep?q=needle&path=sub')
+
+        self.assertEqual(['./sub/b.log'], [hit['path'] for hit in hits])
+        self.assertEqual(2, summary['files'])
+
+    def test_grep_limit(self):
+        self.grep_tree()
+        hits, summary = self.grep('/grep?q=needle&limit=1')
+
+        self.assertEqual(1, len(hits))
+        self.assertEqual('hits', summary['truncated'])
+
+    def test_grep_byte_budget(self):
+        self.grep_tree(grep_bytes=4)
+        hits, summary = self.grep('/grep?q=needle')
+
+        self.assertEqual([], hits)
+        self.assertEqual(4, summary['bytes'])
+        self.assertEqual('bytes', summary['truncated'])
+
+    def test_grep_time_budget(self):
+        self.grep_tree(grep_time=0)
+        hits, summary = self.grep('/grep?q=needle')
+
+        self.assertEqual([], hits)
+        self.assertEqual('time', summary['truncated'])
+
+    def test_grep_invalid_request(self):
+        for path, status_code in [
+            ('/grep?q=', 400),
+            ('/grep?q=x&path=../', 403),
+            ('/grep?q=x&path=inexisting', 404),
+        ]:
+            with self.subTest(path=path):
+                self.get(path)
+
+                self.assert_status_code(status_code)
+
+    def test_grep_file_long_lines(self):
+        fs_root = self.tmp_fs_root()
+        path = fs_root.joinpath('long.txt')
+        path.write_bytes(
+            b'x' * (3 << 20) + b'needle\n' + b'y\n' * 100 + b'needle'
+        )
+
+        hits, bytes_read = webls.grep_file(path, b'needle', 1 << 30, 10)
+
+        self.assertEqual(path.stat().st_size, bytes_read)
+        self.assertEqual([1, 102], [line for line, _ in hits])
+        self.assertEqual(webls.GREP_LINE_SIZE, len(hits[0][1]))
+
     def test_fs_inexisting_file(self):
         self.get('/fs/inexisting.txt')
 
@@ -519,8 +1310,196 @@ class TestWebls(unittest.TestCase):
         self.assert_dl_btn('/dl/large.txt')
         self.assert_warning(
             message='file is too large (1.2M)',
+            url='?lines=-1000',
+            url_text='show the last 1000 lines',
+        )
+
+    def assert_text_lines(self, first, lines):
+        linenos = self.body.findall('.//td[@class="linenos"]//span')
+        code = self.body.find('.//td[@class="code"]//pre')
+
+        actual_line_numbers = [int(span.text) for span in linenos]
+        actual_lines = ''.join(code.itertext()).split('\n')[:-1]
+
+        self.assertEqual(
+            list(range(first, first + len(lines))),
+            actual_line_numbers,
+        )
+        self.assertEqual(list(lines), actual_lines)
+
+    def lines_file(self, line_count, **kwargs):
+        fs_root = self.tmp_fs_root(**kwargs)
+        path = fs_root.joinpath('lines.log')
+        self.write_file(
+            path,
+            ''.join(f'line {idx}\n' for idx in range(1, line_count + 1)),
+        )
+
+        return path
+
+    def test_fs_text_file_lines(self):
+        self.lines_file(100)
+        self.get('/fs/lines.log?lines=10-12')
+
+        self.assert_status_code(200)
+        self.assert_text_lines(10, ['line 10', 'line 11', 'line 12'])
+        self.assert_pager('?lines=7-9', 'lines 10-12 of 100', '?lines=13-15')
+
+    def test_fs_text_file_last_lines(self):
+        self.lines_file(100)
+        self.get('/fs/lines.log?lines=-2')
+
+        self.assert_text_lines(99, ['line 99', 'line 100'])
+        self.assert_pager('?lines=97-98', 'lines 99-100 of 100', None)
+
+    def test_fs_text_file_last_lines_above_max(self):
+        self.lines_file(100)
+
+        with mock.patch.object(webls, 'LINES_WINDOW_MAX', 3):
+            self.get('/fs/lines.log?lines=-50')
+
+        self.assert_text_lines(98, ['line 98', 'line 99', 'line 100'])
+
+    def test_fs_text_file_lines_open_ended(self):
+        self.lines_file(100)
+
+        self.get('/fs/lines.log?lines=98-')
+        self.assert_text_lines(98, ['line 98', 'line 99', 'line 100'])
+
+        self.get('/fs/lines.log?lines=500-600')
+        self.assert_text_lines(100, ['line 100'])
+
+    def test_fs_large_file_lines(self):
+        self.get('/fs/large.txt?lines=40000-40001')
+
+        self.assert_status_code(200)
+        self.assert_text_lines(40000, ['e' * 30, ''])
+        self.assert_pager(
+            '?lines=39998-39999',
+            'lines 40000-40001 of 40001',
+            None,
         )
 
+    def test_file_lines_parse(self):
+        for value, lines in [
+            (None, None),
+            ('3-7', (3, 7)),
+            ('3-', (3, None)),
+            ('-5', (-5, None)),
+            ('7', None),
+            ('0-3', None),
+            ('7-3', None),
+            ('-0', None),
+            ('a-b', None),
+        ]:
+            with self.subTest(value=value):
+                self.assertEqual(lines, webls.file_lines_parse(value))
+
+    def test_line_index(self):
+        path = self.lines_file(1000)
+        line_offsets = [0]
+        for line in path.read_bytes().splitlines(keepends=True):
+            line_offsets.append(line_offsets[-1] + len(line))
+
+        with (
+            mock.patch.object(webls.LineIndex, 'BLOCK_SIZE', 256),
+            path.open('rb') as file,
+        ):
+            fd = file.fileno()
+            line_index = webls.LineIndex()
+            line_index.update(fd, os.fstat(fd))
+
+            self.assertEqual(1000, line_index.line_count(fd))
+            self.assertEqual(
+                line_offsets,
+                [
+                    line_index.line_offset(fd, line)
+                    for line in range(1, 1002)
+                ],
+            )
+            self.assertIsNone(line_index.line_offset(fd, 1002))
+
+    def test_line_index_update(self):
+        path = self.lines_file(1000)
+
+        with (
+            mock.patch.object(webls.LineIndex, 'BLOCK_SIZE', 256),
+            path.open('rb') as file,
+        ):
+            fd = file.fileno()
+            line_index = webls.LineIndex()
+            line_index.update(fd, os.fstat(fd))
+            counts = line_index.counts
+
+            with path.open('a') as appended:
+                appended.write('line 1001\nline 1002')
+            line_index.update(fd, os.fstat(fd))
+
+            self.assertIs(counts, line_index.counts)
+            self.assertEqual(1002, line_index.line_count(fd))
+            self.assertEqual(
+                path.read_bytes().index(b'line 1002'),
+                line_index.line_offset(fd, 1002),
+            )
+
+            path.write_text('one\n' * 2000)
+            line_index.update(fd, os.fstat(fd))
+
+            self.assertIsNot(counts, line_index.counts)
+            self.assertEqual(2000, line_index.line_count(fd))
+            self.assertEqual(4 * 1500, line_index.line_offset(fd, 1501))
+
+    def test_line_indexes_lock_per_file(self):
+        slow_path = self.lines_file(100)
+        fast_path = slow_path.with_name('fast.log')
+        fast_path.write_text('one\ntwo\n')
+        line_indexes = webls.LineIndexes(path=None, max_bytes=1 << 20)
+        is_updating = threading.Event()
+        is_released = threading.Event()
+        update = webls.LineIndex.update
+
+        def update_held(line_index, fd, file_stat):
+            if file_stat.st_ino == slow_path.stat().st_ino:
+                is_updating.set()
+                is_released.wait(10)
+            update(line_index, fd, file_stat)
+
+        def line_count(path):
+            with path.open('rb') as file:
+                fd = file.fileno()
+                line_index = line_indexes.get(fd, os.fstat(fd))
+                return line_index.line_count(fd)
+
+        with (
+            mock.patch.object(webls.LineIndex, 'update', update_held),
+            ThreadPoolExecutor(max_workers=1) as pool,
+        ):
+            slow = pool.submit(line_count, slow_path)
+            is_updating.wait(10)
+
+            self.assertEqual(2, line_count(fast_path))
+            self.assertFalse(slow.done())
+            is_released.set()
+            self.assertEqual(100, slow.result())
+
+        self.assertEqual({}, line_indexes.file_locks)
+
+    def test_line_indexes_persisted(self):
+        with tempfile.TemporaryDirectory() as index_dir:
+            path = self.lines_file(100_000, line_index_dir=Path(index_dir))
+            self.get('/fs/lines.log?lines=50000-50001')
+
+            self.assertEqual(1, len(os.listdir(index_dir)))
+            self.app_build(
+                fs_root=self.app.fs_root,
+                line_index_dir=Path(index_dir),
+            )
+            with mock.patch.object(webls.LineIndex, 'update') as update:
+                self.get('/fs/lines.log?lines=50000-50001')
+
+            update.assert_not_called()
+            self.assert_text_lines(50000, ['line 50000', 'line 50001'])
+
     def test_fs_binary_file(self):
         self.get('/fs/Lato-Regular.ttf')
 
@@ -539,6 +1518,81 @@ class TestWebls(unittest.TestCase):
             message='the contents cannot be displayed',
         )
 
+    def test_fs_binary_file_unknown_type(self):
+        fs_root = self.tmp_fs_root()
+        path = fs_root.joinpath('blob')
+        path.write_bytes(b'\x7fELF\x02\x01\x01\0' + b'\xee' * (900 << 10))
+        os.utime(path, (time.time() - 60, time.time() - 60))
+
+        serve_text = mock.patch.object(webls, 'file_serve_text_kwargs')
+        with serve_text as file_serve_text_kwargs:
+            self.get('/fs/blob')
+            self.get('/fs/blob')
+
+        file_serve_text_kwargs.assert_not_called()
+        self.assert_warning(message='the contents cannot be displayed')
+        self.get('/metrics')
+        self.assertEqual(1, self.body['sniff_cache']['hits'])
+        self.assertEqual(1, self.body['sniff_cache']['entries'])
+
+    def test_fs_text_file_starting_with_magic(self):
+        fs_root = self.tmp_fs_root()
+        for name, content in [
+            ('id3.txt', 'ID3 is a metadata container\n'),
+            ('ogg.txt', 'OggS and fLaC are audio formats\n'),
+            ('mp4.txt', 'The ftyp box starts MP4 files\n'),
+        ]:
+            self.write_file(fs_root.joinpath(name), content)
+
+            with self.subTest(name=name):
+                self.get(f'/fs/{name}')
+
+                self.assert_text(1, name)
+
+    def test_fs_image_file_unknown_type(self):
+        fs_root = self.tmp_fs_root()
+        path = fs_root.joinpath('picture')
+        path.write_bytes(Path('storage/image.jpg').read_bytes())
+
+        self.get('/fs/picture')
+
+        self.assert_image('/dl/picture')
+
+    def test_file_sniff(self):
+        for window, is_whole, expected in [
+            (b'\x89PNG\r\n\x1a\n\0\0\0\rIHDR', False, 'image'),
+            (b'\xff\xd8\xff\xe0\0\x10JFIF', False, 'image'),
+            (b'RIFF\0\0\0\0WEBPVP8 ', False, 'image'),
+            (b'ID3\x04\0\0\0\0', False, 'audio'),
+            (b'RIFF\0\0\0\0WAVEfmt ', False, 'audio'),
+            (b'\0\0\0\x20ftypM4A \0\0', False, 'audio'),
+            (b'\0\0\0\x20ftypisom\0\0', False, 'video'),
+            (b'\x1aE\xdf\xa3\x9fB\x86', False, 'video'),
+            (b'%PDF-1.7\n', False, 'pdf'),
+            (b'text\0with a NUL', False, 'binary'),
+            (b'caf\xc3\xa9 au lait\n', True, 'text'),
+            (b'cut in the middle: \xc3', False, 'text'),
+            (b'cut in the middle: \xc3', True, 'binary'),
+            (b'latin-1 caf\xe9 au lait\n', False, 'binary'),
+            (b'', True, 'text'),
+        ]:
+            with self.subTest(window=window):
+                self.assertEqual(
+                    expected,
+                    webls.file_sniff(window, is_whole=is_whole),
+                )
+
+        for window, expected in [
+            (b'ID3 is a metadata container\n', 'text'),
+            (b'%PDF-1.7\n', 'text'),
+            (b'text\0with a NUL', 'binary'),
+        ]:
+            with self.subTest(window=window):
+                self.assertEqual(
+                    expected,
+                    webls.file_sniff(window, is_whole=True, use_magic=False),
+                )
+
     def test_fs_text_file(self):
         self.get('/fs/lorem.txt')
 
@@ -551,6 +1605,237 @@ class TestWebls(unittest.TestCase):
         self.assert_dl_btn('/dl/lorem.txt')
         self.assert_text(21, 'lorem.txt')
 
+    def test_fs_text_file_streamed(self):
+        with mock.patch.object(
+            webls,
+            'file_serve_text_kwargs',
+            wraps=webls.file_serve_text_kwargs,
+        ) as file_serve_text_kwargs:
+            response = self.client.get('/fs/lorem.txt', buffered=False)
+            chunks = iter(response.response)
+
+            # the head goes out before the file is read
+            head = next(chunks)
+            self.assertIn(b'<nav>', head)
+            file_serve_text_kwargs.assert_not_called()
+
+            rest = b''.join(chunks)
+            response.close()
+            file_serve_text_kwargs.assert_called_once()
+
+        self.get('/fs/lorem.txt')
+        self.assertEqual(head + rest, self.response.data)
+
+    def test_fs_text_file_read_error(self):
+        with mock.patch.object(
+            webls,
+            'file_serve_text_kwargs',
+            side_effect=PermissionError,
+        ):
+            self.get('/fs/lorem.txt')
+
+        self.assert_status_code(200)
+        self.assert_warning(message='the contents cannot be displayed')
+
+    def test_plain_text_html(self):
+        for text, linenostart in [
+            ('x', 1),
+            ('a<&"\'>\n\tb\n', 9),
+            ('\n\nblank edges\n\n', 1),
+            ('crlf\r\nand cr\rlines', 99),
+            ('\n'.join(map(str, range(1000))), 1),
+        ]:
+            with self.subTest(text=text[:20], linenostart=linenostart):
+                self.assertEqual(
+                    highlight(
+                        text,
+                        TextLexer(stripnl=False),
+                        HtmlFormatter(linenos=True, linenostart=linenostart),
+                    ),
+                    webls.plain_text_html(text, linenostart),
+                )
+
+    def test_lexers(self):
+        # a file name matching each pattern of the registry
+        names = {'README', 'x.unknown', 'no-extension', 'trailing.'}
+        for _, _, _, patterns, _ in LEXERS.values():
+            for pattern in patterns:
+                name = re.sub(r'\[(.)[^\]]*\]', r'\1', pattern)
+                name = name.replace('*', 'x').replace('?', 'y')
+                names.update([name, name.upper(), f'dir/{name}'])
+
+        lexers = webls.Lexers()
+        for name in sorted(names):
+            with self.subTest(name=name):
+                expected = find_lexer_class_for_filename(name)
+                if expected is TextLexer:
+                    expected = None
+                self.assertIs(expected, lexers.get(name))
+
+    def test_lexers_lazy_import(self):
+        code = 'import sys, webls; assert "pygments" not in sys.modules'
+        subprocess.run([sys.executable, '-c', code], check=True)
+
+    def test_fs_text_file_highlight_max_size(self):
+        fs_root = self.tmp_fs_root()
+        self.write_file(fs_root.joinpath('code.py'), 'import os\n')
+
+        self.get('/fs/code.py')
+        self.assertIsNotNone(self.body.find('.//span[@class="kn"]'))
+
+        self.app_build(fs_root=fs_root, highlight_max_size=4)
+        self.get('/fs/code.py')
+        self.assertIsNone(self.body.find('.//span[@class="kn"]'))
+        self.assert_text(1, 'code.py')
+
+    def test_fs_text_file_highlight_pool(self):
+        fs_root = self.tmp_fs_root(highlight_processes=1)
+        self.write_file(fs_root.joinpath('code.py'), 'import os\n')
+
+        self.get('/fs/code.py')
+        self.assertIsNotNone(self.body.find('.//span[@class="kn"]'))
+        self.assertIsNotNone(self.app.highlight_pool.executor)
+
+        self.app_build(fs_root=fs_root, highlight_processes=0)
+        self.get('/fs/code.py')
+        self.assertIsNotNone(self.body.find('.//span[@class="kn"]'))
+        self.assertIsNone(self.app.highlight_pool)
+
+    def pool_kill(self, pool):
+        future = pool.submit(time.sleep, 30)
+        for pid in list(pool.executor._processes):
+            os.kill(pid, signal.SIGKILL)
+
+        with self.assertRaises(BrokenProcessPool):
+            future.result(timeout=30)
+        self.assertTrue(pool.is_broken)
+
+    def test_fs_text_file_highlight_pool_worker_killed(self):
+        fs_root = self.tmp_fs_root(highlight_processes=1)
+        self.write_file(fs_root.joinpath('code.py'), 'import os\n')
+        self.write_file(fs_root.joinpath('other.py'), 'import sys\n')
+        self.get('/fs/code.py')
+
+        self.pool_kill(self.app.highlight_pool)
+        self.get('/fs/other.py')
+
+        self.assert_status_code(200)
+        self.assertIsNotNone(self.body.find('.//span[@class="kn"]'))
+        self.assertFalse(self.app.highlight_pool.is_broken)
+
+    def test_fs_text_file_highlight_timeout(self):
+        fs_root = self.tmp_fs_root(
+            highlight_processes=1,
+            highlight_timeout=0,
+        )
+        self.write_file(fs_root.joinpath('code.py'), 'import os\n' * 200)
+        headers = {'Accept-Encoding': 'gzip'}
+
+        # the plain text is kept under no validators, compressed or not
+        self.get('/fs/code.py', headers=headers)
+        self.assertNotIn(b'class="kn"', gzip.decompress(self.body))
+        self.assert_header('ETag', None)
+        self.assert_header('Last-Modified', None)
+
+        # the highlighting is cached once it is done
+        deadline = time.monotonic() + 30
+        while self.app.highlight_cache.stats()['entries'] == 0:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+        self.get('/fs/code.py', headers=headers)
+        self.assertIn(b'class="kn"', gzip.decompress(self.body))
+        self.assertIsNotNone(self.response.headers.get('ETag'))
+
+    def test_text_highlight_time_limit(self):
+        text = 'lorem = ipsum("dolor", sit, amet)\n' * 100000
+        handler = signal.getsignal(signal.SIGALRM)
+
+        with self.assertRaises(TimeoutError):
+            webls.text_highlight(
+                text,
+                PythonLexer,
+                {},
+                1,
+                time_limit=0.01,
+            )
+        self.assertIs(handler, signal.getsignal(signal.SIGALRM))
+
+    def test_fs_text_file_highlight_queue_full(self):
+        fs_root = self.tmp_fs_root(highlight_processes=1)
+        self.write_file(fs_root.joinpath('code.py'), 'import os\n')
+        slots = self.app.highlight_pool.slots
+        while slots.acquire(blocking=False):
+            self.addCleanup(slots.release)
+
+        self.get('/fs/code.py')
+        self.assertIsNone(self.body.find('.//span[@class="kn"]'))
+        self.assert_text(1, 'code.py')
+        self.assertIsNone(self.app.highlight_pool.executor)
+        self.assertEqual(0, self.app.highlight_cache.stats()['entries'])
+
+    def test_fs_text_file_highlight_cache(self):
+        self.get('/fs/lorem.txt')
+        self.get('/fs/lorem.txt')
+
+        self.assert_text(21, 'lorem.txt')
+        self.get('/metrics')
+        self.assertEqual(1, self.body['highlight_cache']['hits'])
+        self.assertEqual(1, self.body['highlight_cache']['misses'])
+        self.assertEqual(1, self.body['highlight_cache']['entries'])
+
+    def test_fs_text_file_highlight_cache_changed_file(self):
+        fs_root = self.tmp_fs_root()
+        self.write_file(fs_root.joinpath('file.txt'), 'one\n', age=60)
+
+        self.get('/fs/file.txt')
+        self.assert_text(1, 'file.txt')
+
+        self.write_file(fs_root.joinpath('file.txt'), 'one\ntwo\n', age=30)
+
+        self.get('/fs/file.txt')
+        self.assert_text(2, 'file.txt')
+
+        self.get('/metrics')
+        self.assertEqual(0, self.body['highlight_cache']['hits'])
+        self.assertEqual(2, self.body['highlight_cache']['misses'])
+
+    def test_fs_text_file_highlight_cache_racy_file(self):
+        fs_root = self.tmp_fs_root()
+        self.write_file(fs_root.joinpath('file.txt'), 'one\n', age=0)
+
+        self.get('/fs/file.txt')
+        self.get('/fs/file.txt')
+
+        self.assert_text(1, 'file.txt')
+        self.get('/metrics')
+        self.assertEqual(0, self.body['highlight_cache']['entries'])
+
+    def test_highlight_cache_evicts_by_size(self):
+        cache = webls.ByteLruCache(max_bytes=10)
+
+        cache.put('a', 'a', 4)
+        cache.put('b', 'b', 4)
+        cache.get('a')
+        cache.put('c', 'c', 4)
+        cache.put('d', 'd', 11)
+
+        self.assertEqual('a', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('c', cache.get('c'))
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(
+            {
+                'entries': 2,
+                'size_bytes': 8,
+                'max_bytes': 10,
+                'hits': 3,
+                'misses': 2,
+                'evictions': 1,
+            },
+            cache.stats(),
+        )
+
     def test_fs_image_file(self):
         self.get('/fs/image.jpg')
 
@@ -740,6 +2025,890 @@ class TestWebls(unittest.TestCase):
             url_text='go to root',
         )
 
+    def test_fs_text_file_not_modified(self):
+        self.get('/fs/lorem.txt')
+        etag = self.response.headers['ETag']
+
+        self.get('/fs/lorem.txt', headers={'If-None-Match': etag})
+
+        self.assert_status_code(304)
+        self.assert_header('ETag', etag)
+        self.assertEqual(b'', self.response.data)
+        self.get('/metrics')
+        self.assertEqual(0, self.body['highlight_cache']['hits'])
+        self.assertEqual(1, self.body['highlight_cache']['misses'])
+
+    def test_fs_text_file_if_modified_since_ignored(self):
+        self.get('/fs/lorem.txt')
+        last_modified = self.response.headers['Last-Modified']
+
+        self.get(
+            '/fs/lorem.txt', headers={'If-Modified-Since': last_modified}
+        )
+
+        self.assert_status_code(200)
+        self.assert_text(21, 'lorem.txt')
+
+    def test_fs_text_file_modified(self):
+        self.get('/fs/lorem.txt', headers={'If-None-Match': '"1-2-3"'})
+
+        self.assert_status_code(200)
+        self.assert_text(21, 'lorem.txt')
+
+    def test_fs_text_file_etag_varies_with_query(self):
+        self.get('/fs/lorem.txt')
+        etag = self.response.headers['ETag']
+
+        self.get('/fs/lorem.txt?lines=1-2')
+
+        self.assertNotEqual(etag, self.response.headers['ETag'])
+
+    def test_fs_text_file_changed_etag(self):
+        fs_root = self.tmp_fs_root()
+        self.write_file(fs_root.joinpath('file.txt'), 'one\n', age=60)
+        self.get('/fs/file.txt')
+        etag = self.response.headers['ETag']
+
+        self.write_file(fs_root.joinpath('file.txt'), 'two\n', age=30)
+        self.get('/fs/file.txt', headers={'If-None-Match': etag})
+
+        self.assert_status_code(200)
+        self.assert_text(1, 'file.txt')
+
+    def stat_counts(self, func):
+        """Calls of the stat family made by `func` in this thread."""
+        counts = collections.Counter()
+        thread_id = threading.get_ident()
+
+        def counting(name):
+            real = getattr(os, name)
+
+            def wrapper(*args, **kwargs):
+                if threading.get_ident() == thread_id:
+                    counts[name] += 1
+                return real(*args, **kwargs)
+
+            return mock.patch.object(os, name, wrapper)
+
+        with counting('stat'), counting('lstat'), counting('fstat'):
+            func()
+
+        return {name: counts[name] for name in ['stat', 'lstat', 'fstat']}
+
+    def test_fs_stats_per_request(self):
+        fs_root = self.tmp_fs_root(search_interval=0, dir_cache_size=1 << 20)
+        fs_root.joinpath('dir').mkdir()
+        self.write_file(fs_root.joinpath('dir', 'file.txt'), 'one\n')
+
+        for url_path in ['dir/', 'dir/file.txt']:
+            with self.subTest(url_path=url_path):
+                # fill the caches first
+                self.get('/fs/' + url_path)
+                self.assert_status_code(200)
+
+                # resolving the path takes one lstat per component
+                resolve_counts = self.stat_counts(
+                    lambda: os.path.realpath(fs_root.joinpath(url_path))
+                )
+                counts = self.stat_counts(
+                    lambda: self.get('/fs/' + url_path)
+                )
+
+                self.assert_status_code(200)
+                self.assertEqual(
+                    {'stat': 1, 'lstat': resolve_counts['lstat'], 'fstat': 0},
+                    counts,
+                )
+
+    def test_fs_symlink_loop(self):
+        fs_root = self.tmp_fs_root()
+        fs_root.joinpath('loop').symlink_to('loop')
+
+        self.get('/fs/loop')
+
+        self.assert_status_code(404)
+
+    def test_fs_cache_control(self):
+        self.app_build(
+            fs_root=Path('storage').absolute(),
+            cache_control_fs='private, no-cache',
+        )
+
+        self.get('/fs/lorem.txt')
+        self.assert_header('Cache-Control', 'private, no-cache')
+
+        self.get('/fs/')
+        self.assert_header('Cache-Control', 'private, no-cache')
+        self.assert_header('ETag', None)
+
+        self.get('/fs/inexisting.txt')
+        self.assert_header('Cache-Control', 'no-store, max-age=0')
+
+    def test_static_css(self):
+        for url in ['/fs/', '/fs/lorem.txt']:
+            with self.subTest(url=url):
+                self.get(url)
+                self.assert_header(
+                    'Content-Security-Policy',
+                    "default-src 'self'; "
+                    "block-all-mixed-content; "
+                    "form-action 'self'; "
+                    "frame-ancestors 'none'; "
+                    "object-src 'self'; "
+                    "upgrade-insecure-requests; "
+                    "style-src 'self'",
+                )
+                self.assertEqual([], self.body.findall('.//style'))
+
+                links = self.body.findall('.//link[@rel="stylesheet"]')
+                self.assertTrue(links)
+                for link in links:
+                    self.assertRegex(
+                        link.get('href'),
+                        r'^/static/[0-9a-f]{16}\.css$',
+                    )
+
+        for url in [link.get('href') for link in links]:
+            with self.subTest(url=url):
+                self.get(url)
+                self.assert_status_code(200)
+                self.assert_header('Content-Type', 'text/css; charset=UTF-8')
+                self.assert_header(
+                    'Cache-Control',
+                    'public, max-age=31536000, immutable',
+                )
+
+        self.assertEqual(
+            Path('templates/main.css').read_bytes(),
+            self.app.templates.static_file(
+                self.app.templates.static_names['main.css'],
+            ),
+        )
+
+        self.get('/static/0000000000000000.css')
+        self.assert_status_code(404)
+
+    def test_templates_reload(self):
+        tmp_dir = self.tmp_dir()
+        templates_path = Path(tmp_dir, 'templates')
+        templates_path.mkdir()
+        for path in Path('templates').iterdir():
+            self.write_file(
+                templates_path.joinpath(path.name),
+                path.read_text(),
+            )
+
+        with mock.patch.object(
+            webls,
+            'SimpleTemplate',
+            wraps=webls.SimpleTemplate,
+        ) as simple_template:
+            self.app = webls.app_build(
+                development=True,
+                root=Path(tmp_dir),
+                fs_root=Path('storage').absolute(),
+            )
+            self.client = Client(self.app)
+            builds = simple_template.call_count
+
+            self.get('/fs/')
+            self.get('/fs/lorem.txt')
+            self.assertEqual(builds, simple_template.call_count)
+
+            main_url = self.app.templates.static_file_url('main.css')
+            self.write_file(
+                templates_path.joinpath('main.css'),
+                'body {}\n',
+                age=0,
+            )
+
+            self.get('/fs/')
+            self.assertEqual(2 * builds, simple_template.call_count)
+            self.assertNotEqual(
+                main_url,
+                self.app.templates.static_file_url('main.css'),
+            )
+
+            self.get(self.app.templates.static_file_url('main.css'))
+            self.assertEqual(b'body {}\n', self.body)
+
+    def test_dl_file(self):
+        self.get('/dl/image.jpg')
+
+        self.assert_status_code(200)
+        self.assert_header('Content-Type', 'image/jpeg')
+        self.assert_header('Cache-Control', 'no-cache')
+        self.assert_header('X-Content-Type-Options', 'nosniff')
+        self.assertEqual(
+            self.app.fs_root.joinpath('image.jpg').read_bytes(),
+            self.body,
+        )
+
+    def test_dl_file_offload(self):
+        fs_root = self.app.fs_root
+        for offload, url, header, value in [
+            (
+                'nginx',
+                '/dl/image.jpg',
+                'X-Accel-Redirect',
+                '/webls-offload/image.jpg',
+            ),
+            (
+                'apache',
+                '/dl/nested/file.txt',
+                'X-Sendfile',
+                str(fs_root.joinpath('nested/file.txt')),
+            ),
+            (
+                'lighttpd',
+                '/dl/photo.jpg',
+                'X-Sendfile',
+                str(fs_root.joinpath('image.jpg')),
+            ),
+        ]:
+            with self.subTest(offload=offload):
+                self.app_build(fs_root=fs_root, offload=offload)
+                self.get(url, headers={'Range': 'bytes=0-9'})
+
+                self.assert_status_code(200)
+                self.assert_header(header, value)
+                self.assertIsNotNone(self.response.headers.get('ETag'))
+                self.assertEqual(b'', self.response.data)
+
+    def test_dl_file_offload_nginx_quoted(self):
+        fs_root = self.tmp_fs_root(offload='nginx', offload_prefix='/int/')
+        self.write_file(fs_root.joinpath('a b%.txt'), 'one\n')
+
+        self.get('/dl/a%20b%25.txt')
+
+        self.assert_status_code(200)
+        self.assert_header('X-Accel-Redirect', '/int/a%20b%25.txt')
+        self.assert_header(
+            'Content-Disposition',
+            'attachment; filename="a b%.txt"',
+        )
+
+    def test_dl_file_offload_checks_path(self):
+        self.app_build(fs_root=self.app.fs_root, offload='nginx')
+
+        for url, status_code in [
+            ('/dl/fifo', 403),
+            ('/dl/README.md', 403),
+            ('/dl/inexistent.txt', 404),
+            ('/dl/nested', 404),
+        ]:
+            with self.subTest(url=url):
+                self.get(url)
+
+                self.assert_status_code(status_code)
+                self.assert_header('X-Accel-Redirect', None)
+
+        self.get('/dl/nested/?format=zip')
+        self.assert_header('Content-Type', 'application/zip')
+        self.assert_header('X-Accel-Redirect', None)
+
+    def test_http_accept_encoding(self):
+        for header, encoding in [
+            ('', None),
+            ('gzip', 'gzip'),
+            ('deflate, gzip', 'gzip'),
+            ('br, deflate', 'deflate'),
+            ('gzip;q=0, deflate;q=0.5', 'deflate'),
+            ('GZIP', 'gzip'),
+            ('*', 'gzip'),
+            ('*;q=0, identity', None),
+            ('gzip;q=0, *', 'deflate'),
+            ('gzip;q=x', None),
+        ]:
+            with self.subTest(header=header):
+                self.assertEqual(encoding, webls.http_accept_encoding(header))
+
+    def test_compress_text_page(self):
+        self.get('/fs/lorem.txt')
+        page = self.response.data
+        etag = self.response.headers['ETag']
+        self.assert_header('Vary', 'Accept, Accept-Encoding')
+        self.assert_header('Content-Encoding', None)
+
+        for encoding, decompress in [
+            ('gzip', gzip.decompress),
+            ('deflate', zlib.decompress),
+        ]:
+            with self.subTest(encoding=encoding):
+                for _ in range(2):
+                    self.get(
+                        '/fs/lorem.txt',
+                        headers={'Accept-Encoding': encoding},
+                    )
+
+                    self.assert_status_code(200)
+                    self.assert_header('Content-Encoding', encoding)
+                    self.assert_header('Vary', 'Accept, Accept-Encoding')
+                    self.assert_header('ETag', f'{etag[:-1]}-{encoding}"')
+                    self.assertLess(len(self.response.data), len(page) / 2)
+                    self.assertEqual(page, decompress(self.response.data))
+
+        # the second of each came from the cache
+        self.assertEqual(2, self.app.highlight_cache.stats()['entries'] - 1)
+
+        self.get(
+            '/fs/lorem.txt',
+            headers={
+                'Accept-Encoding': 'gzip',
+                'If-None-Match': f'{etag[:-1]}-gzip"',
+            },
+        )
+        self.assert_status_code(304)
+        self.assert_header('ETag', f'{etag[:-1]}-gzip"')
+
+    def test_compress_chunks_max_size(self):
+        chunks = [os.urandom(1000) for _ in range(5)]
+
+        for max_size, is_kept in [
+            (None, True),
+            (1 << 20, True),
+            (2000, False),
+        ]:
+            with self.subTest(max_size=max_size):
+                done = []
+                compressed = b''.join(webls.compress_chunks(
+                    iter(chunks),
+                    'gzip',
+                    6,
+                    done.append,
+                    max_size,
+                ))
+
+                self.assertEqual(b''.join(chunks), gzip.decompress(compressed))
+                self.assertEqual([compressed] if is_kept else [], done)
+
+    def test_compress_streamed(self):
+        fs_root = self.tmp_fs_root()
+        for idx in range(50):
+            fs_root.joinpath(f'file-{idx}.txt').touch()
+
+        self.get('/fs/')
+        page = self.response.data
+
+        with mock.patch.object(webls, 'DIR_ROWS_CHUNK', 10):
+            response = self.client.get(
+                '/fs/',
+                headers={'Accept-Encoding': 'gzip'},
+                buffered=False,
+            )
+            chunks = list(response.response)
+            response.close()
+
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertNotIn('Content-Length', response.headers)
+        # head, start of the table, five chunks of rows, tail and the end
+        # of the stream
+        self.assertEqual(9, len(chunks))
+        self.assertEqual(page, gzip.decompress(b''.join(chunks)))
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertIn(b'<nav>', decompressor.decompress(chunks[0]))
+
+        self.get('/fs/?format=ndjson', headers={'Accept-Encoding': 'gzip'})
+        self.assert_header('Content-Encoding', 'gzip')
+        self.assertEqual(
+            50,
+            gzip.decompress(self.response.data).count(b'\n'),
+        )
+
+    def test_compress_dl(self):
+        fs_root = self.app.fs_root
+        content = fs_root.joinpath('lorem.txt').read_bytes()
+
+        self.get('/dl/lorem.txt')
+        etag = self.response.headers['ETag']
+        self.assert_header('Vary', 'Accept-Encoding')
+
+        self.get('/dl/lorem.txt', headers={'Accept-Encoding': 'gzip'})
+
+        self.assert_status_code(200)
+        self.assert_header('Content-Encoding', 'gzip')
+        self.assert_header('Content-Type', 'application/octet-stream')
+        self.assert_header('ETag', f'{etag[:-1]}-gzip"')
+        self.assert_header('Accept-Ranges', None)
+        self.assertEqual(content, gzip.decompress(self.response.data))
+
+        # ranges are of the file
+        self.get(
+            '/dl/lorem.txt',
+            headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-9'},
+        )
+        self.assert_status_code(206)
+        self.assert_header('Content-Encoding', None)
+        self.assertEqual(content[:10], self.response.data)
+
+        self.get('/dl/lorem.txt', method='HEAD')
+        self.assert_header('Content-Encoding', None)
+
+        for url in [
+            # compressed already, too small and binary
+            '/dl/image.jpg',
+            '/dl/nested/file.txt',
+            '/dl/Lato-Regular.ttf',
+            '/dl/nested/?format=zip',
+        ]:
+            with self.subTest(url=url):
+                self.get(url, headers={'Accept-Encoding': 'gzip'})
+                self.assert_status_code(200)
+                self.assert_header('Content-Encoding', None)
+
+    def test_compress_dl_offload(self):
+        self.app_build(fs_root=self.app.fs_root, offload='apache')
+
+        self.get('/dl/lorem.txt', headers={'Accept-Encoding': 'gzip'})
+
+        self.assert_header('Content-Encoding', None)
+        self.assertEqual(b'', self.response.data)
+
+    def test_compress_disabled(self):
+        self.app_build(fs_root=self.app.fs_root, compress_level=0)
+
+        for url in ['/fs/lorem.txt', '/dl/lorem.txt']:
+            with self.subTest(url=url):
+                self.get(url, headers={'Accept-Encoding': 'gzip'})
+                self.assert_header('Content-Encoding', None)
+
+    def test_gate(self):
+        gate = webls.Gate(limit=1, queue_size=1, wait=0.01)
+
+        self.assertTrue(gate.enter())
+        # the one waiting runs out of time, the next finds the queue full
+        waiter = threading.Thread(target=gate.enter)
+        waiter.start()
+        while gate.stats()['waiting'] == 0:
+            time.sleep(0.001)
+        self.assertFalse(gate.enter())
+        waiter.join()
+        gate.leave()
+        self.assertTrue(gate.enter())
+
+        self.assertEqual({
+            'limit': 1,
+            'queue_size': 1,
+            'active': 1,
+            'waiting': 0,
+            'admitted': 2,
+            'rejected': 1,
+            'timeouts': 1,
+        }, gate.stats())
+
+    def test_admit_heavy_full(self):
+        self.app_build(
+            fs_root=self.app.fs_root,
+            heavy_limit=1,
+            heavy_queue=0,
+            light_limit=1,
+        )
+        self.assertTrue(self.app.gates['heavy'].enter())
+
+        for url in [
+            '/fs/lorem.txt',
+            f'/fs/?limit={webls.DIR_PAGE_SIZE + 1}',
+            '/fs/?format=ndjson',
+            '/dl/empty-dir/?format=zip',
+        ]:
+            with self.subTest(url=url):
+                self.get(url)
+                self.assert_status_code(503)
+                self.assert_header('Retry-After', '1')
+                self.assert_header('Cache-Control', 'no-store, max-age=0')
+
+        for url in ['/fs/', '/fs/image.jpg', '/dl/lorem.txt']:
+            with self.subTest(url=url):
+                self.get(url)
+                self.assert_status_code(200)
+                # as servers do, which lets file bodies leave the gate
+                self.response.close()
+
+        self.get('/metrics')
+        self.assertEqual(4, self.body['admission']['heavy']['rejected'])
+        self.assertEqual(3, self.body['admission']['light']['admitted'])
+        self.assertEqual(0, self.body['admission']['light']['active'])
+
+    def test_admit_large_directory(self):
+        fs_root = self.tmp_fs_root(
+            heavy_limit=1,
+            heavy_queue=0,
+            dir_cache_size=1 << 20,
+        )
+        fs_root.joinpath('small').mkdir()
+        large_path = fs_root.joinpath('large')
+        large_path.mkdir()
+        # more than a block of names
+        for i in range(300):
+            large_path.joinpath(f'file-{i:04}-{"x" * 20}.txt').touch()
+        self.get('/fs/large/')
+        self.assert_status_code(200)
+        self.assertTrue(self.app.gates['heavy'].enter())
+
+        with mock.patch.object(
+            webls,
+            'ADMIT_HEAVY_DIR_SIZE',
+            fs_root.joinpath('small').stat().st_size,
+        ):
+            self.assertGreater(
+                large_path.stat().st_size,
+                webls.ADMIT_HEAVY_DIR_SIZE,
+            )
+            for url, status_code in [
+                ('/fs/small/', 200),
+                # its page is cached
+                ('/fs/large/', 200),
+                ('/fs/large/?offset=50&limit=50', 503),
+            ]:
+                with self.subTest(url=url):
+                    self.get(url)
+                    self.assert_status_code(status_code)
+
+    def test_admit_streamed_body(self):
+        self.app_build(fs_root=self.app.fs_root, heavy_limit=1)
+        gate = self.app.gates['heavy']
+
+        response = self.client.get('/fs/lorem.txt')
+        self.assertEqual(1, gate.stats()['active'])
+        response.close()
+        self.assertEqual(0, gate.stats()['active'])
+
+        self.get('/fs/lorem.txt', headers={'Accept-Encoding': 'gzip'})
+        self.assert_header('Content-Encoding', 'gzip')
+        self.assertEqual(0, gate.stats()['active'])
+
+    def test_admit_file_body(self):
+        self.app_build(fs_root=self.app.fs_root, light_limit=1)
+        gate = self.app.gates['light']
+
+        response = self.client.get('/dl/large.txt')
+        self.assertEqual(1, gate.stats()['active'])
+        response.close()
+        self.assertEqual(0, gate.stats()['active'])
+
+    def test_metrics_disabled(self):
+        self.app_build(fs_root=self.app.fs_root, metrics=False)
+
+        self.get('/metrics')
+        self.assert_status_code(404)
+
+    def test_admit_heavy_default(self):
+        with (
+            mock.patch.object(webls, 'ADMIT_HEAVY_LIMIT', 4),
+            mock.patch.object(webls, 'ADMIT_HEAVY_QUEUE', 16),
+        ):
+            for threads, limit, queue in [
+                (1, 0, 0),
+                (2, 1, 0),
+                (4, 1, 1),
+                (16, 4, 4),
+                (64, 4, 16),
+            ]:
+                with self.subTest(threads=threads):
+                    self.assertEqual(
+                        (limit, queue),
+                        webls.admit_heavy_default(threads),
+                    )
+
+    def test_admit_disabled(self):
+        self.app_build(fs_root=self.app.fs_root, heavy_limit=0)
+
+        self.assertEqual({}, self.app.gates)
+        self.get('/metrics')
+        self.assertNotIn('admission', self.body)
+
+    def test_dl_file_range(self):
+        content = self.app.fs_root.joinpath('image.jpg').read_bytes()
+
+        self.get('/dl/image.jpg', headers={'Range': 'bytes=100-199'})
+
+        self.assert_status_code(206)
+        self.assert_header('Content-Range', f'bytes 100-199/{len(content)}')
+        self.assert_header('Content-Length', '100')
+        self.assertEqual(content[100:200], self.body)
+
+    def test_dl_file_range_not_satisfiable(self):
+        self.get('/dl/image.jpg', headers={'Range': 'bytes=999999-'})
+
+        self.assert_status_code(416)
+
+    def test_dl_file_suffix_range(self):
+        content = self.app.fs_root.joinpath('image.jpg').read_bytes()
+
+        self.get('/dl/image.jpg', headers={'Range': 'bytes=-100'})
+
+        self.assert_status_code(206)
+        self.assert_header(
+            'Content-Range',
+            f'bytes {len(content) - 100}-{len(content) - 1}/{len(content)}',
+        )
+        self.assertEqual(content[-100:], self.body)
+
+    def test_dl_file_multiple_ranges(self):
+        content = self.app.fs_root.joinpath('image.jpg').read_bytes()
+
+        self.get('/dl/image.jpg', headers={'Range': 'bytes=500-599,0-9'})
+
+        self.assert_status_code(206)
+        self.assertEqual('multipart/byteranges', self.response.mimetype)
+        boundary = self.response.mimetype_params['boundary']
+        self.assertEqual(
+            str(len(self.body)),
+            self.response.headers['Content-Length'],
+        )
+        self.assertEqual(
+            b''.join([
+                f'\r\n--{boundary}\r\n'.encode(),
+                b'Content-Type: image/jpeg\r\n',
+                f'Content-Range: bytes 0-9/{len(content)}\r\n\r\n'.encode(),
+                content[0:10],
+                f'\r\n--{boundary}\r\n'.encode(),
+                b'Content-Type: image/jpeg\r\n',
+                f'Content-Range: bytes 500-599/{len(content)}\r\n\r\n'
+                .encode(),
+                content[500:600],
+                f'\r\n--{boundary}--\r\n'.encode(),
+            ]),
+            self.body,
+        )
+
+    def test_dl_file_if_range(self):
+        self.get('/dl/image.jpg')
+        etag = self.response.headers['ETag']
+        last_modified = self.response.headers['Last-Modified']
+
+        for if_range, status_code in [
+            (etag, 206),
+            (last_modified, 206),
+            ('"stale"', 200),
+            (f'W/{etag}', 200),
+            ('Thu, 01 Jan 1970 00:00:00 GMT', 200),
+        ]:
+            self.get(
+                '/dl/image.jpg',
+                headers={'Range': 'bytes=0-9', 'If-Range': if_range},
+            )
+            self.assert_status_code(status_code)
+
+    def test_http_ranges_parse(self):
+        for header, ranges in [
+            ('bytes=0-9', [(0, 10)]),
+            ('bytes=90-', [(90, 100)]),
+            ('bytes=-10', [(90, 100)]),
+            ('bytes=-200', [(0, 100)]),
+            ('bytes=50-500', [(50, 100)]),
+            ('bytes=0-9, 20-29', [(0, 10), (20, 30)]),
+            ('bytes=20-29,0-9', [(0, 10), (20, 30)]),
+            ('bytes=0-9,5-14,15-19', [(0, 20)]),
+            ('bytes=100-', []),
+            ('bytes=-0', []),
+            ('bytes=100-200,0-0', [(0, 1)]),
+            ('bytes=9-0', None),
+            ('bytes=a-b', None),
+            ('bytes=-', None),
+            ('bytes=0-1,x', None),
+            ('items=0-9', None),
+            ('bytes=' + ','.join(['0-0'] * 65), None),
+        ]:
+            self.assertEqual(
+                ranges,
+                webls.http_ranges_parse(header, 100),
+                header,
+            )
+
+    def test_dl_text_file(self):
+        self.get('/dl/lorem.txt')
+
+        self.assert_status_code(200)
+        self.assert_header('Content-Type', 'application/octet-stream')
+        self.assert_header(
+            'Content-Disposition',
+            'attachment; filename="lorem.txt"',
+        )
+
+    def test_dl_file_not_modified(self):
+        self.app_build(
+            fs_root=Path('storage').absolute(),
+            cache_control_dl='max-age=3600',
+        )
+        self.get('/dl/image.jpg')
+        last_modified = self.response.headers['Last-Modified']
+
+        self.get('/dl/image.jpg', headers={'If-Modified-Since': last_modified})
+
+        self.assert_status_code(304)
+        self.assert_header('Cache-Control', 'max-age=3600')
+        self.assertEqual(b'', self.response.data)
+
+    def test_dl_file_etag(self):
+        self.get('/dl/image.jpg')
+        etag = self.response.headers['ETag']
+
+        self.get('/dl/image.jpg', headers={'If-None-Match': f'"x", {etag}'})
+        self.assert_status_code(304)
+
+        self.get('/dl/image.jpg', headers={'If-None-Match': '"x"'})
+        self.assert_status_code(200)
+
+    def pool_server_start(self, threads):
+        server = webls.PoolWSGIServer(
+            ('127.0.0.1', 0),
+            threads=threads,
+            reuse_port=True,
+            quiet=True,
+        )
+        server.set_app(self.app)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+        self.addCleanup(stop)
+
+        return f'http://127.0.0.1:{server.server_port}'
+
+    def test_pool_server_concurrent_requests(self):
+        url = self.pool_server_start(threads=4) + '/fs/lorem.txt'
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            statuses = list(pool.map(
+                lambda _: urlopen(url).status,
+                range(16),
+            ))
+
+        self.assertEqual([200] * 16, statuses)
+
+    def test_prefork_server_reload(self):
+        for workers in [1, 2]:
+            with self.subTest(workers=workers):
+                self.prefork_server_reload(workers)
+
+    def prefork_server_reload(self, workers):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'webls',
+                '--root', 'storage',
+                '--port', str(port),
+                '--workers', str(workers),
+                '--threads', '2',
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.addCleanup(process.wait)
+        self.addCleanup(process.terminate)
+        children_path = f'/proc/{process.pid}/task/{process.pid}/children'
+
+        def children():
+            with open(children_path) as file:
+                return set(file.read().split())
+
+        deadline = time.monotonic() + 30
+        while len(children()) < workers:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        old_children = children()
+
+        # light, as the heavy gate of two threads turns some pages away
+        url = f'http://127.0.0.1:{port}/dl/lorem.txt'
+        errors = []
+        is_done = threading.Event()
+
+        def client():
+            while not is_done.is_set():
+                try:
+                    urlopen(url, timeout=10).read()
+                except OSError as error:
+                    errors.append(error)
+
+        clients = [threading.Thread(target=client) for _ in range(4)]
+        for thread in clients:
+            thread.start()
+
+        # a second reload while the first one is under way
+        os.kill(process.pid, signal.SIGHUP)
+        os.kill(process.pid, signal.SIGHUP)
+        while children() & old_children or len(children()) != workers:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+        is_done.set()
+        for thread in clients:
+            thread.join()
+        self.assertEqual([], errors)
+
+    def test_pool_server_admit_light_while_heavy_full(self):
+        heavy_limit, heavy_queue = webls.admit_heavy_default(4)
+        self.app_build(
+            fs_root=self.app.fs_root,
+            heavy_limit=heavy_limit,
+            heavy_queue=heavy_queue,
+        )
+        gate = self.app.gates['heavy']
+        url = self.pool_server_start(threads=4)
+        is_released = threading.Event()
+        text_html = webls.text_html
+
+        def text_html_held(*args, **kwargs):
+            is_released.wait(10)
+            return text_html(*args, **kwargs)
+
+        def status(path):
+            try:
+                with urlopen(url + path, timeout=10) as response:
+                    response.read()
+                    return response.status
+            except HTTPError as error:
+                return error.code
+
+        with (
+            mock.patch.object(webls, 'text_html', text_html_held),
+            ThreadPoolExecutor(max_workers=4) as pool,
+        ):
+            held = [
+                pool.submit(status, '/fs/lorem.txt')
+                for _ in range(heavy_limit + heavy_queue)
+            ]
+            deadline = time.monotonic() + 10
+            while gate.stats()['waiting'] < heavy_queue:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+            self.assertEqual(503, status('/fs/lorem.txt'))
+            self.assertEqual(200, status('/dl/lorem.txt'))
+            self.assertEqual(200, status('/fs/'))
+            is_released.set()
+            self.assertEqual(
+                [200] * len(held),
+                [future.result() for future in held],
+            )
+
+    def test_pool_server_sendfile(self):
+        url = self.pool_server_start(threads=1) + '/dl/large.txt'
+        content = self.app.fs_root.joinpath('large.txt').read_bytes()
+        read = mock.patch.object(
+            webls.FileRange,
+            'read',
+            side_effect=AssertionError('read instead of sendfile'),
+        )
+        read.start()
+        self.addCleanup(read.stop)
+
+        with urlopen(url) as response:
+            self.assertEqual(content, response.read())
+
+        range_request = Request(url, headers={'Range': 'bytes=1000-1999'})
+        with urlopen(range_request) as response:
+            self.assertEqual(206, response.status)
+            self.assertEqual(content[1000:2000], response.read())
+
     def test_dl_inexistent_file(self):
         self.get('/dl/inexisting.txt')
 
@@ -758,6 +2927,98 @@ class TestWebls(unittest.TestCase):
             self.response.text,
         )
 
+    def test_dl_directory_zip(self):
+        self.get('/dl/nested/?format=zip')
+
+        self.assert_status_code(200)
+        self.assert_header('Content-Type', 'application/zip')
+        self.assert_header(
+            'Content-Disposition',
+            'attachment; filename="nested.zip"',
+        )
+        with zipfile.ZipFile(io.BytesIO(self.body)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(
+                [
+                    'nested/',
+                    'nested/level-1/',
+                    'nested/level-1/file.txt',
+                    'nested/level-1/level-2/',
+                    'nested/level-1/level-2/file.txt',
+                    'nested/file.txt',
+                ],
+                archive.namelist(),
+            )
+            self.assertEqual(
+                self.app.fs_root.joinpath('nested/file.txt').read_bytes(),
+                archive.read('nested/file.txt'),
+            )
+
+    def test_dl_directory_tar(self):
+        for archive_format, mimetype in [
+            ('tar', 'application/x-tar'),
+            ('tar.gz', 'application/gzip'),
+        ]:
+            with self.subTest(archive_format=archive_format):
+                self.get(f'/dl/nested/?format={archive_format}')
+
+                self.assert_status_code(200)
+                self.assert_header('Content-Type', mimetype)
+                self.assert_header(
+                    'Content-Disposition',
+                    f'attachment; filename="nested.{archive_format}"',
+                )
+                with tarfile.open(fileobj=io.BytesIO(self.body)) as archive:
+                    self.assertEqual(
+                        [
+                            'nested',
+                            'nested/level-1',
+                            'nested/level-1/file.txt',
+                            'nested/level-1/level-2',
+                            'nested/level-1/level-2/file.txt',
+                            'nested/file.txt',
+                        ],
+                        archive.getnames(),
+                    )
+                    self.assertEqual(
+                        self.app.fs_root.joinpath(
+                            'nested/level-1/level-2/file.txt',
+                        ).read_bytes(),
+                        archive.extractfile(
+                            'nested/level-1/level-2/file.txt',
+                        ).read(),
+                    )
+
+    def test_dl_directory_excludes_forbidden_entries(self):
+        self.get('/dl/?format=tar')
+
+        self.assert_status_code(200)
+        with tarfile.open(fileobj=io.BytesIO(self.body)) as archive:
+            names = archive.getnames()
+
+        self.assertIn('storage/empty-dir', names)
+        self.assertIn('storage/lorem.txt', names)
+        for name in [
+            'README.md',
+            'broken.txt',
+            'unix.sock',
+            'fifo',
+            'char_device',
+        ]:
+            self.assertNotIn(f'storage/{name}', names)
+
+    def test_dl_directory_unknown_format(self):
+        self.get('/dl/nested/?format=rar')
+
+        self.assert_status_code(400)
+
+    def test_dl_directory_head(self):
+        self.response = self.client.head('/dl/nested/')
+
+        self.assert_status_code(200)
+        self.assert_header('Content-Type', 'application/zip')
+        self.assertEqual(b'', self.response.data)
+
     def test_dl_broken_symlink(self):
         self.get('/dl/broken.txt')
 
@@ -849,5 +3110,203 @@ class TestWebls(unittest.TestCase):
         )
 
 
+    def export(self, **kwargs):
+        out_dir = Path(self.tmp_dir())
+        summary = webls.export(
+            {
+                'development': False,
+                'root': self.app.root,
+                'fs_root': self.app.fs_root,
+            },
+            out_dir,
+            **{'processes': 1, **kwargs},
+        )
+
+        return out_dir, summary
+
+    def tmp_dir(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+
+        return tmp_dir.name
+
+    def export_outputs(self, out_dir):
+        return sorted(
+            path.relative_to(out_dir).as_posix()
+            for path in out_dir.rglob('*')
+            if path.is_file() and path.name != '.webls-export'
+        )
+
+    def export_static_outputs(self):
+        return sorted(
+            'static/' + file_name
+            for file_name in self.app.templates.static_files
+        )
+
+    def test_export(self):
+        fs_root = self.tmp_fs_root()
+        fs_root.joinpath('dir').mkdir()
+        self.write_file(fs_root.joinpath('dir', 'a b.txt'), 'one\n')
+        self.write_file(fs_root.joinpath('index'), 'two\n')
+        fs_root.joinpath('link.txt').symlink_to('dir/a b.txt')
+        os.mkfifo(fs_root.joinpath('fifo'))
+
+        out_dir, summary = self.export()
+
+        self.assertEqual(
+            {'paths': 4, 'exported': 4, 'removed': 0, 'failures': 0},
+            summary,
+        )
+        self.assertEqual(
+            [
+                'dl/dir/a b.txt',
+                'dl/index',
+                'fs/dir/a b.txt/index.html',
+                'fs/dir/index.html',
+                'fs/index.html',
+                'fs/index/index.html',
+                *self.export_static_outputs(),
+            ],
+            self.export_outputs(out_dir),
+        )
+
+        # relative links lead to exported files
+        for page_path in self.export_outputs(out_dir):
+            if not page_path.startswith('fs/'):
+                continue
+
+            page = html5lib.parse(
+                out_dir.joinpath(page_path).read_text(),
+                namespaceHTMLElements=False,
+            )
+            for element in page.iter():
+                link = element.get('href') or element.get('src')
+                if link is None or link.startswith('/'):
+                    continue
+
+                with self.subTest(page_path=page_path, link=link):
+                    path = out_dir.joinpath(page_path).parent.joinpath(
+                        unquote(link)
+                    )
+                    self.assertTrue(path.is_file())
+
+        self.body = html5lib.parse(
+            out_dir.joinpath('fs/index.html').read_text(),
+            namespaceHTMLElements=False,
+        )
+        hrefs = {a.get('href') for a in self.body.iter('a')}
+        self.assertLessEqual(
+            {
+                'dir/index.html',
+                'index/index.html',
+                'dir/a%20b.txt/index.html',
+                '../dl/dir/a%20b.txt',
+                '/fs/fifo',
+                '/dl/?format=zip',
+            },
+            hrefs,
+        )
+
+    def test_export_identical_to_live(self):
+        # the search form needs a running server, so exports leave it out
+        self.app_build(fs_root=self.app.fs_root, search_interval=0)
+        out_dir, _ = self.export(processes=2)
+
+        for page_path in self.export_outputs(out_dir):
+            if not page_path.endswith('/index.html'):
+                continue
+
+            url_path = page_path.removeprefix('fs/').removesuffix(
+                'index.html'
+            )
+            if not self.app.fs_root.joinpath(url_path).is_dir():
+                url_path = url_path.removesuffix('/')
+
+            with self.subTest(url_path=url_path):
+                self.get('/fs/' + url_path)
+                self.assertEqual(
+                    webls.export_page_html(
+                        self.app,
+                        self.response.text,
+                        url_path,
+                        page_path,
+                    ),
+                    out_dir.joinpath(page_path).read_text(),
+                )
+
+    def test_export_pages(self):
+        fs_root = self.tmp_fs_root()
+        for name in 'abcde':
+            self.write_file(fs_root.joinpath(name), name)
+
+        with mock.patch.object(webls, 'DIR_PAGE_SIZE', 2):
+            out_dir, _ = self.export()
+
+        pages = ['index.html', 'index.2.html', 'index.4.html']
+        for page, prev_url, next_url in [
+            (pages[0], None, pages[1]),
+            (pages[1], pages[0], pages[2]),
+            (pages[2], pages[1], None),
+        ]:
+            with self.subTest(page=page):
+                self.body = html5lib.parse(
+                    out_dir.joinpath('fs', page).read_text(),
+                    namespaceHTMLElements=False,
+                )
+                for klass, url in [
+                    ('pager-prev', prev_url),
+                    ('pager-next', next_url),
+                ]:
+                    a = self.body.find(f'.//a[@class="{klass}"]')
+                    self.assertEqual(url, None if a is None else a.get('href'))
+
+    def test_export_incremental(self):
+        fs_root = self.tmp_fs_root()
+        fs_root.joinpath('dir').mkdir()
+        self.write_file(fs_root.joinpath('dir', 'one.txt'), 'one\n')
+        self.write_file(fs_root.joinpath('two.txt'), 'two\n')
+        os.utime(fs_root.joinpath('dir'), (0, 0))
+        os.utime(fs_root, (0, 0))
+        out_dir = Path(self.tmp_dir())
+        app_kwargs = {
+            'development': False,
+            'root': self.app.root,
+            'fs_root': fs_root,
+        }
+
+        def export():
+            return webls.export(app_kwargs, out_dir, processes=1)
+
+        self.assertEqual(4, export()['exported'])
+        self.assertEqual(0, export()['exported'])
+
+        # the file and the listing showing its size
+        self.write_file(fs_root.joinpath('dir', 'one.txt'), 'one more\n', 30)
+        self.assertEqual(2, export()['exported'])
+        self.assertIn(
+            'one more',
+            out_dir.joinpath('fs/dir/one.txt/index.html').read_text(),
+        )
+
+        fs_root.joinpath('two.txt').unlink()
+        summary = export()
+        self.assertEqual(1, summary['exported'])
+        self.assertEqual(2, summary['removed'])
+        self.assertEqual(
+            [
+                'dl/dir/one.txt',
+                'fs/dir/index.html',
+                'fs/dir/one.txt/index.html',
+                'fs/index.html',
+                *self.export_static_outputs(),
+            ],
+            self.export_outputs(out_dir),
+        )
+
+        # all pages, once the templates change
+        with mock.patch.object(webls.Templates, 'version', return_value='x'):
+            self.assertEqual(3, export()['exported'])
+
+
 if __name__ == '__main__':
     unittest.main()
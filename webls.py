@@ -1,46 +1,1213 @@
+import bisect
 import bottle
+import codecs
+import ctypes
+import ctypes.util
+import fnmatch
+import functools
+import hashlib
+import heapq
+import html
+import json
+import mmap
 import mimetypes
+import multiprocessing
 import os
+import posixpath
+import re
+import secrets
+import shutil
+import signal
+import socket
 import stat
+import struct
+import sys
+import tarfile
+import threading
+import time
+import traceback
+import wsgiref.util
+import zipfile
+import zlib
 
+from array import array
 from bottle import Bottle, SimpleTemplate, request as req, response as res
+from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from operator import itemgetter
 from optparse import OptionParser
 from pathlib import Path
-from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import get_lexer_for_filename
-from pygments.lexers.special import TextLexer
-from pygments.util import ClassNotFound
-from urllib.parse import quote
+from urllib.parse import parse_qs, quote, unquote
+from wsgiref.simple_server import (
+    ServerHandler,
+    WSGIRequestHandler,
+    WSGIServer,
+)
+
+
+HIGHLIGHT_CACHE_SIZE = 64 << 20
+HIGHLIGHT_MAX_SIZE = 256 << 10
+HIGHLIGHT_PROCESSES = os.cpu_count() or 1
+# jobs waiting in the highlight pool, per process of it
+HIGHLIGHT_QUEUE_PER_PROCESS = 2
+HIGHLIGHT_TIMEOUT = 2.0
+# a job past the timeout runs up to this many times it, to be cached for
+# the next view, and is stopped then; a timeout of 0 leaves it unbounded
+HIGHLIGHT_LATE_FACTOR = 5
+DIR_PAGE_SIZE = 1000
+DIR_PAGE_SIZE_MAX = 10000
+DIR_ROWS_CHUNK = 100
+API_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+CACHE_CONTROL_FS = 'no-cache'
+CACHE_CONTROL_DL = 'no-cache'
+CACHE_CONTROL_STATIC = 'public, max-age=31536000, immutable'
+# crawling the tree and grepping it take each worker of their own, so
+# both are left to be turned on
+SEARCH_INTERVAL = 0
+SEARCH_LIMIT = 100
+SEARCH_LIMIT_MAX = 1000
+LINE_INDEX_CACHE_SIZE = 16 << 20
+LINE_INDEX_DIR = Path(
+    os.environ.get('XDG_CACHE_HOME') or '~/.cache',
+    'webls/line-index',
+).expanduser()
+LINES_WINDOW = 1000
+LINES_WINDOW_MAX = 10000
+DIR_SIZES_INTERVAL = 0
+DIR_SIZES_MAX_AGE_INTERVALS = 10
+GREP_PROCESSES = 0
+GREP_TIME = 10.0
+GREP_BYTES = 256 << 20
+GREP_LIMIT = 1000
+GREP_LIMIT_MAX = 10000
+GREP_LINE_SIZE = 400
+OFFLOAD_HEADERS = {
+    'nginx': 'X-Accel-Redirect',
+    'apache': 'X-Sendfile',
+    'lighttpd': 'X-Sendfile',
+}
+OFFLOAD_PREFIX = '/webls-offload/'
+EXPORT_PROCESSES = os.cpu_count() or 1
+ADMIT_HEAVY_LIMIT = os.cpu_count() or 1
+ADMIT_HEAVY_QUEUE = 4 * ADMIT_HEAVY_LIMIT
+ADMIT_WAIT = 5.0
+ADMIT_RETRY_AFTER = 1
+# the size of a directory on disk grows with its entries on most file
+# systems: ext4 takes about 2000 short names to reach this
+ADMIT_HEAVY_DIR_SIZE = 64 << 10
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 1 << 10
+# `wbits` of the zlib stream of each encoding, in order of preference
+COMPRESS_ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+SNIFF_SIZE = 8 << 10
+SNIFF_CACHE_SIZE = 1 << 20
+SNIFF_MAGIC_RE = re.compile(
+    rb'(?P<image>\x89PNG\r\n\x1a\n|\xff\xd8\xff|GIF8[79]a|RIFF.{4}WEBP'
+    rb'|.{4}ftyp(?:avif|heic))'
+    rb'|(?P<audio>ID3|fLaC|OggS|RIFF.{4}WAVE|.{4}ftypM4A)'
+    rb'|(?P<video>\x1aE\xdf\xa3|RIFF.{4}AVI |.{4}ftyp)'
+    rb'|(?P<pdf>%PDF-)',
+    re.DOTALL,
+)
 
 
 class Templates:
-    def __init__(self, *, path, fresh):
+    """
+    Templates of `path`, compiled together, and its stylesheets, served
+    under names of their content hashes. Templates include each other
+    compiled. With `fresh`, all are reloaded when a file of `path`
+    changes, otherwise they are loaded once.
+    """
+
+    def __init__(self, *, path, fresh, static_url=None):
         self.path = path
         self.fresh = fresh
+        self.static_url = static_url
 
+        self.signature = None
+        self.cached_version = None
         self.cache = {}
+        self.static_names = {}
+        self.static_files = {}
+
+        self.load()
 
-    def build(self, name):
-        return SimpleTemplate(
-            lookup=[self.path],
-            name=name,
+    def paths_signature(self):
+        # rendered pages change with the templates and with this module
+        paths = sorted(self.path.iterdir()) + [Path(__file__)]
+
+        return ';'.join(
+            f'{path.name}:{path_stat.st_size}:{path_stat.st_mtime_ns}'
+            for path in paths
+            for path_stat in [path.stat()]
         )
 
+    def load(self):
+        signature = self.paths_signature()
+        if signature == self.signature:
+            return
+
+        static_names = {}
+        static_files = {}
+        for path in sorted(self.path.glob('*.css')):
+            content = path.read_bytes()
+            digest = hashlib.sha256(content).hexdigest()[:16]
+            static_names[path.name] = f'{digest}.css'
+            static_files[f'{digest}.css'] = content
+
+        cache = {}
+        for path in sorted(self.path.glob('*.html')):
+            template = SimpleTemplate(lookup=[self.path], name=path.name)
+            template.defaults = {'static_url': self.static_file_url}
+            template.cache = cache
+            # compile now rather than on the first render
+            template.co
+            cache[path.name] = template
+
+        self.cache = cache
+        self.static_names = static_names
+        self.static_files = static_files
+        self.cached_version = f'{zlib.crc32(signature.encode()):08x}'
+        self.signature = signature
+
+    def version(self):
+        if self.fresh:
+            self.load()
+
+        return self.cached_version
+
+    def static_file_url(self, name):
+        return self.static_url(file_name=self.static_names[name])
+
+    def static_file(self, file_name):
+        if self.fresh:
+            self.load()
+
+        return self.static_files.get(file_name)
+
     def __getitem__(self, name):
         if self.fresh:
-            return self.build(name)
-        if name in self.cache:
-            return self.cache[name]
+            self.load()
 
-        self.cache[name] = self.build(name)
         return self.cache[name]
 
 
+class ByteLruCache:
+    def __init__(self, *, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.on_evict = on_evict
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return False
+
+        with self.lock:
+            if key in self.entries:
+                self.size_bytes -= self.entries.pop(key)[1]
+
+            self.entries[key] = (value, size)
+            self.size_bytes += size
+
+            while self.size_bytes > self.max_bytes:
+                evicted_key, (_, evicted_size) = (
+                    self.entries.popitem(last=False)
+                )
+                self.size_bytes -= evicted_size
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict(evicted_key)
+
+        return True
+
+    def pop(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.size_bytes -= self.entries.pop(key)[1]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size_bytes': self.size_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class Inotify:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_EXCL_UNLINK = 0x04000000
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+
+        self.fd = self.check(
+            self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        )
+
+    def check(self, result):
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        return result
+
+    def add_watch(self, path, mask):
+        return self.check(
+            self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        )
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 << 10)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, name_len = (
+                    self.EVENT_HEADER.unpack_from(buffer, offset)
+                )
+                offset += self.EVENT_HEADER.size + name_len
+
+                yield wd, mask
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirCache:
+    """
+    Directory listings keyed on (directory, offset, limit).
+
+    A directory is invalidated by inotify events on it (which include
+    changes to its direct children), or, when no watch could be added,
+    by a change of its own mtime. The latter only notices entries being
+    added, removed or renamed. Neither notices a symlink target outside
+    the directory changing.
+    """
+    WATCH_MASK = (
+        Inotify.IN_MODIFY
+        | Inotify.IN_ATTRIB
+        | Inotify.IN_MOVED_FROM
+        | Inotify.IN_MOVED_TO
+        | Inotify.IN_CREATE
+        | Inotify.IN_DELETE
+        | Inotify.IN_DELETE_SELF
+        | Inotify.IN_MOVE_SELF
+        | Inotify.IN_ONLYDIR
+        | Inotify.IN_EXCL_UNLINK
+    )
+
+    def __init__(self, *, max_bytes, use_inotify=True):
+        self.max_bytes = max_bytes
+        self.use_inotify = use_inotify
+
+        self.lock = threading.Lock()
+        self.pid = None
+
+        self.invalidations = 0
+        self.watch_failures = 0
+
+    def reset(self):
+        # the inotify queue is shared with forked processes, so each
+        # process starts from an empty cache with its own descriptor
+        self.pid = os.getpid()
+
+        self.cache = ByteLruCache(
+            max_bytes=self.max_bytes,
+            on_evict=self.forget_key,
+        )
+        self.dir_keys = {}
+        self.dir_tokens = {}
+        self.dir_generations = {}
+        self.wd_dirs = {}
+
+        self.inotify = None
+        if self.use_inotify:
+            try:
+                self.inotify = Inotify()
+            except (AttributeError, OSError):
+                pass
+
+    def ensure_reset(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+    def forget_key(self, key):
+        dir_path = key[0]
+        keys = self.dir_keys[dir_path]
+
+        keys.discard(key)
+        if not keys:
+            self.forget_dir(dir_path)
+
+    def forget_dir(self, dir_path):
+        self.dir_keys.pop(dir_path, None)
+        token = self.dir_tokens.pop(dir_path, None)
+
+        if isinstance(token, int):
+            del self.wd_dirs[token]
+            self.inotify.rm_watch(token)
+
+    def invalidate(self, dir_path):
+        self.invalidations += 1
+        self.dir_generations[dir_path] = (
+            self.dir_generations.get(dir_path, 0) + 1
+        )
+
+        for key in list(self.dir_keys.get(dir_path, [])):
+            self.cache.pop(key)
+            self.forget_key(key)
+
+    def invalidate_all(self):
+        for dir_path in list(self.dir_keys):
+            self.invalidate(dir_path)
+
+    def process_events(self):
+        if self.inotify is None:
+            return
+
+        for wd, mask in self.inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self.invalidate_all()
+            elif wd in self.wd_dirs:
+                dir_path = self.wd_dirs[wd]
+                if mask & Inotify.IN_IGNORED:
+                    del self.wd_dirs[wd]
+                    self.dir_tokens.pop(dir_path, None)
+                self.invalidate(dir_path)
+
+    def dir_stat_token(self, dir_path, dir_stat=None):
+        if dir_stat is None:
+            dir_stat = os.stat(dir_path)
+
+        return (dir_stat.st_mtime_ns, dir_stat.st_ctime_ns)
+
+    def get(self, key, dir_stat=None):
+        with self.lock:
+            self.ensure_reset()
+            self.process_events()
+
+            dir_path = key[0]
+            token = self.dir_tokens.get(dir_path)
+            if isinstance(token, tuple):
+                try:
+                    is_stale = (
+                        token != self.dir_stat_token(dir_path, dir_stat)
+                    )
+                except OSError:
+                    is_stale = True
+                if is_stale:
+                    self.invalidate(dir_path)
+
+            return self.cache.get(key)
+
+    def watch(self, dir_path):
+        """
+        Start watching `dir_path` before it is read, so that changes made
+        while reading are not missed. Returns a value to pass to `put`.
+        """
+        with self.lock:
+            self.ensure_reset()
+            self.process_events()
+
+            if dir_path not in self.dir_tokens:
+                token = None
+                if self.inotify is not None:
+                    try:
+                        token = self.inotify.add_watch(
+                            dir_path,
+                            self.WATCH_MASK,
+                        )
+                        self.wd_dirs[token] = dir_path
+                    except OSError:
+                        self.watch_failures += 1
+                if token is None:
+                    try:
+                        token = self.dir_stat_token(dir_path)
+                    except OSError:
+                        return None
+
+                self.dir_tokens[dir_path] = token
+                self.dir_keys.setdefault(dir_path, set())
+
+            return self.dir_generations.get(dir_path, 0)
+
+    def put(self, key, value, size, generation):
+        with self.lock:
+            self.ensure_reset()
+            self.process_events()
+
+            dir_path = key[0]
+            is_current = (
+                dir_path in self.dir_tokens
+                and generation == self.dir_generations.get(dir_path, 0)
+            )
+
+            if is_current:
+                # the key is counted first, so that evicting the other
+                # keys of the directory to make room keeps its watch
+                self.dir_keys[dir_path].add(key)
+                if not self.cache.put(key, value, size):
+                    self.forget_key(key)
+            elif not self.dir_keys.get(dir_path):
+                self.forget_dir(dir_path)
+
+    def __contains__(self, key):
+        """Whether `key` is cached, stale or not, without counting a hit."""
+        with self.lock:
+            self.ensure_reset()
+            return key in self.cache
+
+    def stats(self):
+        with self.lock:
+            self.ensure_reset()
+            stats = self.cache.stats()
+            lookups = stats['hits'] + stats['misses']
+
+            stats.update({
+                'hit_rate': stats['hits'] / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+                'inotify': self.inotify is not None,
+                'watches': len(self.wd_dirs),
+                'watch_failures': self.watch_failures,
+                'mtime_checked_dirs': sum(
+                    isinstance(token, tuple)
+                    for token in self.dir_tokens.values()
+                ),
+            })
+
+            return stats
+
+
+class SearchSnapshot:
+    """
+    Entry names of every indexed directory, one per line, with a trailing
+    '/' for directories. The block of lines of each directory in `keys`
+    is appended to `names`, and lowercased to `names_lower`, so that a
+    query is a single `str.find` whatever the number of files. Directory
+    `idx` spans `starts[idx]:starts[idx + 1]` of `names` and
+    `starts_lower[idx]:starts_lower[idx + 1]` of `names_lower`.
+    """
+
+    def __init__(self, keys=(), blocks=()):
+        self.keys = list(keys)
+        self.key_indexes = {key: idx for idx, key in enumerate(self.keys)}
+
+        self.starts = array('Q', [0])
+        self.starts_lower = array('Q', [0])
+        # whether each name of a block lowercases to as many characters,
+        # so that offsets in `names_lower` map to `names` as is
+        self.aligned = array('B')
+
+        blocks_lower = []
+        for block in blocks:
+            block_lower = block.lower()
+            blocks_lower.append(block_lower)
+
+            self.starts.append(self.starts[-1] + len(block))
+            self.starts_lower.append(self.starts_lower[-1] + len(block_lower))
+            self.aligned.append(
+                block.isascii()
+                or all(len(char.lower()) == 1 for char in set(block))
+            )
+
+        self.names = ''.join(blocks)
+        self.names_lower = ''.join(blocks_lower)
+        self.count = self.names.count('\n')
+
+    def block(self, idx):
+        return self.names[self.starts[idx]:self.starts[idx + 1]]
+
+    def name(self, idx, start_lower, end_lower):
+        if self.aligned[idx]:
+            offset = self.starts[idx] - self.starts_lower[idx]
+            return self.names[start_lower + offset:end_lower + offset]
+
+        line = self.names_lower.count(
+            '\n',
+            self.starts_lower[idx],
+            start_lower,
+        )
+        return self.block(idx).split('\n')[line]
+
+    def size(self):
+        return (
+            sys.getsizeof(self.names)
+            + sys.getsizeof(self.names_lower)
+            + sys.getsizeof(self.starts)
+            + sys.getsizeof(self.starts_lower)
+            + sys.getsizeof(self.aligned)
+        )
+
+
+class Crawler:
+    """
+    Base of the indexes of the tree under `fs_root` that a crawler thread
+    of each process updates with `crawl_once` every `interval` seconds.
+    """
+
+    def __init__(self, *, fs_root, interval):
+        self.fs_root = fs_root
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.crawl_lock = threading.Lock()
+        self.pid = None
+
+        self.crawls = 0
+        self.crawl_seconds = 0.0
+
+    def ensure_started(self):
+        # threads do not survive a fork, so each worker runs its own crawler
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+
+        threading.Thread(target=self.crawl_loop, daemon=True).start()
+
+    def crawl_loop(self):
+        while True:
+            try:
+                self.crawl()
+            except Exception:
+                traceback.print_exc()
+
+            time.sleep(self.interval)
+
+    def crawl(self):
+        with self.crawl_lock:
+            started_at = time.monotonic()
+            self.crawl_once()
+
+            self.crawls += 1
+            self.crawl_seconds = time.monotonic() - started_at
+
+    def dir_token(self, dir_stat):
+        """
+        Token of a directory that changes with its entries, or None if it
+        may change again unnoticed: like a cached file, a racy directory
+        is read again on the next crawl.
+        """
+        if file_stat_is_racy(dir_stat):
+            return None
+
+        return (dir_stat.st_mtime_ns, dir_stat.st_ctime_ns)
+
+    def crawl_once(self):
+        raise NotImplementedError
+
+
+class SearchIndex(Crawler):
+    """
+    Filename index of the tree under `fs_root`, for case insensitive
+    substring queries.
+
+    A crawler thread walks the tree every `interval` seconds. Directories
+    whose mtime and ctime did not change since the previous walk cost a
+    single stat, the others are listed again, and a new `SearchSnapshot`
+    replaces the current one only when some listing changed. Symlinks to
+    directories are not followed.
+    """
+    SUBDIR_RE = re.compile(r'^(.*)/$', re.MULTILINE)
+
+    def __init__(self, *, fs_root, interval):
+        super().__init__(fs_root=fs_root, interval=interval)
+
+        self.snapshot = None
+        self.dir_tokens = {}
+        self.crawled_at = None
+
+    def dir_block(self, path):
+        lines = []
+
+        try:
+            with os.scandir(path) as dir_entries:
+                for dir_entry in dir_entries:
+                    if '\n' in dir_entry.name:
+                        continue
+                    try:
+                        is_dir = dir_entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+
+                    lines.append(dir_entry.name + ('/\n' if is_dir else '\n'))
+        except OSError:
+            pass
+
+        lines.sort()
+
+        return ''.join(lines)
+
+    def crawl_once(self):
+        snapshot = self.snapshot or SearchSnapshot()
+
+        blocks = {}
+        dir_tokens = {}
+        is_changed = self.snapshot is None
+        stack = ['']
+
+        while stack:
+            key = stack.pop()
+            path = os.path.join(self.fs_root, key)
+            try:
+                dir_stat = os.stat(path)
+            except OSError:
+                continue
+
+            token = self.dir_token(dir_stat)
+            idx = snapshot.key_indexes.get(key)
+            cached = self.dir_tokens.get(key)
+
+            if idx is not None and cached and cached[0] == token:
+                block = snapshot.block(idx)
+                subdirs = cached[1]
+            else:
+                block = self.dir_block(path)
+                subdirs = self.SUBDIR_RE.findall(block)
+                is_changed = (
+                    is_changed
+                    or idx is None
+                    or block != snapshot.block(idx)
+                )
+
+            blocks[key] = block
+            if token is not None:
+                dir_tokens[key] = (token, subdirs)
+
+            stack.extend(key + name + '/' for name in subdirs)
+
+        if is_changed or len(blocks) != len(snapshot.keys):
+            keys = sorted(blocks)
+            self.snapshot = SearchSnapshot(
+                keys,
+                [blocks[key] for key in keys],
+            )
+        self.dir_tokens = dir_tokens
+        self.crawled_at = time.time()
+
+    def search(self, query, *, scope='', limit):
+        """
+        Up to `limit` `(dir_key, name)` of the entries whose name contains
+        `query`, in directory `scope` (empty, or ending with '/') and its
+        subdirectories, and whether more entries matched.
+        """
+        snapshot = self.snapshot
+        query = query.lower()
+
+        if snapshot is None or not query or '\n' in query:
+            return [], False
+
+        # the keys under `scope` sort between `scope` and `scope` with
+        # its trailing '/' replaced by the next character, '0'
+        first = bisect.bisect_left(snapshot.keys, scope)
+        last = len(snapshot.keys)
+        if scope:
+            last = bisect.bisect_left(snapshot.keys, scope[:-1] + '0')
+
+        names_lower = snapshot.names_lower
+        pos = snapshot.starts_lower[first]
+        end = snapshot.starts_lower[last]
+        results = []
+
+        while (pos := names_lower.find(query, pos, end)) != -1:
+            if len(results) == limit:
+                return results, True
+
+            idx = bisect.bisect_right(snapshot.starts_lower, pos) - 1
+            line_start = names_lower.rfind('\n', 0, pos) + 1
+            line_end = names_lower.find('\n', pos)
+
+            results.append((
+                snapshot.keys[idx],
+                snapshot.name(idx, line_start, line_end),
+            ))
+            pos = line_end + 1
+
+        return results, False
+
+    def stats(self):
+        snapshot = self.snapshot or SearchSnapshot()
+
+        return {
+            'dirs': len(snapshot.keys),
+            'names': snapshot.count,
+            'size': snapshot.size(),
+            'crawls': self.crawls,
+            'crawl_seconds': self.crawl_seconds,
+            'crawled_at': self.crawled_at,
+        }
+
+
+class DirSizes(Crawler):
+    """
+    Recursive sizes and file counts of the directories under `fs_root`,
+    like `du --apparent-size`: regular files, symlinks and other non
+    directories count with their own size, symlinks are not followed.
+
+    A crawler thread walks the tree every `interval` seconds and stats
+    the entries of a directory only if the mtime or ctime of the directory
+    changed, or if it was last scanned over `max_age` seconds ago, since
+    a file changing size does not change its directory. Totals are then
+    added up again from the per directory sums, and each carries the time
+    of the oldest scan it adds up.
+    """
+
+    def __init__(self, *, fs_root, interval, max_age):
+        super().__init__(fs_root=fs_root, interval=interval)
+
+        self.max_age = max_age
+
+        # key: (token, own_bytes, own_files, subdirs, scanned_at)
+        self.records = {}
+        # key: (total_bytes, total_files, scanned_at)
+        self.totals = None
+
+        self.scanned_dirs = 0
+
+    def dir_scan(self, path, token, scanned_at):
+        own_bytes = 0
+        own_files = 0
+        subdirs = []
+
+        try:
+            with os.scandir(path) as dir_entries:
+                for dir_entry in dir_entries:
+                    try:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            subdirs.append(dir_entry.name)
+                            continue
+                        entry_stat = dir_entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+                    own_bytes += entry_stat.st_size
+                    own_files += 1
+        except OSError:
+            pass
+
+        return (token, own_bytes, own_files, subdirs, scanned_at)
+
+    def crawl_once(self):
+        now = time.time()
+
+        records = {}
+        stack = ['']
+
+        while stack:
+            key = stack.pop()
+            path = os.path.join(self.fs_root, key)
+            try:
+                dir_stat = os.stat(path)
+            except OSError:
+                continue
+
+            token = self.dir_token(dir_stat)
+
+            record = self.records.get(key)
+            if (
+                record is None
+                or record[0] is None
+                or record[0] != token
+                or now - record[4] >= self.max_age
+            ):
+                record = self.dir_scan(path, token, now)
+                self.scanned_dirs += 1
+
+            records[key] = record
+            stack.extend(key + name + '/' for name in record[3])
+
+        # a subdirectory key sorts after its parent key, of which it
+        # is an extension, so children are added up before parents
+        totals = {}
+        for key in sorted(records, reverse=True):
+            _, total_bytes, total_files, subdirs, scanned_at = records[key]
+
+            for name in subdirs:
+                subdir_total = totals.get(key + name + '/')
+                if subdir_total is not None:
+                    total_bytes += subdir_total[0]
+                    total_files += subdir_total[1]
+                    scanned_at = min(scanned_at, subdir_total[2])
+
+            totals[key] = (total_bytes, total_files, scanned_at)
+
+        self.records = records
+        self.totals = totals
+
+    def get(self, key):
+        """
+        `(total_bytes, total_files, scanned_at)` of the directory `key`
+        (empty, or ending with '/'), or None if it was not crawled yet.
+        """
+        if self.totals is None:
+            return None
+
+        return self.totals.get(key)
+
+    def stats(self):
+        return {
+            'dirs': len(self.records),
+            'crawls': self.crawls,
+            'crawl_seconds': self.crawl_seconds,
+            'scanned_dirs': self.scanned_dirs,
+        }
+
+
+class LineIndex:
+    """
+    Sparse line index of a file: `counts[idx]` is the number of newlines
+    before block `idx` of `BLOCK_SIZE` bytes, for the whole blocks of the
+    file, so the offset of any line is a bisection plus reading a block.
+    """
+    BLOCK_SIZE = 64 << 10
+    HEADER = struct.Struct('<8sQqQI')
+    MAGIC = b'webls-li'
+
+    def __init__(self, counts=None, *, check=0, file_size=0, mtime_ns=0):
+        self.counts = counts if counts is not None else array('Q', [0])
+        # crc32 of the last indexed block, to tell appends from rewrites
+        self.check = check
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+
+    @property
+    def indexed_size(self):
+        return (len(self.counts) - 1) * self.BLOCK_SIZE
+
+    def is_current(self, file_stat):
+        return (
+            self.file_size == file_stat.st_size
+            and self.mtime_ns == file_stat.st_mtime_ns
+        )
+
+    def block_check(self, fd, block_idx):
+        if block_idx < 0:
+            return 0
+
+        data = os.pread(fd, self.BLOCK_SIZE, block_idx * self.BLOCK_SIZE)
+
+        return zlib.crc32(data)
+
+    def update(self, fd, file_stat):
+        """Index the blocks appended since the last update, or all."""
+        is_appended = (
+            file_stat.st_size > self.file_size
+            and self.block_check(fd, len(self.counts) - 2) == self.check
+        )
+        if not is_appended:
+            self.counts = array('Q', [0])
+
+        end = file_stat.st_size - file_stat.st_size % self.BLOCK_SIZE
+        if end > self.indexed_size:
+            with mmap.mmap(fd, end, access=mmap.ACCESS_READ) as data:
+                if hasattr(data, 'madvise'):
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+
+                count = self.counts[-1]
+                for start in range(self.indexed_size, end, self.BLOCK_SIZE):
+                    count += data[start:start + self.BLOCK_SIZE].count(b'\n')
+                    self.counts.append(count)
+
+        self.check = self.block_check(fd, len(self.counts) - 2)
+        self.file_size = file_stat.st_size
+        self.mtime_ns = file_stat.st_mtime_ns
+
+    def line_offset(self, fd, line):
+        """Offset of the start of `line`, counted from 1, or None."""
+        skip = line - 1
+        if skip <= 0:
+            return 0
+
+        # the block holding the newline that ends the previous line
+        block_idx = bisect.bisect_left(self.counts, skip) - 1
+        skip -= self.counts[block_idx]
+        offset = block_idx * self.BLOCK_SIZE
+
+        while data := os.pread(fd, self.BLOCK_SIZE, offset):
+            count = data.count(b'\n')
+            if count >= skip:
+                pos = -1
+                for _ in range(skip):
+                    pos = data.find(b'\n', pos + 1)
+                return offset + pos + 1
+
+            skip -= count
+            offset += len(data)
+
+        return None
+
+    def line_count(self, fd):
+        count = self.counts[-1]
+        offset = self.indexed_size
+        last = b''
+
+        while data := os.pread(fd, self.BLOCK_SIZE, offset):
+            count += data.count(b'\n')
+            offset += len(data)
+            last = data[-1:]
+
+        if offset > 0 and not last:
+            last = os.pread(fd, 1, offset - 1)
+
+        return count + (offset > 0 and last != b'\n')
+
+    def dump(self):
+        header = self.HEADER.pack(
+            self.MAGIC,
+            self.file_size,
+            self.mtime_ns,
+            len(self.counts),
+            self.check,
+        )
+
+        return header + self.counts.tobytes()
+
+    @classmethod
+    def load(cls, data):
+        try:
+            magic, file_size, mtime_ns, length, check = cls.HEADER.unpack_from(
+                data,
+            )
+        except struct.error:
+            return None
+
+        counts = array('Q')
+        counts.frombytes(data[cls.HEADER.size:])
+        if magic != cls.MAGIC or len(counts) != length:
+            return None
+
+        return cls(counts, check=check, file_size=file_size, mtime_ns=mtime_ns)
+
+
+class LineIndexes:
+    """
+    `LineIndex` of files by device and inode, kept in memory and, when
+    `path` is given, saved as one file per index under it, so they
+    survive restarts. Building is locked per file, so the first request
+    for a huge file only holds back the others for the same file.
+    """
+
+    def __init__(self, *, path, max_bytes):
+        self.path = path
+        self.cache = ByteLruCache(max_bytes=max_bytes)
+        self.lock = threading.Lock()
+        # lock of each file being indexed, and how many requests use it
+        self.file_locks = {}
+
+    def index_path(self, file_stat):
+        return self.path.joinpath(f'{file_stat.st_dev:x}-{file_stat.st_ino:x}')
+
+    def load(self, file_stat):
+        if self.path is None:
+            return None
+
+        try:
+            return LineIndex.load(self.index_path(file_stat).read_bytes())
+        except OSError:
+            return None
+
+    def save(self, file_stat, line_index):
+        if self.path is None:
+            return
+
+        index_path = self.index_path(file_stat)
+        tmp_path = index_path.with_name(f'{index_path.name}.{os.getpid()}')
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(line_index.dump())
+            tmp_path.replace(index_path)
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+
+    def get(self, fd, file_stat):
+        key = (file_stat.st_dev, file_stat.st_ino)
+
+        with self.lock:
+            file_lock = self.file_locks.setdefault(
+                key,
+                [threading.Lock(), 0],
+            )
+            file_lock[1] += 1
+
+        try:
+            with file_lock[0]:
+                return self.get_locked(key, fd, file_stat)
+        finally:
+            with self.lock:
+                file_lock[1] -= 1
+                if file_lock[1] == 0:
+                    del self.file_locks[key]
+
+    def get_locked(self, key, fd, file_stat):
+        line_index = self.cache.get(key)
+        if line_index is None:
+            line_index = self.load(file_stat) or LineIndex()
+
+        if not line_index.is_current(file_stat):
+            line_index.update(fd, file_stat)
+            self.save(file_stat, line_index)
+
+        self.cache.put(key, line_index, sys.getsizeof(line_index.counts))
+
+        return line_index
+
+
+@functools.lru_cache(maxsize=1024)
+def lexer_class_find(name):
+    from pygments.lexers import find_lexer_class_for_filename
+
+    return find_lexer_class_for_filename(name)
+
+
+class Lexers:
+    """
+    Pygments lexer classes of file names, as `get_lexer_for_filename`
+    picks them, from an index of the glob patterns of the lexer registry.
+    Plain text gains nothing from going through Pygments, and is None.
+
+    Most file names only match patterns like `*.ext`: the lexer of those
+    is looked up by extension, and only the first file of an extension
+    has Pygments rank its candidates. Other names go through Pygments,
+    with a bounded cache. Pygments is imported when the index is first
+    needed; plain text is told apart without loading a lexer class.
+    """
+    PLAIN_TEXT = 'TextLexer'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.is_indexed = False
+
+        # extension: names of the lexers claiming `*.extension`
+        self.extensions = {}
+        # exact file names, and a regex of all the other patterns
+        self.names = set()
+        self.other_re = None
+
+        self.resolved = {}
+
+    def pattern_add(self, pattern, lexer_name, other_patterns):
+        if not any(char in pattern for char in '*?['):
+            self.names.add(pattern)
+        elif (
+            pattern.startswith('*.')
+            and not any(char in pattern[2:] for char in '*?[.')
+        ):
+            self.extensions.setdefault(pattern[1:], []).append(lexer_name)
+        else:
+            other_patterns.append(fnmatch.translate(pattern))
+
+    def index_build(self):
+        from pygments.lexers._mapping import LEXERS
+        from pygments.plugin import find_plugin_lexers
+
+        other_patterns = []
+        for lexer_name, (_, _, _, patterns, _) in LEXERS.items():
+            for pattern in patterns:
+                self.pattern_add(pattern, lexer_name, other_patterns)
+
+        # lexers of plugins are few, and always left to Pygments
+        for lexer_class in find_plugin_lexers():
+            for pattern in lexer_class.filenames:
+                other_patterns.append(fnmatch.translate(pattern))
+
+        if other_patterns:
+            self.other_re = re.compile('|'.join(other_patterns))
+
+    def text_none(self, lexer_class):
+        if lexer_class is None or lexer_class.__name__ == self.PLAIN_TEXT:
+            return None
+
+        return lexer_class
+
+    def get(self, path):
+        """Lexer class of the file name of `path`, or None."""
+        with self.lock:
+            if not self.is_indexed:
+                self.index_build()
+                self.is_indexed = True
+
+        name = os.path.basename(path)
+        if name in self.names or (
+            self.other_re is not None and self.other_re.match(name)
+        ):
+            return self.text_none(lexer_class_find(name))
+
+        _, dot, extension = name.rpartition('.')
+        lexer_names = self.extensions.get(dot + extension) if dot else None
+        if lexer_names is None or lexer_names == [self.PLAIN_TEXT]:
+            return None
+
+        if extension not in self.resolved:
+            self.resolved[extension] = self.text_none(lexer_class_find(name))
+
+        return self.resolved[extension]
+
+
 class AddHeaders:
     api = 2
 
-    def __init__(self):
+    CACHE_CONTROL_DEFAULT = 'no-store, max-age=0'
+
+    def __init__(self, *, cache_control, vary=None):
+        self.cache_control = cache_control
+        self.vary = vary or {}
         self.csp_value = '; '.join([
             "default-src 'self'",
             "block-all-mixed-content",
@@ -48,20 +1215,47 @@ class AddHeaders:
             "frame-ancestors 'none'",
             "object-src 'self'",
             "upgrade-insecure-requests",
-            "style-src 'nonce-23228fbd' 'nonce-f8f2ec78'",
+            "style-src 'self'",
         ])
 
     def apply(self, callback, route):
+        cache_policy = route.config.get('cache_policy')
+        cache_control = self.cache_control.get(
+            cache_policy,
+            self.CACHE_CONTROL_DEFAULT,
+        )
+        vary = self.vary.get(cache_policy)
+
         def wrapper(*args, **kwargs):
-            res.set_header('Cache-Control', 'no-store, max-age=0')
-            res.set_header('Content-Security-Policy', self.csp_value)
-            res.set_header('X-Content-Type-Options', 'nosniff')
-            res.set_header('X-Frame-Options', 'deny')
+            self.set_headers(res, cache_control)
+            if vary is not None:
+                res.set_header('Vary', vary)
 
-            return callback(*args, **kwargs)
+            # an `HTTPResponse` replaces the headers of `res` entirely
+            try:
+                result = callback(*args, **kwargs)
+            except bottle.HTTPError as error:
+                self.set_headers(error, self.CACHE_CONTROL_DEFAULT)
+                raise
+            except bottle.HTTPResponse as response:
+                self.set_headers(response, cache_control)
+                raise
+
+            if isinstance(result, bottle.HTTPError):
+                self.set_headers(result, self.CACHE_CONTROL_DEFAULT)
+            elif isinstance(result, bottle.HTTPResponse):
+                self.set_headers(result, cache_control)
+
+            return result
 
         return wrapper
 
+    def set_headers(self, response, cache_control):
+        response.set_header('Cache-Control', cache_control)
+        response.set_header('Content-Security-Policy', self.csp_value)
+        response.set_header('X-Content-Type-Options', 'nosniff')
+        response.set_header('X-Frame-Options', 'deny')
+
 
 class WrapPath:
     api = 2
@@ -75,362 +1269,3378 @@ class WrapPath:
                 kwargs['url_path'] = './' + kwargs['url_path']
             else:
                 kwargs['url_path'] = './'
-            kwargs['fs_path'] = (
-                self.fs_root.joinpath(kwargs['url_path']).resolve()
+            # unlike `Path.resolve`, `realpath` leaves out the stat that
+            # detects symlink loops, which the stat below fails on anyway
+            kwargs['fs_path'] = Path(
+                os.path.realpath(self.fs_root.joinpath(kwargs['url_path']))
             )
 
+            # the one stat of the request, shared by the other plugins and
+            # the handler; None if the path does not exist
+            try:
+                kwargs['fs_stat'] = os.stat(kwargs['fs_path'])
+            except OSError:
+                kwargs['fs_stat'] = None
+
             return callback(*args, **kwargs)
 
         return wrapper
 
 
-class CheckPath:
+class CheckModified:
+    """
+    Answer conditional GETs for regular files with 304 before the handler
+    runs. The strong ETag is built from the file's inode, size and mtime,
+    plus the query string and `version` for pages rendered from the file,
+    and the representation `variant` picks from the request headers.
+    If-Modified-Since is only honoured without a `version`.
+    """
     api = 2
 
-    def __init__(self, *, fs_root):
-        self.fs_root = fs_root
+    def __init__(self, *, version=None, variant=None):
+        self.version = version
+        self.variant = variant
 
     def apply(self, callback, route):
         def wrapper(*args, **kwargs):
-            url_path = kwargs['url_path']
+            file_stat = kwargs['fs_stat']
+            if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+                return callback(*args, **kwargs)
+
+            etag = self.etag(file_stat)
+            last_modified = http_date(file_stat.st_mtime)
+            res.set_header('ETag', etag)
+            res.set_header('Last-Modified', last_modified)
+
+            not_modified_etag = self.not_modified_etag(etag, file_stat)
+            if not_modified_etag is not None:
+                res.set_header('ETag', not_modified_etag)
+                res.status = 304
+                return ''
+
+            result = callback(*args, **kwargs)
+            if isinstance(result, bottle.HTTPResponse):
+                # as `res` has it, `Compress` may have encoded the body
+                result.set_header('ETag', res.get_header('ETag'))
+                result.set_header('Last-Modified', last_modified)
+
+            return result
+
+        return wrapper
+
+    def etag(self, file_stat):
+        variant = req.query_string
+        if self.version is not None:
+            variant = f'{self.version()}?{variant}'
+        if self.variant is not None and self.variant() is not None:
+            variant = f'{variant}#{self.variant()}'
+
+        return file_etag(file_stat, variant)
+
+    def not_modified_etag(self, etag, file_stat):
+        """
+        ETag of the representation the client has, `etag` or one of its
+        compressed variants, if it is not modified, else None.
+        """
+        if_none_match = req.get_header('If-None-Match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return etag
+
+            etags = [
+                value.strip().removeprefix('W/')
+                for value in if_none_match.split(',')
+            ]
+            for variant_etag in [etag] + [
+                etag_encoded(etag, encoding)
+                for encoding in COMPRESS_ENCODINGS
+            ]:
+                if variant_etag in etags:
+                    return variant_etag
+
+            return None
+
+        # the file's date says nothing about the templates, query or
+        # variant a page is rendered with; only its ETag does
+        if_modified_since = req.get_header('If-Modified-Since')
+        if if_modified_since is not None and self.version is None:
+            modified_since = bottle.parse_date(
+                if_modified_since.split(';')[0].strip()
+            )
+            if (
+                modified_since is not None
+                and int(file_stat.st_mtime) <= modified_since
+            ):
+                return etag
+
+        return None
+
+
+class Compress:
+    """
+    Compress text responses with an encoding the request accepts. Pages
+    and JSON go by their content type, downloads by the `display_type`
+    of their file, unless its type is compressed already. Bodies under
+    the ETag of a file that is not racy are kept compressed in `cache`.
+    Runs inside `CheckModified`, whose ETag it gives an encoded variant.
+    """
+    api = 2
+
+    MIMETYPES = [
+        'application/json',
+        'application/x-ndjson',
+        'application/xml',
+        'image/svg+xml',
+    ]
+
+    def __init__(self, *, cache, display_type, level=COMPRESS_LEVEL):
+        self.cache = cache
+        self.display_type = display_type
+        self.level = level
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            result = callback(*args, **kwargs)
+
+            # an `HTTPResponse` replaces the headers of `res` entirely
+            response, body = res, result
+            if isinstance(result, bottle.HTTPResponse):
+                response, body = result, result.body
+
+            if req.method == 'HEAD' or not self.is_compressible(
+                response,
+                body,
+                kwargs.get('fs_path'),
+                kwargs.get('fs_stat'),
+            ):
+                return result
+
+            vary = response.get_header('Vary')
+            if vary is None:
+                response.set_header('Vary', 'Accept-Encoding')
+            else:
+                response.set_header('Vary', f'{vary}, Accept-Encoding')
+
+            encoding = http_accept_encoding(
+                req.get_header('Accept-Encoding', ''),
+            )
+            # ranges are of the file, never of a compressed body
+            if encoding is None or req.get_header('Range') is not None:
+                return result
+
+            for name in ['Content-Length', 'Accept-Ranges']:
+                if name in response:
+                    del response[name]
+            response.set_header('Content-Encoding', encoding)
+
+            # `CheckModified` set the ETag of the file on `res`
+            cache_key = None
+            etag = res.get_header('ETag')
+            if etag is not None:
+                res.set_header('ETag', etag_encoded(etag, encoding))
+                if not file_stat_is_racy(kwargs['fs_stat']):
+                    cache_key = (etag, encoding)
+
+            compressed = None
+            if cache_key is not None:
+                compressed = self.cache.get(cache_key)
+            if compressed is not None:
+                if hasattr(body, 'close'):
+                    body.close()
+            elif isinstance(body, (str, bytes)):
+                compressed = b''.join(
+                    compress_chunks([body], encoding, self.level),
+                )
+                if cache_key is not None:
+                    self.cache_put(cache_key, compressed)
+            else:
+                on_done = None
+                if cache_key is not None:
+                    on_done = functools.partial(self.cache_put, cache_key)
+                compressed = compress_chunks(
+                    body,
+                    encoding,
+                    self.level,
+                    on_done,
+                    self.cache.max_bytes,
+                )
+
+            if response is res:
+                return compressed
+
+            response.body = compressed
+
+            return response
+
+        return wrapper
+
+    def is_compressible(self, response, body, fs_path, fs_stat):
+        if (
+            response.status_code != 200
+            or response.get_header('Content-Encoding') is not None
+        ):
+            return False
+
+        # bodies not of a file, like the empty one of offloaded files,
+        # are left as they are
+        if isinstance(response, bottle.HTTPResponse):
+            if not isinstance(body, FileRange):
+                return False
+            size = body.length
+        elif isinstance(body, (str, bytes)):
+            size = len(body)
+        else:
+            size = None
+
+        if size is not None and size < COMPRESS_MIN_SIZE:
+            return False
+
+        mimetype = (response.content_type or 'text/html').split(';')[0]
+        if mimetype[:5] == 'text/' or mimetype in self.MIMETYPES:
+            return True
+
+        return (
+            mimetype == 'application/octet-stream'
+            and fs_stat is not None
+            and stat.S_ISREG(fs_stat.st_mode)
+            and not mimetype_is_compressed(fs_path)
+            and self.display_type(fs_path, fs_stat) == 'text'
+        )
+
+    def cache_put(self, cache_key, compressed):
+        self.cache.put(cache_key, compressed, sys.getsizeof(compressed))
+
+
+class Gate:
+    """
+    Admits `limit` requests at once and lets `queue_size` more wait up to
+    `wait` seconds for one of them to leave; the others are turned away.
+    """
+
+    def __init__(self, *, limit, queue_size, wait):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.wait = wait
+
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def enter(self):
+        with self.condition:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue_size:
+                    self.rejected += 1
+                    return False
+
+                self.waiting += 1
+                try:
+                    is_free = self.condition.wait_for(
+                        lambda: self.active < self.limit,
+                        timeout=self.wait,
+                    )
+                finally:
+                    self.waiting -= 1
+
+                if not is_free:
+                    self.timeouts += 1
+                    return False
+
+            self.active += 1
+            self.admitted += 1
+
+            return True
+
+    def leave(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'limit': self.limit,
+                'queue_size': self.queue_size,
+                'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+            }
+
+
+class ClosingBody:
+    """
+    Iterable `body` calling `on_close` once, when it runs out or is
+    closed, as servers close the bodies they do not send whole.
+    """
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+
+    def __iter__(self):
+        try:
+            yield from self.body
+        finally:
+            self.close()
+
+    def close(self):
+        on_close, self.on_close = self.on_close, None
+        if on_close is None:
+            return
+
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            on_close()
+
+
+def body_on_close(body, on_close):
+    """`body` of a response, calling `on_close` once it is sent."""
+    if body is None or isinstance(body, (str, bytes, list, dict)):
+        on_close()
+        return body
+
+    if hasattr(body, 'read'):
+        # `wsgi.file_wrapper` closes the file with the method it has
+        close = body.close
+
+        def close_and_leave():
+            try:
+                close()
+            finally:
+                on_close()
+
+        body.close = close_and_leave
+        return body
+
+    return ClosingBody(body, on_close)
+
+
+class Admit:
+    """
+    Admit requests through the `Gate` of the class `classify` picks for
+    them, answering 503 with Retry-After when it is full. The request
+    keeps its place until its body is closed, so streamed bodies count
+    until they are sent.
+    """
+    api = 2
+
+    def __init__(self, *, gates, classify):
+        self.gates = gates
+        self.classify = classify
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            gate = self.gates.get(self.classify(route, kwargs))
+            if gate is None:
+                return callback(*args, **kwargs)
+
+            if not gate.enter():
+                raise bottle.HTTPError(
+                    503,
+                    'server busy',
+                    headers={'Retry-After': str(ADMIT_RETRY_AFTER)},
+                )
+
+            try:
+                result = callback(*args, **kwargs)
+            except BaseException:
+                gate.leave()
+                raise
+
+            if isinstance(result, bottle.HTTPResponse):
+                result.body = body_on_close(result.body, gate.leave)
+                return result
+
+            return body_on_close(result, gate.leave)
+
+        return wrapper
+
+
+def admit_heavy_default(threads):
+    """
+    Heavy limit and queue for a worker of `threads` threads. Together they
+    take at most half of the threads, leaving the others to light
+    requests; a single thread serves one request at a time anyway and gets
+    no gate.
+    """
+    share = threads // 2
+    limit = min(ADMIT_HEAVY_LIMIT, max(share // 2, 1), share)
+    queue = min(ADMIT_HEAVY_QUEUE, share - limit)
+
+    return limit, queue
+
+
+def request_class(app, route, kwargs):
+    """
+    'heavy' for requests taking a lot of CPU or memory: archives, text
+    file pages, and listings larger than the default page, streamed whole
+    or of a directory larger than `ADMIT_HEAVY_DIR_SIZE` that is not
+    cached; 'light' for the others, unless the route has an `admit` class.
+    """
+    admit = route.config.get('admit')
+    if admit is not None:
+        return admit
+
+    fs_stat = kwargs['fs_stat']
+    if fs_stat is None:
+        return 'light'
+
+    is_page = route.config.get('cache_policy') == 'fs'
+    if stat.S_ISDIR(fs_stat.st_mode):
+        if not is_page:
+            return 'heavy'
+        elif api_format_get() == 'ndjson':
+            return 'heavy'
+        elif dir_page_query()[1] > DIR_PAGE_SIZE:
+            return 'heavy'
+        elif (
+            # reading and sorting the directory costs, whatever the page
+            fs_stat.st_size > ADMIT_HEAVY_DIR_SIZE
+            and not (
+                app.dir_cache is not None
+                and (str(kwargs['fs_path']), *dir_page_query())
+                in app.dir_cache
+            )
+        ):
+            return 'heavy'
+    elif (
+        is_page
+        and stat.S_ISREG(fs_stat.st_mode)
+        and api_format_get() is None
+        # by the extension, as sniffing reads the file
+        and file_guess_display_type(kwargs['fs_path']) == 'text'
+    ):
+        return 'heavy'
+
+    return 'light'
+
+
+class CheckPath:
+    api = 2
+
+    def __init__(self, *, fs_root):
+        self.fs_root = fs_root
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            url_path = kwargs['url_path']
             fs_path = kwargs['fs_path']
+            fs_stat = kwargs['fs_stat']
 
-            if self.dir_trailing_slash(url_path, fs_path):
+            if self.dir_trailing_slash(url_path, fs_stat):
                 bottle.abort(404)
 
-            if self.is_forbidden(self.fs_root, fs_path):
+            if self.is_forbidden(self.fs_root, fs_path, fs_stat):
                 bottle.abort(403)
 
             return callback(*args, **kwargs)
 
         return wrapper
 
-    def dir_trailing_slash(self, url_path, fs_path):
+    def dir_trailing_slash(self, url_path, fs_stat):
         has_trailing_slash = url_path.endswith('/')
-        is_dir = fs_path.is_dir()
+        is_dir = fs_stat is not None and stat.S_ISDIR(fs_stat.st_mode)
 
         return (
             (has_trailing_slash and not is_dir)
             or (not has_trailing_slash and is_dir)
         )
 
-    def is_forbidden(self, root, path):
+    def is_forbidden(self, root, path, path_stat):
         is_outside_root = not path.is_relative_to(root)
+        if is_outside_root or path_stat is None:
+            return is_outside_root
 
         return (
-            is_outside_root
-            or path.is_socket()
-            or path.is_fifo()
-            or path.is_char_device()
-            or path.is_block_device()
+            stat.S_ISSOCK(path_stat.st_mode)
+            or stat.S_ISFIFO(path_stat.st_mode)
+            or stat.S_ISCHR(path_stat.st_mode)
+            or stat.S_ISBLK(path_stat.st_mode)
+        )
+
+
+def dir_entry_sort_key(dir_entry):
+    path_str = dir_entry.path
+
+    try:
+        is_dir = dir_entry.is_dir()
+    except OSError:
+        is_dir = False
+
+    dir_first = -1 if is_dir else 1
+    dot_first = -1 if path_str.startswith('.') else 1
+
+    return (dir_first, dot_first, path_str)
+
+
+def size_pretty(size):
+    units = ['B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y']
+    idx = 0
+
+    while size > 1024:
+        size /= 1024
+        idx += 1
+
+    if idx == 0:
+        return f'{size:d}{units[idx]}'
+    else:
+        return f'{size:.1f}{units[idx]}'
+
+
+def age_pretty(seconds):
+    units = [('s', 60), ('m', 60), ('h', 24), ('d', None)]
+    value = max(0, int(seconds))
+
+    for unit, unit_size in units:
+        if unit_size is None or value < unit_size:
+            break
+        value //= unit_size
+
+    return f'{value}{unit}'
+
+
+def etag_encoded(etag, encoding):
+    # a compressed body is another representation, with its own etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def http_accept_encoding(header):
+    """
+    First encoding of `COMPRESS_ENCODINGS` that the Accept-Encoding
+    `header` accepts, or None.
+    """
+    qvalues = {}
+    for value in header.split(','):
+        name, *params = value.split(';')
+        qvalue = 1.0
+        for param in params:
+            param_name, _, param_value = param.partition('=')
+            if param_name.strip() == 'q':
+                try:
+                    qvalue = float(param_value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.strip().lower()] = qvalue
+
+    for encoding in COMPRESS_ENCODINGS:
+        if qvalues.get(encoding, qvalues.get('*', 0.0)) > 0:
+            return encoding
+
+    return None
+
+
+def compress_chunks(chunks, encoding, level, on_done=None, max_size=None):
+    """
+    `chunks` of str or bytes compressed with `encoding`, each flushed so
+    streamed bodies keep streaming. `on_done` gets the whole compressed
+    body once all of it has been sent, unless it is larger than
+    `max_size`: the body is only kept in memory until it is.
+    """
+    compressor = zlib.compressobj(
+        level,
+        zlib.DEFLATED,
+        COMPRESS_ENCODINGS[encoding],
+    )
+    parts = None
+    if on_done is not None:
+        parts = []
+    size = 0
+
+    def keep(data):
+        nonlocal parts, size
+        size += len(data)
+        if max_size is not None and size > max_size:
+            parts = None
+        else:
+            parts.append(data)
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = (
+                compressor.compress(chunk)
+                + compressor.flush(zlib.Z_SYNC_FLUSH)
+            )
+            if parts is not None:
+                keep(data)
+            yield data
+
+        data = compressor.flush()
+        if parts is not None:
+            keep(data)
+        yield data
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+    if parts is not None:
+        on_done(b''.join(parts))
+
+
+def file_etag(file_stat, variant=''):
+    parts = [
+        f'{file_stat.st_ino:x}',
+        f'{file_stat.st_size:x}',
+        f'{file_stat.st_mtime_ns:x}',
+    ]
+
+    if variant:
+        parts.append(f'{zlib.crc32(variant.encode()):08x}')
+
+    return '"' + '-'.join(parts) + '"'
+
+
+def http_date(timestamp):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(timestamp))
+
+
+def get_url(app, name, url_path):
+    path = quote(str(url_path))
+
+    return app.get_url(name, url_path=url_path)
+
+
+def url_path_crumbs(app, url_path, is_dir=None):
+    """
+    Crumbs of `url_path`. All but the last crumb of a served path are
+    directories, and the last one is if `is_dir`; if `is_dir` is None,
+    as on error pages, each crumb is checked on the filesystem instead.
+    """
+    assert isinstance(url_path, str)
+
+    path = Path(url_path)
+    crumbs = [path] + list(path.parents)
+
+    crumbs.reverse()
+    if len(crumbs) == 1:
+        crumbs = [Path('.')]
+
+    for idx, crumb_path in enumerate(crumbs):
+        is_root = crumb_path == Path('.')
+        if is_dir is None:
+            crumb_is_dir = app.fs_root.joinpath(crumb_path).is_dir()
+        else:
+            crumb_is_dir = is_dir or idx < len(crumbs) - 1
+
+        crumbs[idx] = {
+            'name': crumb_path.name,
+            'url': get_url(app, 'fs', crumb_path),
+            'link_class': 'is-file',
+        }
+
+        if crumb_is_dir:
+            if not is_root:
+                crumbs[idx]['url'] += '/'
+            crumbs[idx]['link_class'] = 'is-dir'
+
+        if is_root:
+            crumbs[idx]['name'] = '.'
+
+    return crumbs
+
+
+def dir_entry_target_mode(dir_entry, entry_stat):
+    if not stat.S_ISLNK(entry_stat.st_mode):
+        return entry_stat.st_mode
+
+    try:
+        return dir_entry.stat().st_mode
+    except OSError:
+        return None
+
+
+def dir_entry_build(app, url_path, name, path, entry_stat, target_mode):
+    entry_url_path = url_path.joinpath(name)
+    entry = {
+        'is_dir': False,
+        'is_symlink': False,
+        'mode': stat.filemode(entry_stat.st_mode),
+        'size_bytes': entry_stat.st_size,
+        'size_pretty': size_pretty(entry_stat.st_size),
+        'name': name,
+        'url': get_url(app, 'fs', entry_url_path),
+        'dl_url': get_url(app, 'dl', entry_url_path),
+        'entry_class': 'is-file',
+        'symlink_path': None,
+        'symlink_class': 'is-file',
+    }
+
+    if target_mode is None:
+        pass
+    elif stat.S_ISDIR(target_mode):
+        entry['is_dir'] = True
+        entry['name'] += '/'
+        entry['url'] += '/'
+        entry['entry_class'] = 'is-dir'
+        entry['symlink_class'] = 'is-dir'
+    elif stat.S_ISSOCK(target_mode):
+        entry['entry_class'] = 'is-socket'
+    elif stat.S_ISFIFO(target_mode):
+        entry['entry_class'] = 'is-fifo'
+    elif stat.S_ISCHR(target_mode):
+        entry['entry_class'] = 'is-char-device'
+    elif stat.S_ISBLK(target_mode):
+        entry['entry_class'] = 'is-block-device'
+
+    if stat.S_ISLNK(entry_stat.st_mode):
+        entry['is_symlink'] = True
+        entry['symlink_path'] = Path(os.readlink(path))
+        if target_mode is not None:
+            entry['entry_class'] = 'is-symlink'
+        else:
+            entry['entry_class'] = 'is-symlink-broken'
+
+    return entry
+
+
+def dir_scan(fs_path):
+    # only `readdir`, plus one stat of the target for symlinks
+    scanned = []
+
+    try:
+        with os.scandir(fs_path) as dir_entries:
+            for dir_entry in dir_entries:
+                scanned.append((dir_entry_sort_key(dir_entry), dir_entry))
+    except PermissionError:
+        pass
+
+    return scanned
+
+
+def dir_scan_window(scanned, offset, limit):
+    # partial selection from whichever end of the listing is closer, so
+    # only about `limit` keys get ordered for the first and last pages;
+    # windows deep inside the listing sort the keys, which is cheaper
+    # than a large heap
+    SELECT_RATIO = 8
+
+    total = len(scanned)
+    end = min(offset + limit, total)
+    sort_key = itemgetter(0)
+
+    if offset >= total:
+        return []
+    elif end * SELECT_RATIO <= total:
+        return heapq.nsmallest(end, scanned, key=sort_key)[offset:]
+    elif (total - offset) * SELECT_RATIO <= total:
+        window = heapq.nlargest(total - offset, scanned, key=sort_key)
+        window = window[total - end:]
+        window.reverse()
+
+        return window
+    else:
+        return sorted(scanned, key=sort_key)[offset:end]
+
+
+def dir_read_entries(app, fs_path, *, offset=0, limit=None):
+    url_path = fs_path.relative_to(app.fs_root)
+    scanned = dir_scan(fs_path)
+
+    if limit is None:
+        limit = len(scanned)
+    window = dir_scan_window(scanned, offset, limit)
+
+    # one lstat per entry in the window, plus one stat for symlinks
+    entries = []
+    for _, dir_entry in window:
+        try:
+            entry_stat = dir_entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        target_mode = dir_entry_target_mode(dir_entry, entry_stat)
+
+        entries.append(dir_entry_build(
+            app,
+            url_path,
+            dir_entry.name,
+            dir_entry.path,
+            entry_stat,
+            target_mode,
+        ))
+
+    return entries, len(scanned)
+
+
+def dir_entries_size(entries):
+    return sys.getsizeof(entries) + sum(
+        sys.getsizeof(entry) + sum(map(sys.getsizeof, entry.values()))
+        for entry in entries
+    )
+
+
+def dir_read_entries_cached(app, fs_path, *, offset, limit, dir_stat=None):
+    if app.dir_cache is None:
+        return dir_read_entries(app, fs_path, offset=offset, limit=limit)
+
+    key = (str(fs_path), offset, limit)
+    cached = app.dir_cache.get(key, dir_stat)
+    if cached is not None:
+        return cached
+
+    generation = app.dir_cache.watch(key[0])
+    entries, total = dir_read_entries(
+        app,
+        fs_path,
+        offset=offset,
+        limit=limit,
+    )
+    if generation is not None:
+        app.dir_cache.put(
+            key,
+            (entries, total),
+            dir_entries_size(entries),
+            generation,
+        )
+
+    return entries, total
+
+
+def query_int(name, default, *, minimum, maximum=None):
+    try:
+        value = int(req.query.get(name, default))
+    except ValueError:
+        return default
+
+    value = max(minimum, value)
+    if maximum is not None:
+        value = min(value, maximum)
+
+    return value
+
+
+def dir_page(offset, limit, total, count):
+    page = {
+        'first': offset + 1,
+        'last': offset + count,
+        'total': total,
+        'prev_url': None,
+        'next_url': None,
+    }
+
+    if offset > 0:
+        prev_offset = max(0, min(offset, total) - limit)
+        page['prev_url'] = f'?offset={prev_offset}&limit={limit}'
+    if offset + limit < total:
+        page['next_url'] = f'?offset={offset + limit}&limit={limit}'
+
+    return page
+
+
+def dir_page_query():
+    offset = query_int('offset', 0, minimum=0)
+    limit = query_int(
+        'limit',
+        DIR_PAGE_SIZE,
+        minimum=1,
+        maximum=DIR_PAGE_SIZE_MAX,
+    )
+
+    return offset, limit
+
+
+def dir_read_page(app, fs_path, fs_stat):
+    """
+    Offset, limit, entries and total of the page of `fs_path` the query
+    asks for, or of the last page when its offset is past the end.
+    """
+    offset, limit = dir_page_query()
+    entries, total = dir_read_entries_cached(
+        app,
+        fs_path,
+        offset=offset,
+        limit=limit,
+        dir_stat=fs_stat,
+    )
+
+    if offset > 0 and offset >= total:
+        offset = max(0, (total - 1) // limit * limit)
+        entries, total = dir_read_entries_cached(
+            app,
+            fs_path,
+            offset=offset,
+            limit=limit,
+            dir_stat=fs_stat,
         )
 
+    return offset, limit, entries, total
+
+
+def dir_serve(app, url_path, fs_path, fs_stat):
+    kwargs = {
+        'path': url_path,
+        'crumbs': url_path_crumbs(app, url_path, is_dir=True),
+        'dl_url': get_url(app, 'dl', url_path) + '?format=zip',
+        **search_form_kwargs(app, fs_path),
+    }
+
+    return dir_serve_stream(app, kwargs, fs_path, fs_stat)
+
+
+def dir_serve_stream(app, kwargs, fs_path, fs_stat):
+    """
+    The listing page: the head goes out before the directory is read,
+    then the rows `DIR_ROWS_CHUNK` at a time, so that it is never whole
+    in memory.
+    """
+    rows_template = app.templates['dir_rows.html']
+
+    yield app.templates['dir_head.html'].render(**kwargs)
+
+    offset, limit, entries, total = dir_read_page(app, fs_path, fs_stat)
+    kwargs = {
+        **kwargs,
+        'page': dir_page(offset, limit, total, len(entries)),
+        **dir_sizes_kwargs(app, fs_path, entries),
+    }
+    yield app.templates['dir_main.html'].render(**kwargs)
+
+    for start in range(0, len(entries), DIR_ROWS_CHUNK):
+        yield rows_template.render(
+            entries=entries[start:start + DIR_ROWS_CHUNK],
+            **kwargs,
+        )
+
+    yield app.templates['dir_tail.html'].render(**kwargs)
+
+
+def dir_size_build(dir_size):
+    if dir_size is None:
+        return None
+
+    size_bytes, files, scanned_at = dir_size
+
+    return {
+        'size_bytes': size_bytes,
+        'size_pretty': size_pretty(size_bytes),
+        'files': files,
+        'age_pretty': age_pretty(time.time() - scanned_at),
+    }
+
+
+def dir_sizes_kwargs(app, fs_path, entries):
+    # looked up on every request rather than cached with the entries,
+    # since sizes change without the listing changing
+    if app.dir_sizes is None:
+        return {}
+
+    app.dir_sizes.ensure_started()
+    scope = fs_path.relative_to(app.fs_root).as_posix()
+    key = '' if scope == '.' else scope + '/'
+
+    dir_sizes = {}
+    for entry in entries:
+        if entry['is_dir'] and not entry['is_symlink']:
+            dir_size = app.dir_sizes.get(key + entry['name'])
+            dir_sizes[entry['name']] = dir_size_build(dir_size)
+
+    return {
+        'dir_size': dir_size_build(app.dir_sizes.get(key)),
+        'dir_sizes': dir_sizes,
+    }
+
+
+def search_form_kwargs(app, fs_path, query=''):
+    if app.search_index is None:
+        return {}
+
+    scope = fs_path.relative_to(app.fs_root).as_posix()
+
+    return {
+        'search_url': app.get_url('search'),
+        'search_path': '' if scope == '.' else scope + '/',
+        'search_query': query,
+    }
+
+
+def search_serve(app):
+    query = req.query.getunicode('q', default='').strip()
+    scope = req.query.getunicode('path', default='').strip('/')
+    scope = '' if scope in ('', '.') else scope + '/'
+    limit = query_int(
+        'limit',
+        SEARCH_LIMIT,
+        minimum=1,
+        maximum=SEARCH_LIMIT_MAX,
+    )
+
+    app.search_index.ensure_started()
+    matches, is_truncated = app.search_index.search(
+        query,
+        scope=scope,
+        limit=limit,
+    )
+
+    results = []
+    for dir_key, name in matches:
+        results.append({
+            'name': name,
+            'url': get_url(app, 'fs', dir_key + name),
+            'entry_class': 'is-dir' if name.endswith('/') else 'is-file',
+            'dir': './' + dir_key,
+            'dir_url': get_url(app, 'fs', dir_key),
+        })
+
+    if app.search_index.snapshot is None:
+        status = 'index is being built'
+    elif not query:
+        status = 'nothing to search'
+    elif is_truncated:
+        status = f'first {len(results)} matches'
+    else:
+        status = f'{len(results)} matches'
+
+    url_path = './' + scope
+
+    return app.templates['search.html'].render(
+        path=url_path,
+        crumbs=url_path_crumbs(app, url_path, is_dir=True),
+        results=results,
+        status=status,
+        **search_form_kwargs(app, app.fs_root.joinpath(scope), query),
+    )
+
+
+def file_guess_display_type(path):
+    MIMETYPES_TEXT = [
+        'application/json',
+        'application/manifest+json',
+        'application/n-quads',
+        'application/n-triples',
+        'application/postscript',
+        'application/rls-services+xml',
+        'application/rtf',
+        'application/sql',
+        'application/trig',
+        'application/vnd.google-earth.kml+xml',
+        'application/x-csh',
+        'application/x-latex',
+        'application/x-ruby',
+        'application/x-sh',
+        'application/x-shar',
+        'application/x-tcl',
+        'application/x-tex',
+        'application/x-texinfo',
+        'application/x-troff',
+        'application/xml',
+        'message/rfc822',
+    ]
+
+    mimetype, encoding = mimetypes.guess_type(path, strict=False)
+
+    if not mimetype:
+        return 'text'
+    elif encoding:
+        return 'binary'
+    elif mimetype[:5] == 'text/' or mimetype in MIMETYPES_TEXT:
+        return 'text'
+    elif mimetype[:6] in 'image/':
+        return 'image'
+    elif mimetype[:6] == 'audio/':
+        return 'audio'
+    elif mimetype[:6] == 'video/':
+        return 'video'
+    elif mimetype == 'application/pdf':
+        return 'pdf'
+    else:
+        return 'binary'
+
+
+def file_sniff(window, *, is_whole, use_magic=True):
+    """
+    Display type of a file from `window`, its first bytes, or all of them
+    if `is_whole`: a media type by its magic number if `use_magic`,
+    otherwise text if it is NUL-free UTF-8, possibly cut in the middle of
+    a character.
+    """
+    if use_magic:
+        match = SNIFF_MAGIC_RE.match(window)
+        if match:
+            return match.lastgroup
+    if b'\0' in window:
+        return 'binary'
+
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(window, is_whole)
+    except UnicodeDecodeError:
+        return 'binary'
+
+    return 'text'
+
+
+def file_display_type(app, path, file_stat):
+    """
+    Display type of the file at `path`: the one of its extension, unless
+    that is text, which is checked against the first `SNIFF_SIZE` bytes
+    of the file so binaries of unknown types are never read whole. Magic
+    numbers only apply to files of unknown types: a few bytes are not
+    enough to overrule a text extension, which can only become binary.
+    """
+    display_type = file_guess_display_type(path)
+    if display_type != 'text':
+        return display_type
+
+    use_magic = mimetypes.guess_type(path, strict=False)[0] is None
+    cache_key = file_stat_key(file_stat) + (use_magic,)
+    cached = app.sniff_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        with path.open('rb') as file:
+            window = file.read(SNIFF_SIZE)
+    except OSError:
+        return display_type
+
+    display_type = file_sniff(
+        window,
+        is_whole=len(window) < SNIFF_SIZE,
+        use_magic=use_magic,
+    )
+    if not file_stat_is_racy(file_stat):
+        app.sniff_cache.put(cache_key, display_type, sys.getsizeof(cache_key))
+
+    return display_type
+
+
+def file_stat_key(file_stat):
+    return (
+        file_stat.st_dev,
+        file_stat.st_ino,
+        file_stat.st_size,
+        file_stat.st_mtime_ns,
+    )
+
+
+def file_stat_is_racy(file_stat):
+    # a file modified within the timestamp granularity of the filesystem
+    # can change again without its mtime changing, so it is not cached
+    RACY_NS = 2_000_000_000
+
+    return time.time_ns() - file_stat.st_mtime_ns < RACY_NS
+
+
+def file_lines_parse(value):
+    """
+    `(first, last)` lines of `A-B`, `A-` (`last` is None) or `-N` (the
+    last N lines, `first` is -N), counted from 1, or None if invalid.
+    """
+    if value is None:
+        return None
+
+    first, sep, last = value.partition('-')
+    try:
+        if not first:
+            return (-int(last), None) if int(last) > 0 else None
+
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        return None
+
+    if not sep or first < 1 or (last is not None and last < first):
+        return None
+
+    return first, last
+
+
+def file_lines_window(lines, line_count):
+    first, last = lines
+
+    if first < 0:
+        # the window ends with the file, however many lines it asks for
+        first = line_count - min(-first, LINES_WINDOW_MAX) + 1
+        last = line_count
+    elif last is None:
+        last = first + LINES_WINDOW - 1
+
+    first = max(1, min(first, line_count))
+    last = max(first, min(last, first + LINES_WINDOW_MAX - 1, line_count))
+
+    return first, last
+
+
+def file_read_lines(fd, offset, count):
+    """Up to `count` lines from `offset`, and how many were read."""
+    MAX_BYTES = 4 << 20
+
+    data = os.pread(fd, MAX_BYTES, offset)
+    end = 0
+    for read_count in range(count):
+        pos = data.find(b'\n', end)
+        if pos == -1:
+            break
+        end = pos + 1
+    else:
+        return data[:end], count
+
+    # `read_count` whole lines, then either the end of the file, which
+    # may not end with a newline, or a line longer than `MAX_BYTES`
+    if end < len(data) and (len(data) < MAX_BYTES or read_count == 0):
+        return data, read_count + 1
+
+    return data[:end], read_count
+
+
+def file_lines_page(first, last, line_count):
+    size = last - first + 1
+    page = {
+        'first': first,
+        'last': last,
+        'total': line_count,
+        'prev_url': None,
+        'next_url': None,
+    }
+
+    if first > 1:
+        page['prev_url'] = f'?lines={max(1, first - size)}-{first - 1}'
+    if last < line_count:
+        page['next_url'] = f'?lines={last + 1}-{last + size}'
+
+    return page
+
+
+def plain_text_html(text, linenostart=1):
+    """
+    `text` in the markup `HtmlFormatter(linenos=True)` gives it with a
+    `TextLexer(stripnl=False)`, from a few bulk string operations rather
+    than a token per line.
+    """
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if not text.endswith('\n'):
+        text += '\n'
+
+    linenoend = linenostart + text.count('\n')
+    width = len(str(linenoend - 1))
+
+    return ''.join([
+        '<div class="highlight"><table class="highlighttable"><tr>'
+        '<td class="linenos"><div class="linenodiv"><pre>',
+        '\n'.join(
+            f'<span class="normal">{lineno:{width}d}</span>'
+            for lineno in range(linenostart, linenoend)
+        ),
+        '</pre></div></td><td class="code"><div><pre><span></span>',
+        text
+        .replace('&', '&amp;')
+        .replace('<', '&lt;')
+        .replace('>', '&gt;')
+        .replace('"', '&quot;')
+        .replace("'", '&#39;'),
+        '</pre></div></td></tr></table></div>\n',
+    ])
+
+
+def text_lexer(app, path):
+    lexer_class = app.lexers.get(path)
+    if lexer_class is None:
+        return None
+
+    return lexer_class()
+
+
+def text_highlight_timeout(signum, frame):
+    raise TimeoutError('highlighting took too long')
+
+
+def text_highlight(
+    text,
+    lexer_class,
+    lexer_options,
+    linenostart,
+    *,
+    time_limit=0,
+):
+    """
+    `text` highlighted, in at most `time_limit` seconds if it is not 0,
+    which only the main thread of a process can be held to.
+    """
+    from pygments import highlight
+    from pygments.formatters import HtmlFormatter
+
+    # lexers compile their rules on first use, so they go by class
+    lexer = lexer_class(**lexer_options)
+    formatter = HtmlFormatter(linenos=True, linenostart=linenostart)
+
+    if time_limit > 0:
+        previous = signal.signal(signal.SIGALRM, text_highlight_timeout)
+        signal.setitimer(signal.ITIMER_REAL, time_limit)
+    try:
+        return highlight(text, lexer, formatter)
+    finally:
+        if time_limit > 0:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+def text_html(app, text, lexer, size, *, linenostart=1, on_late=None):
+    """
+    `text` as HTML and whether it is final: the plain text stands in for
+    the highlighting when the highlight pool is full or it takes longer
+    than `app.highlight_timeout`, and then `on_late` is called with the
+    highlighting if the pool gets it done within `HIGHLIGHT_LATE_FACTOR`
+    times that.
+    """
+    if lexer is None or size > app.highlight_max_size:
+        return plain_text_html(text, linenostart), True
+
+    args = (text, type(lexer), lexer.options, linenostart)
+
+    if app.highlight_pool is None:
+        return text_highlight(*args), True
+
+    def on_done(future):
+        if not future.cancelled() and future.exception() is None:
+            on_late(future.result())
+
+    try:
+        future = app.highlight_pool.try_submit(
+            functools.partial(
+                text_highlight,
+                time_limit=app.highlight_timeout * HIGHLIGHT_LATE_FACTOR,
+            ),
+            *args,
+        )
+        if future is not None:
+            try:
+                return future.result(timeout=app.highlight_timeout), True
+            except TimeoutError:
+                if on_late is not None:
+                    future.add_done_callback(on_done)
+    except BrokenProcessPool:
+        # a process of the pool died, the next job gets a new pool
+        pass
+
+    return plain_text_html(text, linenostart), False
+
+
+def file_serve_lines_kwargs(app, kwargs, file, file_stat, lexer, lines):
+    fd = file.fileno()
+    line_index = app.line_indexes.get(fd, file_stat)
+    line_count = line_index.line_count(fd)
+    first, last = file_lines_window(lines, line_count)
+
+    cache_key = file_stat_key(file_stat) + (type(lexer), first, last)
+    cached = app.highlight_cache.get(cache_key)
+
+    if cached is None:
+        offset = line_index.line_offset(fd, first)
+        data, read_count = b'', 0
+        if offset is not None:
+            data, read_count = file_read_lines(fd, offset, last - first + 1)
+        last = max(first, first + read_count - 1)
+
+        def cache_put(highlighted):
+            if not file_stat_is_racy(file_stat):
+                app.highlight_cache.put(
+                    cache_key,
+                    (highlighted, last),
+                    sys.getsizeof(highlighted),
+                )
+
+        if lexer is not None:
+            # blank lines at the edges of a window are lines all the same
+            lexer = type(lexer)(stripnl=False)
+        highlighted, is_final = text_html(
+            app,
+            data.decode('utf-8', 'replace'),
+            lexer,
+            len(data),
+            linenostart=first,
+            on_late=cache_put,
+        )
+        cached = (highlighted, last)
+
+        if is_final:
+            cache_put(highlighted)
+
+    highlighted, last = cached
+
+    kwargs['can_display'] = True
+    kwargs['warning_message'] = None
+    kwargs['display_kwargs']['highlighted'] = highlighted
+    kwargs['display_kwargs']['page'] = file_lines_page(first, last, line_count)
+
+
+def file_serve_text_kwargs(app, kwargs, lines):
+    ONE_MIB = 1 << 20
+
+    file_stat = kwargs['fs_stat']
+    file_size = file_stat.st_size
+    file_size_pretty = size_pretty(file_size)
+
+    if file_size == 0:
+        kwargs['warning_message'] = 'file is empty'
+        return
+
+    lexer = text_lexer(app, kwargs['fs_path'])
+
+    if lines is not None:
+        with kwargs['fs_path'].open() as file:
+            # the line index maps the open file, so it goes by its stat
+            file_serve_lines_kwargs(
+                app,
+                kwargs,
+                file,
+                os.fstat(file.fileno()),
+                lexer,
+                lines,
+            )
+        return
+
+    if file_size > ONE_MIB:
+        kwargs['warning_message'] = (
+            f'file is too large ({file_size_pretty})'
+        )
+        kwargs['warning_url'] = f'?lines=-{LINES_WINDOW}'
+        kwargs['warning_url_text'] = (
+            f'show the last {LINES_WINDOW} lines'
+        )
+        return
+
+    cache_key = file_stat_key(file_stat) + (type(lexer),)
+    highlighted = app.highlight_cache.get(cache_key)
+
+    if highlighted is None:
+        with kwargs['fs_path'].open() as file:
+            try:
+                file_content = file.read()
+            except UnicodeDecodeError:
+                return
+            file_stat_after = os.fstat(file.fileno())
+
+        def cache_put(highlighted):
+            is_unchanged = (
+                file_stat_key(file_stat) == file_stat_key(file_stat_after)
+            )
+            if is_unchanged and not file_stat_is_racy(file_stat_after):
+                app.highlight_cache.put(
+                    cache_key,
+                    highlighted,
+                    sys.getsizeof(highlighted),
+                )
+
+        highlighted, is_final = text_html(
+            app,
+            file_content,
+            lexer,
+            file_size,
+            on_late=cache_put,
+        )
+
+        if is_final:
+            cache_put(highlighted)
+
+    kwargs['can_display'] = True
+    kwargs['warning_message'] = None
+    kwargs['display_kwargs']['highlighted'] = highlighted
+
+
+def file_serve_other_kwargs(app, kwargs):
+    kwargs['can_display'] = True
+    kwargs['warning_message'] = None
+    kwargs['display_kwargs']['url'] = get_url(app, 'dl', kwargs['path'])
+
+
+def file_serve(app, url_path, fs_path, fs_stat):
+    kwargs = {
+        'path': url_path,
+        'fs_path': fs_path,
+        'fs_stat': fs_stat,
+        'crumbs': url_path_crumbs(app, url_path, is_dir=False),
+        'dl_url': get_url(app, 'dl', url_path),
+        'can_display': False,
+        'warning_message': 'the contents cannot be displayed',
+        'warning_url': None,
+        'warning_url_text': None,
+        'display_type': file_display_type(app, fs_path, fs_stat),
+        'display_kwargs': {},
+    }
+
+    lines = None
+    if kwargs['display_type'] == 'binary':
+        pass
+    elif kwargs['display_type'] == 'text':
+        # the request is read now, the text is read by the stream
+        lines = file_lines_parse(req.query.get('lines'))
+        if file_text_may_fall_back(app, fs_path, fs_stat, lines):
+            # neither clients nor `Compress` may keep the plain text
+            # under the validators of the file
+            for name in ['ETag', 'Last-Modified']:
+                if name in res:
+                    del res[name]
+    elif kwargs['display_type'] in ['image', 'audio', 'video', 'pdf']:
+        file_serve_other_kwargs(app, kwargs)
+    else:
+        raise NotImplementedError(kwargs['display_type'])
+
+    return file_serve_stream(app, kwargs, lines)
+
+
+def file_text_may_fall_back(app, fs_path, fs_stat, lines):
+    """
+    Whether the text of the page of a file may be shown plain for want of
+    its highlighting: it is highlighted in the pool and not cached yet.
+    Windows of lines are not looked up, as that takes their line index.
+    """
+    if app.highlight_pool is None:
+        return False
+
+    lexer_class = app.lexers.get(fs_path)
+    if lexer_class is None:
+        return False
+    elif lines is not None:
+        return True
+    elif fs_stat.st_size > app.highlight_max_size:
+        return False
+
+    return file_stat_key(fs_stat) + (lexer_class,) not in app.highlight_cache
+
+
+def file_serve_stream(app, kwargs, lines):
+    """
+    The file page, the head first, then the rest once the text has been
+    read and highlighted. The status is sent with the head, so failing
+    to read the text shows the warning.
+    """
+    yield app.templates['file_head.html'].render(**kwargs)
+
+    if kwargs['display_type'] == 'text':
+        try:
+            file_serve_text_kwargs(app, kwargs, lines)
+        except OSError:
+            pass
+
+    yield app.templates['file_tail.html'].render(**kwargs)
+
+
+def api_format_get():
+    """
+    Format of `API_FORMATS` the request asks for, by its `format` query
+    or else its Accept header, or None for the page.
+    """
+    api_format = req.query.get('format')
+    if api_format is None:
+        media_types = {
+            value.split(';')[0].strip()
+            for value in req.get_header('Accept', '').split(',')
+        }
+        for api_format, mimetype in API_FORMATS.items():
+            if mimetype in media_types:
+                return api_format
+
+        return None
+    elif api_format not in API_FORMATS:
+        bottle.abort(400, f'unknown format: {api_format}')
+
+    return api_format
+
+
+def entry_api(entry):
+    """`entry` of `dir_entry_build`, as the API gives it."""
+    ENTRY_TYPES = {
+        'is-dir': 'dir',
+        'is-file': 'file',
+        'is-symlink': 'symlink',
+        'is-symlink-broken': 'symlink',
+        'is-socket': 'socket',
+        'is-fifo': 'fifo',
+        'is-char-device': 'char-device',
+        'is-block-device': 'block-device',
+    }
+
+    symlink_path = entry['symlink_path']
+    if symlink_path is not None:
+        symlink_path = str(symlink_path)
+
+    return {
+        'name': entry['name'].removesuffix('/'),
+        'type': ENTRY_TYPES[entry['entry_class']],
+        'mode': entry['mode'],
+        'size': entry['size_bytes'],
+        'is_dir': entry['is_dir'],
+        'symlink_path': symlink_path,
+        'is_symlink_broken': entry['entry_class'] == 'is-symlink-broken',
+        'url': entry['url'],
+        'dl_url': entry['dl_url'],
+    }
+
+
+def dir_serve_api(app, url_path, fs_path, fs_stat):
+    offset, limit, entries, total = dir_read_page(app, fs_path, fs_stat)
+
+    return {
+        'path': url_path,
+        'offset': offset,
+        'limit': limit,
+        'total': total,
+        'entries': [entry_api(entry) for entry in entries],
+    }
+
+
+def dir_stream_api(app, fs_path):
+    """
+    NDJSON lines of the entries of `fs_path`, unsorted and in chunks of
+    `DIR_ROWS_CHUNK` as they are read, so that directories of any size
+    stream from the first `readdir` and are never whole in memory.
+    """
+    url_path = fs_path.relative_to(app.fs_root)
+    lines = []
+
+    try:
+        with os.scandir(fs_path) as dir_entries:
+            for dir_entry in dir_entries:
+                try:
+                    entry_stat = dir_entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                target_mode = dir_entry_target_mode(dir_entry, entry_stat)
+                entry = dir_entry_build(
+                    app,
+                    url_path,
+                    dir_entry.name,
+                    dir_entry.path,
+                    entry_stat,
+                    target_mode,
+                )
+
+                lines.append(json.dumps(entry_api(entry)) + '\n')
+                if len(lines) == DIR_ROWS_CHUNK:
+                    yield ''.join(lines)
+                    lines.clear()
+    except PermissionError:
+        pass
+
+    yield ''.join(lines)
+
+
+def file_serve_api(app, url_path, fs_stat):
+    # the entry of the path as its directory lists it, so symlinks show
+    # as such, while the stat of the request is of their target
+    path = Path(url_path)
+    try:
+        entry_stat = os.lstat(app.fs_root.joinpath(path))
+    except OSError:
+        bottle.abort(404)
+
+    entry = dir_entry_build(
+        app,
+        path.parent,
+        path.name,
+        app.fs_root.joinpath(path),
+        entry_stat,
+        fs_stat.st_mode,
+    )
+
+    return entry_api(entry)
+
+
+def api_serve(app, api_format, url_path, fs_path, fs_stat):
+    if stat.S_ISDIR(fs_stat.st_mode):
+        if api_format == 'ndjson':
+            res.content_type = API_FORMATS['ndjson']
+            return dir_stream_api(app, fs_path)
+
+        result = dir_serve_api(app, url_path, fs_path, fs_stat)
+    else:
+        result = file_serve_api(app, url_path, fs_stat)
+
+    res.content_type = API_FORMATS[api_format]
+
+    return json.dumps(result) + ('\n' if api_format == 'ndjson' else '')
+
+
+def error_serve(app, template_name, message):
+    if req.path[:4] != '/fs/':
+        return f'{message}: {req.method} {req.path}'
+
+    url_path = './' + req.path[4:]
+    fs_path = Path(url_path)
+
+    return app.templates[template_name].render(
+        path=url_path,
+        crumbs=url_path_crumbs(app, url_path),
+        root_url=get_url(app, 'fs', ''),
+    )
+
+
+def static_file_kwargs(fs_path):
+    mimetype, encoding = mimetypes.guess_type(fs_path)
+    interpret_as_octet_stream = (
+        mimetype is None
+        or mimetype[:5] == 'text/'
+    )
+
+    if not interpret_as_octet_stream:
+        return {}
+
+    return {
+        'mimetype': 'application/octet-stream',
+        'download': True,
+    }
+
+
+class FileRange:
+    """
+    File-like body of `length` bytes of `file` starting at `offset`.
+
+    The file is positioned at `offset`, so servers whose `wsgi.file_wrapper`
+    sends from the current position of `fileno()` send the right bytes.
+    """
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.remaining = length
+
+        self.file.seek(offset)
+        file_advise_sequential(self.file, offset, length)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+
+        return data
+
+    def __iter__(self):
+        while data := self.read(self.BLOCK_SIZE):
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+class FileRanges:
+    """
+    `multipart/byteranges` body of several `(start, end)` ranges of `file`,
+    all read from the one open file.
+    """
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, file, ranges, size, content_type):
+        self.file = file
+        self.boundary = secrets.token_hex(16)
+
+        self.parts = [
+            (
+                (
+                    f'\r\n--{self.boundary}\r\n'
+                    f'Content-Type: {content_type}\r\n'
+                    f'Content-Range: bytes {start}-{end - 1}/{size}\r\n'
+                    '\r\n'
+                ).encode(),
+                start,
+                end,
+            )
+            for start, end in ranges
+        ]
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode()
+
+        file_advise_sequential(self.file, 0, 0)
+
+    def content_length(self):
+        return len(self.tail) + sum(
+            len(header) + end - start
+            for header, start, end in self.parts
+        )
+
+    def __iter__(self):
+        fd = self.file.fileno()
+
+        for header, start, end in self.parts:
+            yield header
+
+            position = start
+            while position < end:
+                data = os.pread(
+                    fd,
+                    min(self.BLOCK_SIZE, end - position),
+                    position,
+                )
+                if not data:
+                    raise EOFError(f'{self.file.name} was truncated')
+                position += len(data)
+
+                yield data
+
+        yield self.tail
+
+    def close(self):
+        self.file.close()
+
+
+def file_advise_sequential(file, offset, length):
+    # larger readahead for media played back from `offset`
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(
+            file.fileno(),
+            offset,
+            length,
+            os.POSIX_FADV_SEQUENTIAL,
+        )
+
+
+def http_ranges_parse(header, size):
+    """
+    Satisfiable ranges of a `Range` header, as sorted and coalesced
+    `(start, end)` pairs with `end` exclusive. `[]` when none of them is
+    satisfiable and `None` when the header has to be ignored.
+    """
+    MAX_RANGES = 64
+
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, separator, last = spec.strip().partition('-')
+        if not separator:
+            return None
+        if first and not first.isdigit():
+            return None
+        if last and not last.isdigit():
+            return None
+
+        if first:
+            start = int(first)
+            end = size
+            if last:
+                if int(last) < start:
+                    return None
+                end = min(int(last) + 1, size)
+        elif last:
+            start = max(0, size - int(last))
+            end = size if int(last) else 0
+        else:
+            return None
+
+        if start < end:
+            ranges.append((start, end))
+
+    ranges.sort()
+    coalesced = []
+    for start, end in ranges:
+        if coalesced and start <= coalesced[-1][1]:
+            coalesced[-1] = (coalesced[-1][0], max(end, coalesced[-1][1]))
+        else:
+            coalesced.append((start, end))
+
+    return coalesced
+
+
+def http_if_range_matches(file_stat):
+    if_range = req.get_header('If-Range')
+    if if_range is None:
+        return True
+
+    if_range = if_range.strip()
+    if if_range.startswith(('"', 'W/')):
+        # weak validators never match
+        return if_range == file_etag(file_stat)
+
+    if_range_date = bottle.parse_date(if_range)
+
+    return if_range_date == int(file_stat.st_mtime)
+
+
+def content_disposition(name):
+    ascii_name = name.encode('ascii', 'replace').decode().replace('"', '_')
+    value = f'attachment; filename="{ascii_name}"'
+
+    if ascii_name != name:
+        value += f"; filename*=UTF-8''{quote(name)}"
+
+    return value
+
+
+def mimetype_is_compressed(path):
+    MIMETYPES_COMPRESSED = [
+        'application/gzip',
+        'application/pdf',
+        'application/vnd.rar',
+        'application/x-7z-compressed',
+        'application/x-bzip2',
+        'application/x-rar-compressed',
+        'application/x-xz',
+        'application/zip',
+        'application/zstd',
+    ]
+
+    mimetype, encoding = mimetypes.guess_type(path, strict=False)
+
+    return (
+        encoding is not None
+        or mimetype is not None
+        and (
+            mimetype[:6] in ['image/', 'audio/', 'video/']
+            and mimetype != 'image/svg+xml'
+            or mimetype in MIMETYPES_COMPRESSED
+        )
+    )
+
+
+def file_offload_header(app, fs_path):
+    """
+    `(name, value)` of the header handing the download of `fs_path` to
+    the `app.offload` reverse proxy: a URI under `app.offload_prefix` for
+    nginx, which maps it to the root, the file path for the others.
+    """
+    name = OFFLOAD_HEADERS[app.offload]
+
+    if app.offload == 'nginx':
+        url_path = os.fsencode(fs_path.relative_to(app.fs_root))
+        return name, app.offload_prefix + quote(url_path)
+
+    # header values are latin-1, which passes the bytes of the path as is
+    return name, os.fsencode(fs_path).decode('latin-1')
+
+
+def file_download(
+    fs_path,
+    file_stat,
+    *,
+    mimetype='auto',
+    download=False,
+    offload=None,
+):
+    """
+    `bottle.static_file` for an already checked `fs_path` and its stat
+    `file_stat` (None if it does not exist), with a body that
+    servers can send with `sendfile`, `multipart/byteranges` responses
+    for several ranges, suffix ranges and `If-Range`. With an `offload`
+    header, the body is left empty for the reverse proxy to send.
+    """
+    headers = {}
+
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+        bottle.abort(404)
+    if not os.access(fs_path, os.R_OK):
+        bottle.abort(403)
+
+    if mimetype == 'auto':
+        mimetype, encoding = mimetypes.guess_type(fs_path)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+
+    if mimetype:
+        if mimetype[:5] == 'text/' and 'charset' not in mimetype:
+            mimetype += '; charset=UTF-8'
+        headers['Content-Type'] = mimetype
+
+    if download:
+        headers['Content-Disposition'] = content_disposition(fs_path.name)
+
+    headers['Last-Modified'] = http_date(file_stat.st_mtime)
+
+    if offload is not None:
+        # the proxy answers ranges itself, from the file it sends
+        offload_name, offload_value = offload
+        headers[offload_name] = offload_value
+
+        return bottle.HTTPResponse('', status=200, **headers)
+
+    size = file_stat.st_size
+    ranges = None
+
+    headers['Accept-Ranges'] = 'bytes'
+
+    range_header = req.get_header('Range')
+    if range_header is not None and http_if_range_matches(file_stat):
+        ranges = http_ranges_parse(range_header, size)
+
+    if ranges == []:
+        return bottle.HTTPError(
+            416,
+            'Requested Range Not Satisfiable',
+            **{'Content-Range': f'bytes */{size}'},
+        )
+
+    is_head = req.method == 'HEAD'
+
+    if ranges is None:
+        headers['Content-Length'] = str(size)
+        body = '' if is_head else FileRange(fs_path.open('rb'), 0, size)
+
+        return bottle.HTTPResponse(body, status=200, **headers)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        headers['Content-Length'] = str(end - start)
+        body = ''
+        if not is_head:
+            body = FileRange(fs_path.open('rb'), start, end - start)
+
+        return bottle.HTTPResponse(body, status=206, **headers)
+    else:
+        body = FileRanges(
+            fs_path.open('rb'),
+            ranges,
+            size,
+            headers.pop('Content-Type', 'application/octet-stream'),
+        )
+        headers['Content-Type'] = (
+            f'multipart/byteranges; boundary={body.boundary}'
+        )
+        headers['Content-Length'] = str(body.content_length())
+        if is_head:
+            body.close()
+            body = ''
+
+        return bottle.HTTPResponse(body, status=206, **headers)
+
+
+def archive_members(fs_root, fs_path, is_forbidden, name):
+    """
+    Yield `(name, path, stat)` of `fs_path` and of the directories and
+    regular files under it, depth first, with names under `name/`.
+    Symlinks are followed to regular files inside `fs_root` only, and
+    sockets, fifos and devices are left out. Only one open directory per
+    level of depth is held.
+    """
+    stack = [(os.scandir(fs_path), name + '/')]
+
+    try:
+        yield name + '/', fs_path, fs_path.stat()
+
+        while stack:
+            dir_entries, dir_name = stack[-1]
+            dir_entry = next(dir_entries, None)
+
+            if dir_entry is None:
+                dir_entries.close()
+                stack.pop()
+                continue
+
+            name = dir_name + dir_entry.name
+            path = Path(dir_entry.path)
+            try:
+                entry_stat = dir_entry.stat(follow_symlinks=False)
+
+                if stat.S_ISLNK(entry_stat.st_mode):
+                    path = path.resolve()
+                    entry_stat = path.stat()
+                    if is_forbidden(fs_root, path, entry_stat):
+                        continue
+                    if not stat.S_ISREG(entry_stat.st_mode):
+                        continue
+
+                if stat.S_ISDIR(entry_stat.st_mode):
+                    stack.append((os.scandir(path), name + '/'))
+                    yield name + '/', path, entry_stat
+                elif stat.S_ISREG(entry_stat.st_mode):
+                    yield name, path, entry_stat
+            except OSError:
+                continue
+    finally:
+        for dir_entries, _ in stack:
+            dir_entries.close()
+
+
+def archive_file_chunks(path, size):
+    """
+    Exactly `size` bytes of `path`: a file that grew is cut and a file that
+    shrank is padded with NUL bytes, so headers written earlier stay true.
+    """
+    BLOCK_SIZE = 1 << 20
+
+    remaining = size
+    with open(path, 'rb') as file:
+        file_advise_sequential(file, 0, 0)
+
+        while remaining > 0:
+            data = file.read(min(BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+
+            yield data
+
+    while remaining > 0:
+        padding = min(BLOCK_SIZE, remaining)
+        remaining -= padding
+
+        yield bytes(padding)
+
+
+def archive_tar(members):
+    for name, path, member_stat in members:
+        tarinfo = tarfile.TarInfo(name.rstrip('/'))
+        tarinfo.mode = stat.S_IMODE(member_stat.st_mode)
+        tarinfo.mtime = int(member_stat.st_mtime)
+
+        if stat.S_ISDIR(member_stat.st_mode):
+            tarinfo.type = tarfile.DIRTYPE
+            yield tarinfo.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            continue
+
+        try:
+            chunks = archive_file_chunks(path, member_stat.st_size)
+            first_chunk = next(chunks, b'')
+        except OSError:
+            continue
+
+        tarinfo.size = member_stat.st_size
+        yield tarinfo.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        yield first_chunk
+        yield from chunks
+
+        _, remainder = divmod(member_stat.st_size, tarfile.BLOCKSIZE)
+        if remainder:
+            yield bytes(tarfile.BLOCKSIZE - remainder)
+
+    # end of archive, padded to a whole record like `tarfile` does
+    yield bytes(tarfile.RECORDSIZE)
+
+
+def archive_gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+
+    yield compressor.flush()
+
+
+class ArchiveBuffer:
+    """Unseekable file that `zipfile` writes into and `pop` drains."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+
+        return data
+
+
+def archive_zip(members):
+    # the central directory at the end of a zip needs one small `ZipInfo`
+    # per member, which is the only state that grows with the tree
+    buffer = ArchiveBuffer()
+
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, path, member_stat in members:
+            date_time = time.localtime(max(member_stat.st_mtime, 315532800))
+            zipinfo = zipfile.ZipInfo(name, date_time[:6])
+            zipinfo.external_attr = (member_stat.st_mode & 0xFFFF) << 16
+
+            if stat.S_ISDIR(member_stat.st_mode):
+                zipinfo.CRC = 0
+                zipinfo.compress_size = 0
+                zipinfo.file_size = 0
+                archive.mkdir(zipinfo)
+                yield buffer.pop()
+                continue
+
+            try:
+                chunks = archive_file_chunks(path, member_stat.st_size)
+                first_chunk = next(chunks, b'')
+            except OSError:
+                continue
+
+            zipinfo.file_size = member_stat.st_size
+            if mimetype_is_compressed(name):
+                zipinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zipinfo.compress_type = zipfile.ZIP_DEFLATED
+
+            with archive.open(zipinfo, 'w') as member:
+                member.write(first_chunk)
+                for chunk in chunks:
+                    member.write(chunk)
+                    yield buffer.pop()
+
+            yield buffer.pop()
+
+    yield buffer.pop()
+
+
+def archive_download(app, fs_path, is_forbidden):
+    ARCHIVE_FORMATS = {
+        'zip': ('application/zip', '.zip'),
+        'tar': ('application/x-tar', '.tar'),
+        'tar.gz': ('application/gzip', '.tar.gz'),
+    }
+
+    archive_format = req.query.get('format', 'zip')
+    if archive_format not in ARCHIVE_FORMATS:
+        bottle.abort(400, f'unknown archive format: {archive_format}')
+    if not os.access(fs_path, os.R_OK | os.X_OK):
+        bottle.abort(403)
+
+    mimetype, extension = ARCHIVE_FORMATS[archive_format]
+    name = fs_path.name if fs_path != app.fs_root else app.fs_root.name
+
+    res.content_type = mimetype
+    res.set_header(
+        'Content-Disposition',
+        content_disposition(name + extension),
+    )
+
+    if req.method == 'HEAD':
+        return ''
+
+    members = archive_members(app.fs_root, fs_path, is_forbidden, name)
+
+    if archive_format == 'zip':
+        return archive_zip(members)
+    elif archive_format == 'tar':
+        return archive_tar(members)
+    else:
+        return archive_gzip(archive_tar(members))
+
+
+class ProcessPool:
+    """
+    `ProcessPoolExecutor` started in each process, with at most
+    `queue_size` jobs of `try_submit` pending at once. Once one of its
+    processes dies, an executor fails every job with BrokenProcessPool,
+    so the first job failing that way has it replaced.
+    """
+
+    def __init__(self, *, processes, queue_size=None):
+        self.processes = processes
+        self.slots = None
+        if queue_size is not None:
+            self.slots = threading.BoundedSemaphore(queue_size)
+
+        self.lock = threading.Lock()
+        self.pid = None
+        self.executor = None
+        self.is_broken = False
+
+    def get(self):
+        with self.lock:
+            if self.pid == os.getpid() and self.is_broken:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.pid = None
+
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                # forking a process running threads is not safe
+                self.executor = ProcessPoolExecutor(
+                    self.processes,
+                    mp_context=multiprocessing.get_context('forkserver'),
+                )
+                self.is_broken = False
+
+            return self.executor
+
+    def discard(self, executor):
+        """Have `get` replace `executor`, unless it did already."""
+        with self.lock:
+            if self.executor is executor:
+                self.is_broken = True
+
+    def submit(self, fn, *args):
+        """The future of `fn(*args)`."""
+        executor = self.get()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.discard(executor)
+            raise
+
+        def on_done(future):
+            if future.cancelled():
+                return
+            elif isinstance(future.exception(), BrokenProcessPool):
+                self.discard(executor)
+
+        future.add_done_callback(on_done)
+
+        return future
+
+    def try_submit(self, fn, *args):
+        """The future of `fn(*args)`, or None when the queue is full."""
+        if not self.slots.acquire(blocking=False):
+            return None
+
+        try:
+            future = self.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+
+        return future
+
+    def shutdown(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                self.executor.shutdown(cancel_futures=True)
+            self.pid = None
+            self.executor = None
+
+
+def grep_lines(data, query, line_number, hits, max_hits):
+    counted = 0
+    pos = data.find(query)
+
+    while pos != -1 and len(hits) < max_hits:
+        line_start = data.rfind(b'\n', 0, pos) + 1
+        line_end = data.find(b'\n', pos)
+        if line_end == -1:
+            line_end = len(data)
+
+        line_number += data.count(b'\n', counted, line_start)
+        counted = line_start
+
+        line = data[line_start:line_end][:GREP_LINE_SIZE]
+        hits.append((line_number, line.decode('utf-8', 'replace')))
+        pos = data.find(query, line_end)
+
+    return line_number + data.count(b'\n', counted)
+
+
+def grep_file(path, query, max_bytes, max_hits):
+    """
+    `(hits, bytes_read)` of `query` in the first `max_bytes` of `path`,
+    with up to `max_hits` `(line_number, line)` hits. A file with a NUL
+    byte in its first `SNIFF_SIZE` bytes is binary and not searched
+    further, as pages of such files are.
+    """
+    BLOCK_SIZE = 1 << 20
+
+    hits = []
+    line_number = 1
+    pending = b''
+
+    with open(path, 'rb') as file:
+        block = file.read(min(SNIFF_SIZE, max_bytes))
+        bytes_read = len(block)
+        if b'\0' in block:
+            return hits, bytes_read
+
+        while block and len(hits) < max_hits:
+            data = pending + block
+            # only complete lines, unless a line is longer than a block
+            end = data.rfind(b'\n') + 1
+            if end == 0 and len(data) >= BLOCK_SIZE:
+                end = len(data)
+
+            line_number = grep_lines(
+                data[:end],
+                query,
+                line_number,
+                hits,
+                max_hits,
+            )
+            pending = data[end:]
+
+            block = file.read(min(BLOCK_SIZE, max_bytes - bytes_read))
+            bytes_read += len(block)
+
+        if pending and len(hits) < max_hits:
+            grep_lines(pending, query, line_number, hits, max_hits)
+
+    return hits, bytes_read
+
+
+def grep_files(files, query, max_hits):
+    results = []
+
+    for name, path, max_bytes in files:
+        try:
+            hits, bytes_read = grep_file(path, query, max_bytes, max_hits)
+        except OSError:
+            continue
+
+        max_hits -= len(hits)
+        results.append((name, hits, bytes_read))
+
+    return results
+
+
+def grep_batches(members, summary, *, byte_budget, deadline):
+    """
+    Batches of `(name, path, max_bytes)` of the text files in `members`,
+    stopping once their sizes add up to `byte_budget` or past `deadline`.
+    """
+    BATCH_SIZE = 1 << 20
+    BATCH_FILES = 64
+
+    batch = []
+    batch_size = 0
+
+    for name, path, member_stat in members:
+        if time.monotonic() > deadline:
+            summary['truncated'] = 'time'
+            break
+        if stat.S_ISDIR(member_stat.st_mode):
+            continue
+        if file_guess_display_type(path) != 'text':
+            continue
+        if byte_budget <= 0:
+            summary['truncated'] = 'bytes'
+            break
+
+        max_bytes = min(member_stat.st_size, byte_budget)
+        byte_budget -= max_bytes
+        batch.append((name, path, max_bytes))
+        batch_size += max_bytes
+
+        if batch_size >= BATCH_SIZE or len(batch) >= BATCH_FILES:
+            yield batch
+            batch = []
+            batch_size = 0
+
+    if batch:
+        yield batch
+
+
+def grep_stream(app, fs_path, name, query, limit):
+    started_at = time.monotonic()
+    deadline = started_at + app.grep_time
+    summary = {'files': 0, 'bytes': 0, 'hits': 0, 'truncated': None}
+    members = archive_members(
+        app.fs_root,
+        fs_path,
+        CheckPath(fs_root=app.fs_root).is_forbidden,
+        name,
+    )
+    batches = grep_batches(
+        members,
+        summary,
+        byte_budget=app.grep_bytes,
+        deadline=deadline,
+    )
+    pending = set()
+
+    try:
+        while summary['truncated'] is None:
+            # a few batches in flight per process, so results stream in
+            # order of completion without reading ahead of the budgets
+            while len(pending) < 2 * app.grep_pool.processes:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                # one hit past the limit tells that it truncated results
+                pending.add(app.grep_pool.submit(
+                    grep_files,
+                    batch,
+                    query,
+                    limit - summary['hits'] + 1,
+                ))
+            if not pending:
+                break
+
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                summary['truncated'] = 'time'
+                break
+            done, pending = wait(pending, timeout, FIRST_COMPLETED)
+
+            for future in done:
+                for member_name, hits, bytes_read in future.result():
+                    summary['files'] += 1
+                    summary['bytes'] += bytes_read
+
+                    member_name = member_name.removeprefix('./')
+                    for line_number, line in hits:
+                        if summary['hits'] == limit:
+                            summary['truncated'] = 'hits'
+                            break
+                        summary['hits'] += 1
+
+                        yield json.dumps({
+                            'path': './' + member_name,
+                            'url': get_url(app, 'fs', member_name),
+                            'line': line_number,
+                            'text': line,
+                        }) + '\n'
+    except BrokenProcessPool:
+        # a process of the pool died, the next request gets a new pool
+        summary['truncated'] = 'error'
+    finally:
+        for future in pending:
+            future.cancel()
+        batches.close()
+        members.close()
+
+    summary['seconds'] = round(time.monotonic() - started_at, 3)
+
+    yield json.dumps(summary) + '\n'
+
+
+def grep_serve(app):
+    query = req.query.getunicode('q', default='')
+    if not query or '\n' in query:
+        bottle.abort(400, 'q must be a single non-empty line')
+
+    scope = req.query.getunicode('path', default='').strip('/')
+    fs_path = app.fs_root.joinpath('./' + scope).resolve()
+    if not fs_path.is_relative_to(app.fs_root):
+        bottle.abort(403)
+    if not fs_path.is_dir():
+        bottle.abort(404)
+
+    limit = query_int('limit', GREP_LIMIT, minimum=1, maximum=GREP_LIMIT_MAX)
+    name = fs_path.relative_to(app.fs_root).as_posix()
+
+    res.content_type = 'application/x-ndjson'
+
+    return grep_stream(app, fs_path, name, query.encode(), limit)
+
+
+def app_metrics(app):
+    metrics = {
+        'highlight_cache': app.highlight_cache.stats(),
+        'sniff_cache': app.sniff_cache.stats(),
+    }
+
+    if app.dir_cache is not None:
+        metrics['dir_cache'] = app.dir_cache.stats()
+    if app.search_index is not None:
+        metrics['search_index'] = app.search_index.stats()
+    if app.dir_sizes is not None:
+        metrics['dir_sizes'] = app.dir_sizes.stats()
+    if app.gates:
+        metrics['admission'] = {
+            name: gate.stats()
+            for name, gate in app.gates.items()
+        }
+
+    return metrics
+
+
+def app_crawlers_start(app):
+    if app.search_index is not None:
+        app.search_index.ensure_started()
+    if app.dir_sizes is not None:
+        app.dir_sizes.ensure_started()
+
+
+def app_build(
+    *,
+    development,
+    root,
+    fs_root,
+    highlight_cache_size=HIGHLIGHT_CACHE_SIZE,
+    highlight_max_size=HIGHLIGHT_MAX_SIZE,
+    highlight_processes=HIGHLIGHT_PROCESSES,
+    highlight_timeout=HIGHLIGHT_TIMEOUT,
+    dir_cache_size=0,
+    cache_control_fs=CACHE_CONTROL_FS,
+    cache_control_dl=CACHE_CONTROL_DL,
+    search_interval=SEARCH_INTERVAL,
+    dir_sizes_interval=DIR_SIZES_INTERVAL,
+    line_index_dir=None,
+    grep_processes=GREP_PROCESSES,
+    grep_time=GREP_TIME,
+    grep_bytes=GREP_BYTES,
+    offload=None,
+    offload_prefix=OFFLOAD_PREFIX,
+    compress_level=COMPRESS_LEVEL,
+    heavy_limit=ADMIT_HEAVY_LIMIT,
+    heavy_queue=ADMIT_HEAVY_QUEUE,
+    light_limit=0,
+    light_queue=0,
+    metrics=False,
+):
+    app = Bottle()
+
+    app.root = root
+    app.fs_root = fs_root
+
+    app.templates = Templates(
+        path=app.root.joinpath('templates/'),
+        fresh=development,
+        static_url=functools.partial(app.get_url, 'static'),
+    )
+    app.highlight_cache = ByteLruCache(max_bytes=highlight_cache_size)
+    app.highlight_max_size = highlight_max_size
+    app.highlight_pool = None
+    if highlight_processes > 0:
+        app.highlight_pool = ProcessPool(
+            processes=highlight_processes,
+            queue_size=highlight_processes * HIGHLIGHT_QUEUE_PER_PROCESS,
+        )
+    app.highlight_timeout = highlight_timeout
+    app.lexers = Lexers()
+    app.offload = offload
+    app.offload_prefix = offload_prefix
+    app.sniff_cache = ByteLruCache(max_bytes=SNIFF_CACHE_SIZE)
+    app.dir_cache = None
+    if dir_cache_size > 0:
+        app.dir_cache = DirCache(max_bytes=dir_cache_size)
+    app.search_index = None
+    if search_interval > 0:
+        app.search_index = SearchIndex(
+            fs_root=app.fs_root,
+            interval=search_interval,
+        )
+    app.line_indexes = LineIndexes(
+        path=line_index_dir,
+        max_bytes=LINE_INDEX_CACHE_SIZE,
+    )
+    app.dir_sizes = None
+    if dir_sizes_interval > 0:
+        app.dir_sizes = DirSizes(
+            fs_root=app.fs_root,
+            interval=dir_sizes_interval,
+            max_age=dir_sizes_interval * DIR_SIZES_MAX_AGE_INTERVALS,
+        )
+    app.grep_pool = None
+    if grep_processes > 0:
+        app.grep_pool = ProcessPool(processes=grep_processes)
+    app.grep_time = grep_time
+    app.grep_bytes = grep_bytes
+    app.gates = {
+        name: Gate(limit=limit, queue_size=queue_size, wait=ADMIT_WAIT)
+        for name, limit, queue_size in [
+            ('heavy', heavy_limit, heavy_queue),
+            ('light', light_limit, light_queue),
+        ]
+        if limit > 0
+    }
+
+    app.install(AddHeaders(cache_control={
+        'fs': cache_control_fs,
+        'dl': cache_control_dl,
+        'static': CACHE_CONTROL_STATIC,
+    }, vary={
+        'fs': 'Accept',
+    }))
+
+    wrap_path = WrapPath(fs_root=app.fs_root)
+    check_path = CheckPath(fs_root=app.fs_root)
+    check_modified_fs = CheckModified(
+        version=app.templates.version,
+        variant=api_format_get,
+    )
+    check_modified_dl = CheckModified()
+    admit = Admit(
+        gates=app.gates,
+        classify=functools.partial(request_class, app),
+    )
+    compress = []
+    if compress_level > 0:
+        compress = [Compress(
+            cache=app.highlight_cache,
+            display_type=functools.partial(file_display_type, app),
+            level=compress_level,
+        )]
+
+    @app.error(403)
+    def handler(error):
+        return error_serve(app, 'forbidden.html', 'forbidden')
+
+    @app.error(404)
+    def handler(error):
+        return error_serve(app, 'not_found.html', 'not found')
+
+    @app.error(503)
+    def handler(error):
+        return f'{error.body}: {req.method} {req.path}'
+
+    @app.route('/')
+    @app.route('/fs')
+    def handler():
+        bottle.redirect(get_url(app, 'fs', ''))
+
+    if metrics:
+        @app.route('/metrics')
+        def handler():
+            return app_metrics(app)
+
+    @app.route(
+        '/static/<file_name>',
+        name='static',
+        apply=compress,
+        cache_policy='static',
+    )
+    def handler(file_name):
+        content = app.templates.static_file(file_name)
+        if content is None:
+            bottle.abort(404)
+
+        res.content_type = 'text/css; charset=UTF-8'
+
+        return content
+
+    if app.search_index is not None:
+        @app.route(
+            '/search',
+            name='search',
+            apply=[admit, *compress],
+            admit='heavy',
+        )
+        def handler():
+            return search_serve(app)
+
+    if app.grep_pool is not None:
+        @app.route(
+            '/grep',
+            name='grep',
+            apply=[admit, *compress],
+            admit='heavy',
+        )
+        def handler():
+            return grep_serve(app)
+
+    fs_plugins = [
+        wrap_path,
+        check_path,
+        check_modified_fs,
+        admit,
+        *compress,
+    ]
+    dl_plugins = [
+        wrap_path,
+        check_path,
+        check_modified_dl,
+        admit,
+        *compress,
+    ]
+
+    @app.route('/fs/', apply=fs_plugins, cache_policy='fs')
+    @app.route(
+        '/fs/<url_path:path>',
+        name='fs',
+        apply=fs_plugins,
+        cache_policy='fs',
+    )
+    def handler(url_path, fs_path, fs_stat):
+        api_format = api_format_get()
+        if fs_stat is None:
+            bottle.abort(404)
+        elif api_format is not None:
+            return api_serve(app, api_format, url_path, fs_path, fs_stat)
+        elif stat.S_ISDIR(fs_stat.st_mode):
+            return dir_serve(app, url_path, fs_path, fs_stat)
+        else:
+            return file_serve(app, url_path, fs_path, fs_stat)
+
+    @app.route('/dl/', apply=dl_plugins, cache_policy='dl')
+    @app.route(
+        '/dl/<url_path:path>',
+        name='dl',
+        apply=dl_plugins,
+        cache_policy='dl',
+    )
+    def handler(url_path, fs_path, fs_stat):
+        if fs_stat is not None and stat.S_ISDIR(fs_stat.st_mode):
+            return archive_download(app, fs_path, check_path.is_forbidden)
+        else:
+            offload = None
+            if app.offload is not None:
+                offload = file_offload_header(app, fs_path)
+
+            return file_download(
+                fs_path,
+                fs_stat,
+                offload=offload,
+                **static_file_kwargs(fs_path),
+            )
+
+    return app
+
+
+class SendfileServerHandler(ServerHandler):
+    """
+    `ServerHandler` sending `FileRange` bodies with `socket.sendfile`, so
+    the file data never passes through Python.
+    """
+
+    def sendfile(self):
+        body = self.result.filelike
+        if not isinstance(body, FileRange):
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+
+        self.bytes_sent += self.request_handler.connection.sendfile(
+            body.file,
+            body.offset,
+            body.length,
+        )
+
+        return True
+
+
+class PoolRequestHandler(WSGIRequestHandler):
+    def handle(self):
+        # `WSGIRequestHandler.handle` with a `SendfileServerHandler`
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = SendfileServerHandler(
+            self.rfile,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=self.server.threads > 1,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def address_string(self):
+        return self.client_address[0]
+
+    def log_request(self, *args, **kwargs):
+        if not self.server.quiet:
+            super().log_request(*args, **kwargs)
+
+
+class PoolWSGIServer(WSGIServer):
+    """
+    `WSGIServer` handing connections to a fixed pool of threads. The
+    accept loop blocks while every thread is busy, so connections wait in
+    the listen backlog instead of an unbounded queue.
+    """
+
+    def __init__(self, address, *, threads, reuse_port, quiet):
+        self.threads = threads
+        self.reuse_port = reuse_port
+        self.quiet = quiet
+
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(threads)
+
+        super().__init__(address, PoolRequestHandler)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class PreforkServer(bottle.ServerAdapter):
+    """
+    `workers` forked processes, each serving with `threads` threads. The
+    parent binds a SO_REUSEPORT socket per worker, or one for all of them
+    where there is no SO_REUSEPORT, and a worker accepts on the socket
+    of its slot. As the sockets outlive the workers, connections wait in
+    their backlog while a worker is replaced instead of being refused.
+
+    The parent restarts workers that exit, and on SIGHUP replaces them
+    one at a time: each new worker starts before the old one stops, and
+    the next is replaced once it has finished its in-flight requests.
+    On SIGTERM/SIGINT it stops them after their in-flight requests
+    finish. A second SIGTERM/SIGINT kills them. The optional
+    `worker_init` is called in each worker before it starts serving.
+    """
+    RESTART_DELAY = 1.0
+
+    def run(self, handler):
+        self.handler = handler
+        self.workers = self.options.get('workers', 1)
+        self.threads = self.options.get('threads', 1)
+        self.worker_init = self.options.get('worker_init')
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT')
+
+        if self.reuse_port:
+            self.listeners = [
+                self.server_build()
+                for _ in range(self.workers)
+            ]
+        else:
+            self.listeners = [self.server_build()] * self.workers
+
+        try:
+            # a single worker too, so that it can be replaced on SIGHUP
+            self.master_run()
+        finally:
+            for listener in self.listeners:
+                listener.server_close()
+
+    def server_build(self):
+        server = PoolWSGIServer(
+            (self.host, self.port),
+            threads=self.threads,
+            reuse_port=self.reuse_port,
+            quiet=self.quiet,
+        )
+        server.set_app(self.handler)
+        # workers may share a socket, so it does not block: one woken for
+        # a connection another took would otherwise wait in accept and
+        # never see that it is being stopped
+        server.socket.setblocking(False)
+
+        return server
+
+    def master_run(self):
+        self.stopping = False
+        # pid of each worker: when it started, the generation of workers
+        # it belongs to, which SIGHUP moves on, and its socket
+        self.children = {}
+        self.generation = 0
+        self.draining = set()
+
+        signal.signal(signal.SIGTERM, self.master_stop)
+        signal.signal(signal.SIGINT, self.master_stop)
+        signal.signal(signal.SIGHUP, self.master_restart)
+
+        for slot in range(self.workers):
+            self.worker_spawn(slot)
+
+        while self.children:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+
+            child = self.children.pop(pid, None)
+            if self.stopping or child is None:
+                continue
+            elif pid in self.draining:
+                # replaced already, on to the next one
+                self.draining.discard(pid)
+                self.master_roll()
+                continue
+
+            started_at, _, slot = child
+            if time.monotonic() - started_at < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+            self.worker_spawn(slot)
+
+    def master_signal_children(self, signum):
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def master_stop(self, signum, frame):
+        if self.stopping:
+            self.master_signal_children(signal.SIGKILL)
+        else:
+            self.stopping = True
+            self.master_signal_children(signal.SIGTERM)
+
+    def master_restart(self, signum, frame):
+        self.generation += 1
+        if not self.draining:
+            self.master_roll()
 
-def dir_entry_sort_key(path):
-    path_str = str(path)
+    def master_roll(self):
+        """Replace a worker of an older generation, if one is left."""
+        for pid, (_, generation, slot) in list(self.children.items()):
+            if generation < self.generation and pid not in self.draining:
+                self.worker_spawn(slot)
+                self.draining.add(pid)
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                return
 
-    dir_first = -1 if path.is_dir() else 1
-    dot_first = -1 if path_str.startswith('.') else 1
+    def worker_spawn(self, slot):
+        pid = os.fork()
 
-    return (dir_first, dot_first, path_str)
+        if pid == 0:
+            code = 0
+            try:
+                self.worker_run(slot)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
 
+        self.children[pid] = (time.monotonic(), self.generation, slot)
 
-def size_pretty(size):
-    units = ['B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y']
-    idx = 0
+    def worker_run(self, slot):
+        server = self.listeners[slot]
 
-    while size > 1024:
-        size /= 1024
-        idx += 1
+        def worker_stop(signum, frame):
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            # `shutdown` waits for `serve_forever`, which runs in this thread
+            threading.Thread(target=server.shutdown).start()
 
-    if idx == 0:
-        return f'{size:d}{units[idx]}'
-    else:
-        return f'{size:.1f}{units[idx]}'
+        signal.signal(signal.SIGTERM, worker_stop)
+        signal.signal(signal.SIGINT, worker_stop)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
 
+        if self.worker_init is not None:
+            self.worker_init()
 
-def get_url(app, name, url_path):
-    path = quote(str(url_path))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
 
-    return app.get_url(name, url_path=url_path)
 
+def export_page_path(url_path, offset=0):
+    """
+    Path, relative to the output directory, of the exported /fs/ page of
+    `url_path` at `offset`. Each page is an index in a directory of its
+    own, so pages of files and of directories never collide.
+    """
+    name = f'index.{offset}.html' if offset else 'index.html'
+    parts = ['fs', url_path.strip('/'), name]
 
-def url_path_crumbs(app, url_path):
-    assert isinstance(url_path, str)
+    return '/'.join(part for part in parts if part)
 
-    path = Path(url_path)
-    crumbs = [path] + list(path.parents)
 
-    crumbs.reverse()
-    if len(crumbs) == 1:
-        crumbs = [Path('.')]
+def export_link(app, url, page_url_path, page_path):
+    """
+    Relative link from the exported page `page_path` of `page_url_path`
+    for `url`, a link of the live page. Symlinks are not exported, so
+    links to them go to their targets. Links to anything else than the
+    pages and downloads of directories and regular files, like archives
+    and line windows, and the stylesheets, are kept.
+    """
+    path, _, query = url.partition('?')
+    if not path:
+        path = '/fs/' + quote(os.fsencode(page_url_path))
 
-    for idx, crumb_path in enumerate(crumbs):
-        fs_path = app.fs_root.joinpath(crumb_path)
-        is_root = crumb_path == Path('.')
+    kind = path[:4]
+    params = parse_qs(query)
+    offset = 0
 
-        crumbs[idx] = {
-            'name': crumb_path.name,
-            'url': get_url(app, 'fs', crumb_path),
-            'link_class': 'is-file',
-        }
+    if path.startswith('/static/') and not query:
+        file_name = path.removeprefix('/static/')
+        if app.templates.static_file(file_name) is None:
+            return url
 
-        if fs_path.is_dir():
-            if not is_root:
-                crumbs[idx]['url'] += '/'
-            crumbs[idx]['link_class'] = 'is-dir'
+        return posixpath.relpath(
+            'static/' + file_name,
+            posixpath.dirname(page_path),
+        )
+    elif kind not in ['/fs/', '/dl/']:
+        return url
+    elif (
+        kind == '/fs/'
+        and set(params) == {'offset', 'limit'}
+        and params['limit'] == [str(DIR_PAGE_SIZE)]
+        and params['offset'][0].isdigit()
+    ):
+        offset = int(params['offset'][0])
+    elif query:
+        return url
 
-        if is_root:
-            crumbs[idx]['name'] = '.'
+    fs_path = Path(
+        os.path.realpath(
+            app.fs_root.joinpath(unquote(path[4:], errors='surrogateescape'))
+        )
+    )
+    if not fs_path.is_relative_to(app.fs_root):
+        return url
+    try:
+        fs_mode = os.stat(fs_path).st_mode
+    except OSError:
+        return url
+    if not (
+        stat.S_ISREG(fs_mode)
+        or (kind == '/fs/' and stat.S_ISDIR(fs_mode))
+    ):
+        return url
 
-    return crumbs
+    url_path = fs_path.relative_to(app.fs_root).as_posix()
+    if url_path == '.':
+        url_path = ''
 
+    if kind == '/fs/':
+        target = export_page_path(url_path, offset)
+    else:
+        target = 'dl/' + url_path
 
-def dir_read_entries(app, fs_path):
-    try:
-        entries = list(fs_path.iterdir())
-    except PermissionError:
-        entries = []
-
-    entries.sort(key=dir_entry_sort_key)
-    for idx, entry in enumerate(entries):
-        url_path = entry.relative_to(app.fs_root)
-        entry_stat = entry.stat(follow_symlinks=False)
-        entries[idx] = {
-            'is_dir': False,
-            'is_symlink': False,
-            'mode': stat.filemode(entry_stat.st_mode),
-            'size_bytes': entry_stat.st_size,
-            'size_pretty': size_pretty(entry_stat.st_size),
-            'name': entry.name,
-            'url': get_url(app, 'fs', url_path),
-            'dl_url': get_url(app, 'dl', url_path),
-            'entry_class': 'is-file',
-            'symlink_path': None,
-            'symlink_class': 'is-file',
-        }
+    relative = posixpath.relpath(target, posixpath.dirname(page_path))
 
-        if entry.is_dir():
-            entries[idx]['is_dir'] = True
-            entries[idx]['name'] += '/'
-            entries[idx]['url'] += '/'
-            entries[idx]['entry_class'] = 'is-dir'
-            entries[idx]['symlink_class'] = 'is-dir'
-        elif entry.is_socket():
-            entries[idx]['entry_class'] = 'is-socket'
-        elif entry.is_fifo():
-            entries[idx]['entry_class'] = 'is-fifo'
-        elif entry.is_char_device():
-            entries[idx]['entry_class'] = 'is-char-device'
-        elif entry.is_block_device():
-            entries[idx]['entry_class'] = 'is-block-device'
-
-        if entry.is_symlink():
-            entries[idx]['is_symlink'] = True
-            entries[idx]['symlink_path'] = entry.readlink()
-            if entry.exists():
-                entries[idx]['entry_class'] = 'is-symlink'
-            else:
-                entries[idx]['entry_class'] = 'is-symlink-broken'
+    return quote(os.fsencode(relative))
 
-    return entries
 
+def export_page_html(app, body, page_url_path, page_path):
+    def link_replace(match):
+        url = html.unescape(match[2])
+        link = export_link(app, url, page_url_path, page_path)
+        if link == url:
+            return match[0]
 
-def dir_serve(app, url_path, fs_path):
-    return app.templates['dir.html'].render(
-        path=url_path,
-        crumbs=url_path_crumbs(app, url_path),
-        entries=dir_read_entries(app, fs_path),
-    )
+        return f'{match[1]}="{html.escape(link)}"'
 
+    return re.sub(r'\b(href|src)="([^"]*)"', link_replace, body)
 
-def file_guess_display_type(path):
-    MIMETYPES_TEXT = [
-        'application/json',
-        'application/manifest+json',
-        'application/n-quads',
-        'application/n-triples',
-        'application/postscript',
-        'application/rls-services+xml',
-        'application/rtf',
-        'application/sql',
-        'application/trig',
-        'application/vnd.google-earth.kml+xml',
-        'application/x-csh',
-        'application/x-latex',
-        'application/x-ruby',
-        'application/x-sh',
-        'application/x-shar',
-        'application/x-tcl',
-        'application/x-tex',
-        'application/x-texinfo',
-        'application/x-troff',
-        'application/xml',
-        'message/rfc822',
-    ]
 
-    if path.is_symlink():
-        path = path.readlink()
+def export_get(app, path, query=''):
+    """Status code and body of a GET of `path` and `query` from `app`."""
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        # WSGI strings carry the bytes of the path as latin-1
+        'PATH_INFO': (
+            path.encode('utf-8', 'surrogateescape').decode('latin-1')
+        ),
+        'QUERY_STRING': query,
+    }
+    wsgiref.util.setup_testing_defaults(environ)
+    statuses = []
 
-    mimetype, encoding = mimetypes.guess_type(path, strict=False)
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
 
-    if not mimetype:
-        return 'text'
-    elif encoding:
-        return 'binary'
-    elif mimetype[:5] == 'text/' or mimetype in MIMETYPES_TEXT:
-        return 'text'
-    elif mimetype[:6] in 'image/':
-        return 'image'
-    elif mimetype[:6] == 'audio/':
-        return 'audio'
-    elif mimetype[:6] == 'video/':
-        return 'video'
-    elif mimetype == 'application/pdf':
-        return 'pdf'
-    else:
-        return 'binary'
+    body = app(environ, start_response)
+    try:
+        data = b''.join(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
 
+    return int(statuses[0].split()[0]), data
 
-def file_serve_text_kwargs(kwargs):
-    ONE_MIB = 1 << 20
 
-    file_size = kwargs['fs_path'].stat().st_size
-    file_size_pretty = size_pretty(file_size)
+def export_write(path, data, mtime_ns):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'.{path.name}.webls-tmp')
 
-    if file_size > ONE_MIB:
-        kwargs['warning_message'] = f'file is too large ({file_size_pretty})'
-        return
+    tmp_path.write_bytes(data)
+    if mtime_ns is not None:
+        os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp_path, path)
 
-    try:
-        file_content = kwargs['fs_path'].read_text()
-    except UnicodeDecodeError:
-        return
 
-    if file_size == 0:
-        kwargs['warning_message'] = 'file is empty'
-        return
+def export_copy(src_path, path):
+    # a hard link costs no space, and the output stays valid when the
+    # file is modified in place, since it is the same file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'.{path.name}.webls-tmp')
 
+    tmp_path.unlink(missing_ok=True)
     try:
-        lexer = get_lexer_for_filename(kwargs['fs_path'])
-    except ClassNotFound:
-        lexer = TextLexer()
-    formatter = HtmlFormatter(linenos=True)
-    highlighted = highlight(file_content, lexer, formatter)
-
-    kwargs['can_display'] = True
-    kwargs['warning_message'] = None
-    kwargs['display_kwargs']['highlighted'] = highlighted
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copy2(src_path, tmp_path)
+    os.replace(tmp_path, path)
 
 
-def file_serve_other_kwargs(app, kwargs):
-    kwargs['can_display'] = True
-    kwargs['warning_message'] = None
-    kwargs['display_kwargs']['url'] = get_url(app, 'dl', kwargs['path'])
+@functools.lru_cache(maxsize=1)
+def export_app(**app_kwargs):
+    return app_build(**app_kwargs)
 
 
-def file_serve(app, url_path, fs_path):
-    kwargs = {
-        'path': url_path,
-        'fs_path': fs_path,
-        'crumbs': url_path_crumbs(app, url_path),
-        'dl_url': get_url(app, 'dl', url_path),
-        'can_display': False,
-        'warning_message': 'the contents cannot be displayed',
-        'display_type': file_guess_display_type(fs_path),
-        'display_kwargs': {},
-    }
+def export_task(app_kwargs, out_dir, task):
+    """
+    Export the pages of a directory, or the page and the download of a
+    file, for `task`. Returns the number of pages the server could not
+    render.
+    """
+    app = export_app(**app_kwargs)
+    kind, url_path, mtime_ns, offsets = task
+    failures = 0
 
-    if kwargs['display_type'] == 'binary':
-        pass
-    elif kwargs['display_type'] == 'text':
-        file_serve_text_kwargs(kwargs)
-    elif kwargs['display_type'] in ['image', 'audio', 'video', 'pdf']:
-        file_serve_other_kwargs(app, kwargs)
-    else:
-        raise NotImplementedError(kwargs['display_type'])
+    for offset in offsets:
+        query = f'offset={offset}&limit={DIR_PAGE_SIZE}' if offset else ''
+        status_code, body = export_get(app, '/fs/' + url_path, query)
+        if status_code != 200:
+            failures += 1
+            continue
 
-    return app.templates['file.html'].render(**kwargs)
+        page_path = export_page_path(url_path, offset)
+        body = body.decode('utf-8', 'surrogateescape')
+        body = export_page_html(app, body, url_path, page_path)
+        export_write(
+            out_dir.joinpath(page_path),
+            body.encode('utf-8', 'surrogateescape'),
+            mtime_ns,
+        )
 
+    if kind == 'file':
+        export_copy(app.fs_root.joinpath(url_path), out_dir / 'dl' / url_path)
 
-def error_serve(app, template_name, message):
-    if req.path[:4] != '/fs/':
-        return f'{message}: {req.method} {req.path}'
+    return failures
 
-    url_path = './' + req.path[4:]
-    fs_path = Path(url_path)
 
-    return app.templates[template_name].render(
-        path=url_path,
-        crumbs=url_path_crumbs(app, url_path),
-        root_url=get_url(app, 'fs', ''),
-    )
+def export_tasks(fs_root):
+    """
+    Yield the tasks exporting the directories and regular files under
+    `fs_root`, with the paths of the outputs they write. Symlinks are
+    not followed: links to them go to their targets.
+    """
+    stack = ['']
 
+    while stack:
+        dir_url_path = stack.pop()
+        dir_path = fs_root.joinpath(dir_url_path)
+        # a directory page changes with the directory and its entries
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+        count = 0
 
-def static_file_kwargs(fs_path):
-    mimetype, encoding = mimetypes.guess_type(fs_path)
-    interpret_as_octet_stream = (
-        mimetype is None
-        or mimetype[:5] == 'text/'
-    )
+        try:
+            with os.scandir(dir_path) as dir_entries:
+                for dir_entry in dir_entries:
+                    count += 1
+                    try:
+                        entry_stat = dir_entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    mtime_ns = max(mtime_ns, entry_stat.st_mtime_ns)
+                    url_path = dir_url_path + dir_entry.name
 
-    if not interpret_as_octet_stream:
-        return {}
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        stack.append(url_path + '/')
+                    elif stat.S_ISREG(entry_stat.st_mode):
+                        yield (
+                            ('file', url_path, entry_stat.st_mtime_ns, [0]),
+                            [
+                                export_page_path(url_path),
+                                'dl/' + url_path,
+                            ],
+                        )
+        except PermissionError:
+            pass
 
-    return {
-        'mimetype': 'application/octet-stream',
-        'download': True,
-    }
+        offsets = list(range(0, max(count, 1), DIR_PAGE_SIZE))
+        yield (
+            ('dir', dir_url_path, mtime_ns, offsets),
+            [export_page_path(dir_url_path, offset) for offset in offsets],
+        )
 
 
-def app_build(*, development, root, fs_root):
-    app = Bottle()
+def export(app_kwargs, out_dir, *, processes):
+    """
+    Render the /fs/ pages of the whole tree to `out_dir`, with relative
+    links, and link the files under `out_dir/dl/`, in `processes`
+    processes. Pages of files and directories that have not changed
+    since the last export are kept, unless the templates changed, and
+    outputs of removed files are deleted.
+    """
+    STAMP_NAME = '.webls-export'
 
-    app.root = root
-    app.fs_root = fs_root
+    # the search form and directory sizes need a running server
+    app_kwargs = {
+        **app_kwargs,
+        'development': False,
+        'search_interval': 0,
+        'dir_sizes_interval': 0,
+        'dir_cache_size': 0,
+        'grep_processes': 0,
+        # pages are rendered in a pool of processes already, one at a time
+        'highlight_processes': 0,
+        'heavy_limit': 0,
+        'light_limit': 0,
+    }
+    app = export_app(**app_kwargs)
+    stamp_path = out_dir.joinpath(STAMP_NAME)
+    version = app.templates.version()
 
-    app.templates = Templates(
-        path=app.root.joinpath('templates/'),
-        fresh=development,
-    )
+    try:
+        is_current = stamp_path.read_text() == version
+    except OSError:
+        is_current = False
 
-    app.install(AddHeaders())
+    def is_fresh(output_path, mtime_ns):
+        # downloads are the files themselves, pages depend on templates
+        if not is_current and output_path[:3] == 'fs/':
+            return False
 
-    wrap_path = WrapPath(fs_root=app.fs_root)
-    check_path = CheckPath(fs_root=app.fs_root)
+        try:
+            output_stat = os.stat(out_dir.joinpath(output_path))
+        except OSError:
+            return False
 
-    @app.error(403)
-    def handler(error):
-        return error_serve(app, 'forbidden.html', 'forbidden')
+        return output_stat.st_mtime_ns == mtime_ns
 
-    @app.error(404)
-    def handler(error):
-        return error_serve(app, 'not_found.html', 'not found')
+    outputs = set()
+    tasks = []
+    total = 0
+    for task, task_outputs in export_tasks(app.fs_root):
+        _, _, mtime_ns, _ = task
+        total += 1
+        outputs.update(task_outputs)
+        if not all(is_fresh(path, mtime_ns) for path in task_outputs):
+            tasks.append(task)
 
-    @app.route('/')
-    @app.route('/fs')
-    def handler():
-        bottle.redirect(get_url(app, 'fs', ''))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for file_name, content in app.templates.static_files.items():
+        output_path = 'static/' + file_name
+        outputs.add(output_path)
+        # names are content hashes, an existing file is up to date
+        if not out_dir.joinpath(output_path).exists():
+            export_write(out_dir.joinpath(output_path), content, None)
 
-    @app.route('/fs/', apply=[wrap_path, check_path])
-    @app.route('/fs/<url_path:path>', name='fs', apply=[wrap_path, check_path])
-    def handler(url_path, fs_path):
-        if fs_path.is_dir():
-            return dir_serve(app, url_path, fs_path)
-        elif fs_path.exists():
-            return file_serve(app, url_path, fs_path)
-        else:
-            bottle.abort(404)
+    task_func = functools.partial(export_task, app_kwargs, out_dir)
+    if processes > 1:
+        executor = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context('forkserver'),
+        )
+        with executor:
+            failures = sum(executor.map(task_func, tasks, chunksize=16))
+    else:
+        failures = sum(map(task_func, tasks))
 
-    @app.route('/dl/', apply=[wrap_path, check_path])
-    @app.route('/dl/<url_path:path>', name='dl', apply=[wrap_path, check_path])
-    def handler(url_path, fs_path):
-        path = str(fs_path.relative_to(app.fs_root))
-        kwargs = static_file_kwargs(fs_path)
+    removed = 0
+    for top in ['fs', 'dl', 'static']:
+        for dir_path, dir_names, file_names in os.walk(
+            out_dir.joinpath(top),
+            topdown=False,
+        ):
+            for file_name in file_names:
+                path = Path(dir_path, file_name)
+                if path.relative_to(out_dir).as_posix() not in outputs:
+                    path.unlink()
+                    removed += 1
+            if not os.listdir(dir_path):
+                os.rmdir(dir_path)
 
-        return bottle.static_file(path, root=app.fs_root, **kwargs)
+    stamp_path.write_text(version)
 
-    return app
+    return {
+        'paths': total,
+        'exported': len(tasks),
+        'removed': removed,
+        'failures': failures,
+    }
 
 
 def run_kwargs(opts):
@@ -443,12 +4653,16 @@ def run_kwargs(opts):
         kwargs['reloader'] = True
         kwargs['interval'] = 0.2
         kwargs['debug'] = True
+    else:
+        kwargs['server'] = PreforkServer
+        kwargs['workers'] = opts.workers
+        kwargs['threads'] = opts.threads
 
     return kwargs
 
 
 def option_parser_build():
-    option_parser = OptionParser()
+    option_parser = OptionParser(usage='%prog [options] [export OUTDIR]')
 
     option_parser.add_option(
         '--host',
@@ -466,6 +4680,25 @@ def option_parser_build():
         type='int',
         default=8080,
     )
+    option_parser.add_option(
+        '--workers',
+        help=(
+            'serve from this many processes, which SIGHUP replaces one at'
+            ' a time (default: 1)'
+        ),
+        dest='workers',
+        metavar='N',
+        type='int',
+        default=1,
+    )
+    option_parser.add_option(
+        '--threads',
+        help='serve with this many threads per process (default: 1)',
+        dest='threads',
+        metavar='N',
+        type='int',
+        default=1,
+    )
     option_parser.add_option(
         '--root',
         help='serve this directory (default: .)',
@@ -488,21 +4721,339 @@ def option_parser_build():
         action='store_false',
         default=False,
     )
+    option_parser.add_option(
+        '--highlight-cache',
+        help=(
+            'keep up to this many bytes of highlighted files in memory'
+            f' (default: {HIGHLIGHT_CACHE_SIZE})'
+        ),
+        dest='highlight_cache_size',
+        metavar='BYTES',
+        type='int',
+        default=HIGHLIGHT_CACHE_SIZE,
+    )
+    option_parser.add_option(
+        '--highlight-max-size',
+        help=(
+            'highlight text files up to this many bytes, show larger ones'
+            f' as plain text (default: {HIGHLIGHT_MAX_SIZE})'
+        ),
+        dest='highlight_max_size',
+        metavar='BYTES',
+        type='int',
+        default=HIGHLIGHT_MAX_SIZE,
+    )
+    option_parser.add_option(
+        '--highlight-processes',
+        help=(
+            'highlight text files in this many processes, per worker;'
+            ' 0 highlights them in the request thread'
+            f' (default: {HIGHLIGHT_PROCESSES})'
+        ),
+        dest='highlight_processes',
+        metavar='N',
+        type='int',
+        default=HIGHLIGHT_PROCESSES,
+    )
+    option_parser.add_option(
+        '--highlight-timeout',
+        help=(
+            'show a text file as plain text when highlighting it takes'
+            f' longer than this many seconds (default: {HIGHLIGHT_TIMEOUT})'
+        ),
+        dest='highlight_timeout',
+        metavar='SECONDS',
+        type='float',
+        default=HIGHLIGHT_TIMEOUT,
+    )
+    option_parser.add_option(
+        '--dir-cache',
+        help=(
+            'keep up to this many bytes of directory listings in memory'
+            ' (default: 0, disabled)'
+        ),
+        dest='dir_cache_size',
+        metavar='BYTES',
+        type='int',
+        default=0,
+    )
+    option_parser.add_option(
+        '--search-interval',
+        help=(
+            'crawl the tree for /search every this many seconds, in each'
+            ' worker, e.g. 60; 0 disables searching (default: 0)'
+        ),
+        dest='search_interval',
+        metavar='SECONDS',
+        type='int',
+        default=SEARCH_INTERVAL,
+    )
+    option_parser.add_option(
+        '--line-index-dir',
+        help=(
+            'save the line indexes of files shown by ?lines= under this'
+            ' directory; empty to keep them in memory only'
+            f' (default: {LINE_INDEX_DIR})'
+        ),
+        dest='line_index_dir',
+        metavar='DIR',
+        type='string',
+        default=str(LINE_INDEX_DIR),
+    )
+    option_parser.add_option(
+        '--dir-sizes-interval',
+        help=(
+            'add up the sizes of directories for their listings every this'
+            ' many seconds, in each worker; a file that changes size shows'
+            f' within {DIR_SIZES_MAX_AGE_INTERVALS} intervals'
+            ' (default: 0, disabled)'
+        ),
+        dest='dir_sizes_interval',
+        metavar='SECONDS',
+        type='int',
+        default=DIR_SIZES_INTERVAL,
+    )
+    option_parser.add_option(
+        '--grep-processes',
+        help=(
+            'search file contents for /grep in this many processes, per'
+            ' worker, e.g. the number of CPUs divided by the workers;'
+            ' 0 disables grepping (default: 0)'
+        ),
+        dest='grep_processes',
+        metavar='N',
+        type='int',
+        default=GREP_PROCESSES,
+    )
+    option_parser.add_option(
+        '--grep-time',
+        help=(
+            'stop a /grep request after this many seconds'
+            f' (default: {GREP_TIME})'
+        ),
+        dest='grep_time',
+        metavar='SECONDS',
+        type='float',
+        default=GREP_TIME,
+    )
+    option_parser.add_option(
+        '--grep-bytes',
+        help=(
+            'stop a /grep request after reading this many bytes'
+            f' (default: {GREP_BYTES})'
+        ),
+        dest='grep_bytes',
+        metavar='BYTES',
+        type='int',
+        default=GREP_BYTES,
+    )
+    option_parser.add_option(
+        '--offload',
+        help=(
+            'leave sending /dl/ files to this reverse proxy, with an'
+            ' X-Accel-Redirect (nginx) or X-Sendfile (apache, lighttpd)'
+            ' header (default: none)'
+        ),
+        dest='offload',
+        metavar='SERVER',
+        type='choice',
+        choices=list(OFFLOAD_HEADERS),
+        default=None,
+    )
+    option_parser.add_option(
+        '--offload-prefix',
+        help=(
+            'with --offload=nginx, redirect to this internal location'
+            ' serving the root directory'
+            f' (default: {OFFLOAD_PREFIX})'
+        ),
+        dest='offload_prefix',
+        metavar='PREFIX',
+        type='string',
+        default=OFFLOAD_PREFIX,
+    )
+    option_parser.add_option(
+        '--compress-level',
+        help=(
+            'compress text responses at this zlib level, 0 to disable'
+            f' (default: {COMPRESS_LEVEL})'
+        ),
+        dest='compress_level',
+        metavar='LEVEL',
+        type='int',
+        default=COMPRESS_LEVEL,
+    )
+    option_parser.add_option(
+        '--metrics',
+        help=(
+            'serve the counters of caches, crawlers and admission at'
+            ' /metrics, to anyone who can reach the server (default: off)'
+        ),
+        dest='metrics',
+        action='store_true',
+        default=False,
+    )
+    option_parser.add_option(
+        '--heavy-limit',
+        help=(
+            'serve this many archives, text file pages, large listings,'
+            ' searches and greps at once, per worker; 0 for no limit'
+            ' (default: a quarter of --threads, at most the number of'
+            f' CPUs, {ADMIT_HEAVY_LIMIT})'
+        ),
+        dest='heavy_limit',
+        metavar='N',
+        type='int',
+        default=None,
+    )
+    option_parser.add_option(
+        '--heavy-queue',
+        help=(
+            'let this many more heavy requests wait for their turn,'
+            ' answer 503 to the others; with the limit, less than'
+            ' --threads, so light requests find a thread'
+            ' (default: the rest of half of --threads)'
+        ),
+        dest='heavy_queue',
+        metavar='N',
+        type='int',
+        default=None,
+    )
+    option_parser.add_option(
+        '--light-limit',
+        help=(
+            'serve this many other requests to /fs/ and /dl/ at once,'
+            ' per worker (default: 0, no limit)'
+        ),
+        dest='light_limit',
+        metavar='N',
+        type='int',
+        default=0,
+    )
+    option_parser.add_option(
+        '--light-queue',
+        help=(
+            'let this many more light requests wait for their turn,'
+            ' answer 503 to the others (default: 0)'
+        ),
+        dest='light_queue',
+        metavar='N',
+        type='int',
+        default=0,
+    )
+    option_parser.add_option(
+        '--export-processes',
+        help=(
+            'with export, render pages in this many processes'
+            f' (default: {EXPORT_PROCESSES})'
+        ),
+        dest='export_processes',
+        metavar='N',
+        type='int',
+        default=EXPORT_PROCESSES,
+    )
+    option_parser.add_option(
+        '--cache-control-fs',
+        help=(
+            'Cache-Control header of /fs/ pages'
+            f' (default: {CACHE_CONTROL_FS})'
+        ),
+        dest='cache_control_fs',
+        metavar='VALUE',
+        type='string',
+        default=CACHE_CONTROL_FS,
+    )
+    option_parser.add_option(
+        '--cache-control-dl',
+        help=(
+            'Cache-Control header of /dl/ downloads, e.g. max-age=86400'
+            f' (default: {CACHE_CONTROL_DL})'
+        ),
+        dest='cache_control_dl',
+        metavar='VALUE',
+        type='string',
+        default=CACHE_CONTROL_DL,
+    )
 
     return option_parser
 
 
 def main():
     option_parser = option_parser_build()
-    opts, _ = option_parser.parse_args()
+    opts, args = option_parser.parse_args()
+
+    heavy_limit, heavy_queue = admit_heavy_default(opts.threads)
+    if opts.heavy_limit is not None:
+        heavy_limit = opts.heavy_limit
+    if opts.heavy_queue is not None:
+        heavy_queue = opts.heavy_queue
+    # waiting requests hold a thread: were the heavy ones to take them
+    # all, light ones would wait in the listen backlog and never see 503
+    if (
+        not opts.development
+        and heavy_limit > 0
+        and heavy_limit + heavy_queue >= opts.threads
+    ):
+        option_parser.error(
+            '--heavy-limit and --heavy-queue must add up to less than'
+            ' --threads'
+        )
 
-    app = app_build(
+    app_kwargs = dict(
         development=opts.development,
         root=Path('.').absolute(),
         fs_root=Path(opts.fs_root).absolute(),
+        highlight_cache_size=opts.highlight_cache_size,
+        highlight_max_size=opts.highlight_max_size,
+        highlight_processes=opts.highlight_processes,
+        highlight_timeout=opts.highlight_timeout,
+        dir_cache_size=opts.dir_cache_size,
+        cache_control_fs=opts.cache_control_fs,
+        cache_control_dl=opts.cache_control_dl,
+        search_interval=opts.search_interval,
+        dir_sizes_interval=opts.dir_sizes_interval,
+        line_index_dir=(
+            Path(opts.line_index_dir).absolute()
+            if opts.line_index_dir
+            else None
+        ),
+        grep_processes=opts.grep_processes,
+        grep_time=opts.grep_time,
+        grep_bytes=opts.grep_bytes,
+        offload=opts.offload,
+        offload_prefix=opts.offload_prefix,
+        compress_level=opts.compress_level,
+        heavy_limit=heavy_limit,
+        heavy_queue=heavy_queue,
+        light_limit=opts.light_limit,
+        light_queue=opts.light_queue,
+        metrics=opts.metrics,
     )
+
+    if args:
+        if args[0] != 'export' or len(args) != 2:
+            option_parser.error('the only command is export OUTDIR')
+
+        summary = export(
+            app_kwargs,
+            Path(args[1]).absolute(),
+            processes=opts.export_processes,
+        )
+        print(
+            f'exported {summary["exported"]} of {summary["paths"]} paths,'
+            f' removed {summary["removed"]} outputs,'
+            f' {summary["failures"]} pages failed'
+        )
+        return
+
+    app = app_build(**app_kwargs)
     kwargs = run_kwargs(opts)
 
+    if opts.development:
+        app_crawlers_start(app)
+    else:
+        kwargs['worker_init'] = functools.partial(app_crawlers_start, app)
+
     app.run(**kwargs)
 
 